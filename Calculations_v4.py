@@ -1,7 +1,13 @@
+from __future__ import annotations
 import math
-import pandas as pd
+import threading
+from collections import OrderedDict
+import Lazy as lazy
 import numpy as np
 import time
+import Instrumentation as instr
+import Kernels as kern
+pd = lazy.lazy_import('pandas')
 
 ### Units Converter
 class UnitsConverter:
@@ -28,77 +34,21 @@ class UnitsConverter:
             return (temperature_C + 273.15) * 9 / 5
         def R_to_K(temperature_R: float):
             return temperature_R * 5 / 9
+        def R_to_C(temperature_R: float):
+            return temperature_R * 5 / 9 - 273.15
         def C_to_K(temperature_C: float):
             return temperature_C + 273.15
 
 
 def get_zfactor(Aj: float,
                 Bj: float,
-                phase: str):
-    ### Solving cubic Peng-Robinson Equation of State
-    print('\nSolving Peng-Robinson EOS for {} phase compressibility factor...'.format(phase))
-    roots = []
-    a2 = -(1 - Bj)
-    a1 = Aj - 2 * Bj - 3 * Bj**2
-    a0 = -(Aj * Bj - Bj**2 - Bj**3)
-    q = 1/3 * a1 - 1/9 * a2**2
-    r = 1/6 * (a1 * a2 - 3 * a0) - 1/27 * a2**3
-    if (q**3 + r**2) > 0:
-        print('\tEquation has one real root and a pair of complex conjugate roots...')
-    elif (q**3 + r**2) == 0:
-        print('\tEquation has all real roots and at leas two of them are equal...')
-    else:
-        print('\tEquation has all real roots...')
-    if abs(q**3 + r**2) <= 1e-5:  # this convergence criteria may affect equicomp results
-        smallvar = 0  # introduced to avoid problems when expression is too small
-    else:
-        smallvar = (q ** 3 + r ** 2) ** (1 / 2)
-    print('q={},\tr={}'.format(q, r))
-    print('a0={},\ta1={},\ta2={}'.format(a0, a1, a2))
-    print('smallvar={}'.format(smallvar))
-    print('q**3+r**2='.format(abs(q**3 + r**2)))
-    s1 = np.cbrt(r + smallvar)
-    s2 = np.cbrt(r - smallvar)
-    # print('-->', s1, s2)
-    z1 = (s1 + s2) - a2 / 3
-    z2 = complex(-1/2 * (s1 + s2) - a2 / 3, (3**(1/2)) / 2 * (s1 - s2))
-    z3 = complex(-1/2 * (s1 + s2) - a2 / 3, -(3**(1/2)) / 2 * (s1 - s2))
-    check1 = abs((z1 + z2 +z3) - complex(-1 * a2, 0)) < 0.001
-    check2 = abs((z1 * z2 + z1 * z3 + z2 * z3) - complex(a1, 0)) < 0.001
-    check3 = abs((z1 * z2 * z3) - complex(-1 * a0, 0)) < 0.001
-    # print('-->', z1, z2, z3)
-    if check1 and check2 and check3:
-        print('\tRoots checked successfully!')
-    else:
-        print('\tCheck1: {} = {} --> {}'.format(z1 + z2 + z3, complex(-1 * a2, 0), check1))
-        print('\tCheck2: {} = {} --> {}'.format(z1 * z2 + z1 * z3 + z2 * z3, complex(a1, 0), check2))
-        print('\tCheck3: {} = {} --> {}'.format(z1 * z2 * z3, complex(-1 * a0, 0), check3))
-        print('WARNING! Roots are NOT checked successfully!')
-    for root in [z1, z2, z3]:
-        if abs(root.imag) < 10**-6:
-            root = root.real
-        roots.append(root)
-    ### Selecting proper root for compressibility factor
-    zfactors = []
-    for root in roots:
-        if not(type(root) == complex) and root >= 0 and root >= Bj:
-            zfactors.append(root)
-    if len(zfactors) > 1:
-        if phase == 'vapor':
-            zfactor = min(zfactors)
-        else:
-            zfactor = max(zfactors)
-    else:
-        # zfactor = zfactors[0]
-        try:
-            zfactor = zfactors[0]
-        except:  # ATTENTION!
-            if Bj > 0:
-                zfactor = Bj
-            else:
-                zfactor = 10**-5
-    print()
-    return zfactor
+                phase: str,
+                show_log: bool = True):
+    ### Solving cubic Peng-Robinson Equation of State (scalar front end of get_zfactor_arr)
+    zfactor, valid = get_zfactor_arr(Aj, Bj, phase == 'vapor')
+    if show_log and not valid:
+        instr.logger.warning('No valid %s phase compressibility factor root (A=%s, B=%s)', phase, Aj, Bj)
+    return float(zfactor)
 
 
 def Kvalues_comparison(Kvalues_df1: pd.DataFrame,  # For the time - comparison only for one interaction vapor-liquid
@@ -111,135 +61,16 @@ def Kvalues_comparison(Kvalues_df1: pd.DataFrame,  # For the time - comparison o
 def get_equilibrium_composition_v1(streamcompostion: pd.DataFrame,
                                    Kvalues_df: pd.DataFrame,
                                    show_log: bool):
-    locconvcrit = 1e-4
-    start_time = time.perf_counter()
-    print('\nCalculating equilibrium compositions...')
-    df = pd.DataFrame({'xi': streamcompostion['Content [mol. fract.]'],
-                       'Kign': Kvalues_df['Kign']}, index= streamcompostion.index)
-    result_df = pd.DataFrame(columns= ['vapor', 'liquid'], index= df.index)
-    gn_convergence_check = 0
-    print('\tVapor-Liquid Equilibria...')
-    def convergence_func(df: pd.DataFrame, L: float):
-        Kign_arr = np.array(df['Kign'])
-        res_arr = np.array(df['xi']) / (L + (1 - L) * Kign_arr)
-        check_parameter = np.sum(res_arr) - 1
-        result_df['liquid'] = res_arr
-        result_df['vapor'] = res_arr * Kign_arr
-        return check_parameter
-    L_left = 0
-    L_right = 1
-    L_mid = (L_left + L_right) / 2
-    for i in range(15):
-        L_mid = (L_left + L_right) / 2
-        check_l = convergence_func(df, L_left)
-        check_mid = convergence_func(df, L_mid)
-        if check_l * check_mid < 0:
-            L_right = L_mid
-        else:
-            L_left = L_mid
-        if show_log:
-            print('\t\tvapor-liquid,\tstep-{:d},\tL = {:.4f},\tcheck = {:.3e}'.format(i + 1, L_mid, check_mid))
-        if abs(check_mid) <= locconvcrit:
-            gn_convergence_check = 1
-            break
-    if gn_convergence_check == 1:
-        print('\tEquilibrium composition vapor/liquid converged!')
-    else:
-        if abs(check_mid) <= 0.05:
-            print('\tEquilibrium composition vapor/liquid DID NOT converge in 15 interation, but still OK')
-        else:
-            print('\tWARNING! Equilibrium composition vapor/liquid DID NOT converge!')
-    print('\tIteration time {:.3f} seconds'.format(time.perf_counter() - start_time))
-    return result_df, L_mid
-
-
-# Supposed to work with three phases but do not
-def get_equilibrium_composition_v2(streamcompostion: pd.DataFrame,
-                                   Kvalues_df: pd.DataFrame,
-                                   show_log: bool):
     start_time = time.perf_counter()
-    print('\nCalculating equilibrium compositions...')
-    df = pd.DataFrame({'xi': streamcompostion['Content [mol. fract.]'],
-                       'Kign': Kvalues_df['Kign'],
-                       'Kigq': Kvalues_df['Kigq']}, index= streamcompostion.index)
-    ANAE_result_df = pd.DataFrame(columns= ['non-aqueous', 'aqueous'], index= df.index)
-    ANAE_convergence_check = 0
-    print('\tVapor-non-Aqueous Equilibria...')
-    def convergence_func_na(df: pd.DataFrame, W: float):
-        for component in df.index:
-            xiq = df.loc[component]['xi'] / (W + (1 - W) * df.loc[component]['Kigq'])
-            xig = xiq * df.loc[component]['Kigq']
-            ANAE_result_df.loc[component]['non-aqueous'] = xig
-            ANAE_result_df.loc[component]['aqueous'] = xiq
-        check_parameter = ANAE_result_df['aqueous'].sum() - 1
-        return check_parameter
-    W_left = 0
-    W_right = 1
-    W_mid = (W_left + W_right) / 2
-    for i in range(50):
-        W_mid = (W_left + W_right) / 2
-        check_l = convergence_func_na(df, W_left)
-        check_mid = convergence_func_na(df, W_mid)
-        if check_l * check_mid < 0:
-            W_right = W_mid
-        else:
-            W_left = W_mid
-        if show_log:
-            print('\t\tnon-aqueous/aqueous,\tstep-{:d},\tW = {:.4f},\tcheck = {:.3e}'.format(i + 1, W_mid, check_mid))
-        if abs(check_mid) <= 10**-3:
-            ANAE_convergence_check = 1
-            break
-    if ANAE_convergence_check == 1:
-        print('\tEquilibrium composition vapor/liquid converged!')
-    else:
-        if abs(check_mid) <= 0.05:
-            print('\tEquilibrium composition vapor/liquid DID NOT converge in 15 interation, but still OK')
-        else:
-            print('\tWARNING! Equilibrium composition vapor/liquid DID NOT converge!')
-    print('\tIteration time {:.3} seconds'.format(time.perf_counter() - start_time))
-
-
-    VLE_result_df = pd.DataFrame(columns=['vapor', 'liquid'], index=df.index)
-    VLE_convergence_check = 0
-    print('\tVapor-Liquid Equilibria...')
-    def convergence_func_aq(df: pd.DataFrame, L: float):
-        for component in df.index:
-            xin = ANAE_result_df.loc[component]['non-aqueous'] / (L + (1 - L) * df.loc[component]['Kign'])
-            xig = xin * df.loc[component]['Kign']
-            VLE_result_df.loc[component]['vapor'] = xig
-            VLE_result_df.loc[component]['liquid'] = xin
-        check_parameter = VLE_result_df['liquid'].sum() - 1
-        return check_parameter
-
-    L_left = 0
-    L_right = 1
-    L_mid = (L_left + L_right) / 2
-    for i in range(15):
-        L_mid = (L_left + L_right) / 2
-        check_l = convergence_func_aq(df, L_left)
-        check_mid = convergence_func_aq(df, L_mid)
-        if check_l * check_mid < 0:
-            L_right = L_mid
-        else:
-            L_left = L_mid
-        if show_log:
-            print('\t\tvapor/liquid,\tstep-{:d},\tL = {:.4f},\tcheck = {:.3e}'.format(i + 1, L_mid, check_mid))
-        if abs(check_mid) <= 10 ** -3:
-            VLE_convergence_check = 1
-            break
-    if VLE_convergence_check == 1:
-        print('\tEquilibrium composition vapor/liquid converged!')
-    else:
-        if abs(check_mid) <= 0.05:
-            print('\tEquilibrium composition vapor/liquid DID NOT converge in 15 interation, but still OK')
-        else:
-            print('\tWARNING! Equilibrium composition vapor/liquid DID NOT converge!')
-    print('\tIteration time {:.3} seconds'.format(time.perf_counter() - start_time))
-    result_df = pd.DataFrame(columns= ['vapor', 'liquid', 'aqueous'], index= df.index)
-    result_df['vapor'] = VLE_result_df['vapor']
-    result_df['liquid'] = VLE_result_df['liquid']
-    result_df['aqueous'] = ANAE_result_df['aqueous']
-    return result_df, W_mid, L_mid
+    x, y, L, iterations, converged = solve_rachford_rice_arr(streamcompostion['Content [mol. fract.]'].to_numpy(dtype=float),
+                                                             Kvalues_df['Kign'].to_numpy(dtype=float))
+    result_df = pd.DataFrame({'vapor': y, 'liquid': x}, index=streamcompostion.index)
+    if show_log:
+        instr.logger.debug('Vapor-liquid equilibrium: %d Newton steps, L = %.6f, %.3f seconds',
+                           iterations, L, time.perf_counter() - start_time)
+    if not converged:
+        instr.logger.warning('Equilibrium composition vapor/liquid did not converge')
+    return result_df, L
 
 
 def get_initial_Kvalues(comppropDB: pd.DataFrame,
@@ -286,41 +117,40 @@ def get_compdepvar(comppropDB: pd.DataFrame,
     return compvar_df
 
 
+def get_binary_matrix(binarycoefDB: pd.DataFrame,
+                      components):
+    ### kij[i, j] is taken from binarycoefDB[component_i][component_j]
+    components = list(components)
+    return np.ascontiguousarray(binarycoefDB.loc[components, components].to_numpy(dtype=float).T)
+
+
 def get_phasedepvar(equicomp_df: pd.DataFrame,
                     compvar_df: pd.DataFrame,
                     binarycoefDB: pd.DataFrame,
                     P: float,
                     T: float):
-    R_field = 10.731577089016  # [psi*ft3/(lbmol*R)] - Field
-    phasevar_df = pd.DataFrame(columns=['aj', 'bj', 'Aj', 'Bj'], index=['vapor', 'liquid'])
-    for phase in phasevar_df.index:
-        # Mixing rules for each phase
-        bj = (equicomp_df[phase] * compvar_df['bi']).sum()
-        aj = 0
-        for component_1 in equicomp_df.index:
-            aj += (equicomp_df.loc[component_1][phase] * equicomp_df[phase] * (compvar_df.loc[component_1]['ai'] * compvar_df['ai']) ** 0.5\
-                                                * (1 - binarycoefDB[component_1])).sum()
-        phasevar_df.loc[phase]['aj'] = aj
-        phasevar_df.loc[phase]['bj'] = bj
-        ### Phase-dependent variables calculation
-        phasevar_df.loc[phase]['Aj'] = phasevar_df.loc[phase]['aj'] * P / R_field ** 2 / T ** 2
-        phasevar_df.loc[phase]['Bj'] = phasevar_df.loc[phase]['bj'] * P / R_field / T
-    return phasevar_df
+    ### Mixing rules for each phase, aj is the quadratic form of the (1 - kij) * sqrt(ai * aj) matrix
+    sqrt_a = np.sqrt(compvar_df['ai'].to_numpy(dtype=float))
+    aij = np.outer(sqrt_a, sqrt_a) * (1 - get_binary_matrix(binarycoefDB, compvar_df.index))
+    X = equicomp_df[['vapor', 'liquid']].to_numpy(dtype=float).T
+    aj, bj, Aj, Bj, aij_x = get_phasedepvar_arr(X, compvar_df['bi'].to_numpy(dtype=float), aij, P, T)
+    return pd.DataFrame({'aj': aj, 'bj': bj, 'Aj': Aj, 'Bj': Bj}, index=['vapor', 'liquid'])
 
 
 def get_phasecompdepvar(phasevar_df: pd.DataFrame,
                         compvar_df: pd.DataFrame,
                         equicomp_df: pd.DataFrame,
                         binarycoefDB: pd.DataFrame):
-    ### Calculatin phase-component dependent variable for
-    Aijprime_df = pd.DataFrame(columns=phasevar_df.index, index=compvar_df.index)
-    Bijprime_df = pd.DataFrame(columns=phasevar_df.index, index=compvar_df.index)
-    for phase in phasevar_df.index:
-        Bijprime_df[phase] = compvar_df['bi'] / phasevar_df.loc[phase]['bj']
-        for component in compvar_df.index:
-            aux_var = (equicomp_df[phase] * (compvar_df['ai']) ** 0.5 * (1 - binarycoefDB[component])).sum()
-            Aijprime_df.loc[component][phase] = 1 / phasevar_df.loc[phase]['aj'] * (
-                        2 * math.sqrt(compvar_df.loc[component]['ai']) * aux_var)
+    ### Calculatin phase-component dependent variables, Aij' is a matrix-vector product per phase
+    sqrt_a = np.sqrt(compvar_df['ai'].to_numpy(dtype=float))
+    aij = np.outer(sqrt_a, sqrt_a) * (1 - get_binary_matrix(binarycoefDB, compvar_df.index))
+    X = equicomp_df[phasevar_df.index].to_numpy(dtype=float).T
+    Aijprime, Bijprime = get_phasecompdepvar_arr(phasevar_df['aj'].to_numpy(dtype=float),
+                                                 phasevar_df['bj'].to_numpy(dtype=float),
+                                                 compvar_df['bi'].to_numpy(dtype=float),
+                                                 X @ aij.T)
+    Aijprime_df = pd.DataFrame(Aijprime.T, columns=phasevar_df.index, index=compvar_df.index)
+    Bijprime_df = pd.DataFrame(Bijprime.T, columns=phasevar_df.index, index=compvar_df.index)
     return Aijprime_df, Bijprime_df
 
 
@@ -329,151 +159,1253 @@ def get_fugacities(streamcomp:pd.DataFrame,
                    Aijprime_df: pd.DataFrame,
                    Bijprime_df: pd.DataFrame,
                    zfactors: pd.DataFrame):
-    ### Fugacity coefficients calculation
-    fugacit_df = pd.DataFrame(columns=phasevar_df.index, index=streamcomp.index)
-    for phase in phasevar_df.index:
-        Aj = phasevar_df.loc[phase]['Aj']
-        Bj = phasevar_df.loc[phase]['Bj']
-        for component in streamcomp.index:
-            Aijprime = Aijprime_df.loc[component][phase]
-            Bijprime = Bijprime_df.loc[component][phase]
-            zj = zfactors.loc[phase]['zj']
-            try:
-                f = math.exp(-math.log(zj - Bj) + (zj - 1) * Bijprime \
-                             - Aj / (2 * math.sqrt(2) * Bj) * (Aijprime - Bijprime) \
-                             * math.log((zj + (math.sqrt(2) + 1) * Bj) / (zj - (math.sqrt(2) - 1) * Bj)))
-            except:
-                f = None
-            fugacit_df.loc[component][phase] = f
-    return fugacit_df
+    ### Fugacity coefficients calculation, NaN where the expression is undefined (get_fugacities_arr)
+    phases = phasevar_df.index
+    fugacit = get_fugacities_arr(phasevar_df['Aj'].to_numpy(dtype=float),
+                                 phasevar_df['Bj'].to_numpy(dtype=float),
+                                 Aijprime_df.loc[streamcomp.index, phases].to_numpy(dtype=float).T,
+                                 Bijprime_df.loc[streamcomp.index, phases].to_numpy(dtype=float).T,
+                                 zfactors.loc[phases]['zj'].to_numpy(dtype=float))
+    return pd.DataFrame(fugacit.T, columns=phases, index=streamcomp.index)
 
 
 def get_Kvalues(fugacit_df: pd.DataFrame):
     ### Updated K-values calculation
     Kvalues_df = pd.DataFrame(columns=['Kign', 'Kigq'], index= fugacit_df.index)
-    Kvalues_df['Kign'] = np.where(np.logical_or(fugacit_df['liquid'] is None, fugacit_df['vapor'] is None),
+    Kvalues_df['Kign'] = np.where(np.logical_or(fugacit_df['liquid'].isna(), fugacit_df['vapor'].isna()),
                                   1,
                                   fugacit_df['liquid'] / fugacit_df['vapor'])
     Kvalues_df['Kigq'] = np.array([None] * len(Kvalues_df['Kign']))
     return Kvalues_df
 
 
-def redefine_equicomp(equicomp_df_in: pd.DataFrame,
-                      equicomp_df_out: pd.DataFrame,
-                      phase_fractions: pd.Series,
-                      L: float,
-                      phaseinteractnum: int,
-                      phases_num: int):
-    ### Arranging proper compositions and phase fractions to each phase
-    if phases_num == 3:
-        if phaseinteractnum == 0:
-            equicomp_df_out['aqueous'] = equicomp_df_in['liquid']
-            equicomp_df_out['vapor'] = equicomp_df_in['vapor']
-            phase_fractions['Q'] = L
-        elif phaseinteractnum == 1:
-            equicomp_df_out['vapor'] = equicomp_df_in['vapor']
-            equicomp_df_out['liquid'] = equicomp_df_in['liquid']
-            phase_fractions['V'] = (1 - phase_fractions['Q']) * (1 - L)
-            phase_fractions['L'] = (1 - phase_fractions['Q']) * L
+### Array-native PR-EOS engine
+### Stream is kept as contiguous float64 arrays for the whole solve, DataFrames are built only at the public boundary
+R_field = 10.731577089016  # [psi*ft3/(lbmol*R)] - Field
+CUBIC_DEGENERATE_TOL = 1e-12  # relative discriminant of the PR cubic treated as zero (repeated root)
+
+
+class ComponentSet:
+    ### Component constants of a stream in field units, ordered as the stream composition index
+    def __init__(self,
+                 comppropDB: pd.DataFrame,
+                 binarycoefDB: pd.DataFrame,
+                 components):
+        self.names = list(components)
+        props = comppropDB.loc[self.names]
+        self.Pc = np.ascontiguousarray(UnitsConverter.Pressure.kPa_to_psi(props['Pcrit [kPa]'].to_numpy(dtype=float)))
+        self.Tc = np.ascontiguousarray(UnitsConverter.Temperature.C_to_R(props['Tcrit [C]'].to_numpy(dtype=float)))
+        self.w = np.ascontiguousarray(props['Acentricity'].to_numpy(dtype=float))
+        self.kij = get_binary_matrix(binarycoefDB, self.names)
+        self.water_index = self.names.index('H2O') if 'H2O' in self.names else None
+        # Identity of the component set for caches: same names and constants give the same key
+        self.key = (tuple(self.names), self.Pc.tobytes(), self.Tc.tobytes(), self.w.tobytes())
+
+    def __len__(self):
+        return len(self.names)
+
+
+@instr.profiled('initial K')
+def get_initial_Kvalues_arr(compset: ComponentSet,
+                            P: float,
+                            T: float):  ### Pressure and Temperature in field units
+    ### Wilson correlation, same as get_initial_Kvalues
+    Pr_arr = P / compset.Pc
+    Tr_arr = T / compset.Tc
+    return 1 / Pr_arr * np.exp(5.37 * (1 + compset.w) * (1 - 1 / Tr_arr))
+
+
+def get_eos_params_arr(compset: ComponentSet,
+                       T):  ### Temperature in field units
+    ### Pure-component PR-EOS parameters, same as get_compdepvar; returns ai, bi, kappa and alpha arrays
+    w_arr = compset.w
+    Tr_arr = T / compset.Tc
+    b_i_arr = 0.07780 * R_field * compset.Tc / compset.Pc
+    kappa_arr = np.where(w_arr > 0.49,
+                         0.379642 + 1.4853 * w_arr - 0.164423 * w_arr ** 2 + 0.01666 * w_arr ** 3,
+                         0.37464 + 1.5422 * w_arr - 0.26992 * (w_arr ** 2))
+    alfa_arr = np.where(np.logical_and(compset.Tc == 374.149011230469, Tr_arr ** 0.5 < 0.85),
+                        (1.0085677 + 0.82154 * (1 - Tr_arr ** 0.5)) ** 2,
+                        (1 + kappa_arr * (1 - Tr_arr ** 0.5)) ** 2)
+    ac_arr = 0.45724 * (R_field ** 2) * (compset.Tc ** 2) / compset.Pc
+    return ac_arr * alfa_arr, b_i_arr, kappa_arr, alfa_arr
+
+
+def get_dlnalpha_dT_arr(compset: ComponentSet,
+                        T):  ### Temperature in field units
+    ### Temperature derivative of ln(alpha) for the alpha functions of get_eos_params_arr, d ln(ai) / dT = d ln(alpha) / dT
+    w_arr = compset.w
+    sqrt_Tr_arr = (T / compset.Tc) ** 0.5
+    kappa_arr = np.where(w_arr > 0.49,
+                         0.379642 + 1.4853 * w_arr - 0.164423 * w_arr ** 2 + 0.01666 * w_arr ** 3,
+                         0.37464 + 1.5422 * w_arr - 0.26992 * (w_arr ** 2))
+    water_arr = np.logical_and(compset.Tc == 374.149011230469, sqrt_Tr_arr < 0.85)
+    kappa_arr = np.where(water_arr, 0.82154, kappa_arr)
+    sqrt_alfa_arr = np.where(water_arr, 1.0085677, 1) + kappa_arr * (1 - sqrt_Tr_arr)
+    return -kappa_arr * sqrt_Tr_arr / (sqrt_alfa_arr * T)
+
+
+class CompDepVarCache:
+    ### Bounded LRU cache of pure-component EOS parameters keyed by component set identity and temperature
+    ### Cached arrays are read-only and shared between callers
+    def __init__(self,
+                 maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            params = self._data.get(key)
+            if params is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return params
+
+    def _store(self, key, params):
+        for arr in params:
+            arr.flags.writeable = False
+        with self._lock:
+            self._data[key] = params
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self,
+            compset: ComponentSet,
+            T: float):
+        ### ai, bi, kappa and alpha at a single temperature
+        key = (compset.key, float(T))
+        params = self._lookup(key)
+        if params is None:
+            params = get_eos_params_arr(compset, float(T))
+            self._store(key, params)
+        return params
+
+    def get_many(self,
+                 compset: ComponentSet,
+                 T: np.ndarray):
+        ### ai, kappa and alpha stacked over an array of temperatures (bi does not depend on T)
+        ### Missing temperatures are computed in one vectorized call
+        T = np.asarray(T, dtype=float)
+        if T.size == 0:
+            return get_eos_params_arr(compset, T[..., None])
+        T_unique, inverse = np.unique(T.ravel(), return_inverse=True)
+        found = [self._lookup((compset.key, float(t))) for t in T_unique]
+        missing = [i for i, params in enumerate(found) if params is None]
+        if missing:
+            ai, bi, kappa, alfa = get_eos_params_arr(compset, T_unique[missing][:, None])
+            for row, i in enumerate(missing):
+                found[i] = (ai[row], bi, kappa, alfa[row])
+                self._store((compset.key, float(T_unique[i])), found[i])
+        n = len(compset)
+        ai = np.array([params[0] for params in found])[inverse].reshape(T.shape + (n,))
+        alfa = np.array([params[3] for params in found])[inverse].reshape(T.shape + (n,))
+        return ai, found[0][1], found[0][2], alfa
+
+
+compdepvar_cache = CompDepVarCache()
+
+
+@instr.profiled('compdepvar')
+def get_compdepvar_arr(compset: ComponentSet,
+                       T):  ### Temperature in field units
+    ### Returns ai and bi arrays from compdepvar_cache, T is a scalar or an array of conditions
+    if np.ndim(T) == 0:
+        ai, bi, kappa, alfa = compdepvar_cache.get(compset, T)
     else:
-        equicomp_df_out['vapor'] = equicomp_df_in['vapor']
-        equicomp_df_out['liquid'] = equicomp_df_in['liquid']
-        phase_fractions['V'] = 1 - L
-        phase_fractions['L'] = L
-    return equicomp_df_out, phase_fractions
+        ai, bi, kappa, alfa = compdepvar_cache.get_many(compset, T)
+    return ai, bi
+
+
+def solve_rachford_rice_loop(z: np.ndarray,
+                             K: np.ndarray,
+                             Km1: np.ndarray,
+                             max_iter: int):
+    ### NumPy vapor fraction loop of solve_rachford_rice_arr on conditions x components, all conditions at once
+    ### Returns V, Newton iteration counts, convergence flags and all-liquid / all-vapor flags
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        present = z > 0
+        K_max = np.where(present, K, -np.inf).max(axis=-1)
+        K_min = np.where(present, K, np.inf).min(axis=-1)
+        V_min = 1 / (1 - K_max)
+        V_max = 1 / (1 - K_min)
+        V_low = V_min.copy()
+        V_high = V_max.copy()
+        ### All K-values at one side of unity - no root, feed is entirely liquid (K <= 1) or vapor (K >= 1)
+        all_liquid = K_max <= 1
+        all_vapor = K_min >= 1
+        V = np.where(all_liquid, 0., np.where(all_vapor, 1., 0.5))
+        iterations = np.zeros(len(K), dtype=int)
+        converged = all_liquid | all_vapor
+        active = np.flatnonzero(~converged & np.isfinite(V_low) & np.isfinite(V_high))
+        for i in range(max_iter):
+            if active.size == 0:
+                break
+            Va = V[active]
+            denom = 1 + Va[:, None] * Km1[active]
+            terms = z[active] * Km1[active] / denom
+            f = terms.sum(axis=-1)
+            df = -(terms * Km1[active] / denom).sum(axis=-1)
+            V_low[active] = np.where(f > 0, Va, V_low[active])
+            V_high[active] = np.where(f < 0, Va, V_high[active])
+            ### Newton on (V - V_min) * (V_max - V) * f(V), free of the poles at the asymptotes (Leibovici-Neoschil)
+            dist_low = Va - V_min[active]
+            dist_high = V_max[active] - Va
+            F = dist_low * dist_high * f
+            dF = (dist_high - dist_low) * f + dist_low * dist_high * df
+            step = F / dF
+            V_new = Va - step
+            done = (abs(step) <= 4 * np.finfo(float).eps * np.maximum(1, abs(Va))) | (f == 0)
+            outside = ~((V_new > V_low[active]) & (V_new < V_high[active])) & ~done
+            V_new = np.where(outside, (V_low[active] + V_high[active]) / 2, V_new)
+            V[active] = V_new
+            iterations[active] += 1
+            converged[active[done]] = True
+            active = active[~done]
+    return V, iterations, converged, all_liquid, all_vapor
+
+
+@instr.profiled('rachford-rice')
+def solve_rachford_rice_arr(z: np.ndarray,
+                            K: np.ndarray,
+                            max_iter: int = 100):
+    ### Vapor-liquid split of feed z with K-values K (Rachford-Rice), leading axes are independent conditions
+    ### Solved in vapor fraction V = 1 - L: f(V) = sum(z * (K - 1) / (1 + V * (K - 1))) = 0, f is decreasing in V
+    ### Root is bracketed by the asymptotes 1 / (1 - Kmax) < V < 1 / (1 - Kmin), so negative flash is allowed
+    ### (L outside [0, 1] means that only one phase is present for these K-values)
+    ### Newton steps leaving the bracket are replaced by bisection, iterations stop at machine tolerance
+    ### Returns x (liquid), y (vapor), liquid fraction L, Newton iteration counts and convergence flags
+    z, K = np.broadcast_arrays(np.asarray(z, dtype=float), np.asarray(K, dtype=float))
+    shape = K.shape
+    z = z.reshape(-1, shape[-1])
+    K = K.reshape(-1, shape[-1])
+    Km1 = K - 1
+    if kern.enabled:
+        V, iterations, converged, all_liquid, all_vapor = kern.rachford_rice_kernel(np.ascontiguousarray(z),
+                                                                                    np.ascontiguousarray(K),
+                                                                                    max_iter)
+    else:
+        V, iterations, converged, all_liquid, all_vapor = solve_rachford_rice_loop(z, K, Km1, max_iter)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        x = z / (1 + V[:, None] * Km1)
+        x = np.where((all_liquid | all_vapor)[:, None], np.where(all_liquid[:, None], z, z / K), x)
+        y = x * K
+    return (x.reshape(shape), y.reshape(shape), (1 - V).reshape(shape[:-1])[()],
+            iterations.reshape(shape[:-1])[()], converged.reshape(shape[:-1])[()])
+
+
+def get_equilibrium_composition_arr(z: np.ndarray,
+                                    K: np.ndarray):
+    ### Returns x (liquid), y (vapor) and liquid fraction L from solve_rachford_rice_arr
+    x, y, L, iterations, converged = solve_rachford_rice_arr(z, K)
+    return x, y, L
+
+
+def redefine_equicomp_arr(equicomp: np.ndarray,
+                          phase_fractions: np.ndarray,
+                          feed: np.ndarray,
+                          x: np.ndarray,
+                          y: np.ndarray,
+                          L):
+    ### Arranging vapor-liquid compositions and phase fractions of a two-phase flash
+    ### Leading axes are conditions; liquid fraction outside [0, 1] (negative flash) leaves one phase
+    ### with the feed composition and marks the other one as absent (NaN)
+    L = np.clip(L, 0, 1)
+    liquid_only = (L == 1)[..., None]
+    vapor_only = (L == 0)[..., None]
+    equicomp[..., 0, :] = np.where(vapor_only, feed, np.where(liquid_only, np.nan, y))
+    equicomp[..., 1, :] = np.where(liquid_only, feed, np.where(vapor_only, np.nan, x))
+    phase_fractions[..., 0] = 1 - L
+    phase_fractions[..., 1] = L
+    return equicomp, phase_fractions
+
+
+def arrange_two_phase_arr(mixrule,
+                          feed: np.ndarray,
+                          P,
+                          phase_fractions: np.ndarray,
+                          zj: np.ndarray):
+    ### Z-factors (..., 3) and aqueous fraction of a vapor-liquid flash arranged by redefine_equicomp_arr, as in
+    ### arrange_multiphase_arr: two phases keep the z-factors of the last iteration, a single remaining phase gets
+    ### the z-factor of the feed, absent phases NaN, no aqueous phase (Q = 0)
+    ### Leading axes are conditions
+    phase_fractions[..., 2] = 0
+    zfactors = np.concatenate((zj, np.full(zj.shape[:-1] + (1,), np.nan)), axis=-1)
+    return phase_fractions, get_single_phase_zfactors_arr(mixrule, feed, P, phase_fractions > 0, zfactors)
+
+
+def get_single_phase_zfactors_arr(mixrule,
+                                  feed: np.ndarray,
+                                  P,
+                                  exists: np.ndarray,
+                                  zfactors: np.ndarray):
+    ### Z-factors (..., 3) with absent phases set to NaN; where one phase is left it has the feed composition,
+    ### so its z-factor is recomputed for the feed (vapor root for vapor, liquid root otherwise) instead of
+    ### the one of the last trial composition
+    single = exists.sum(axis=-1) == 1
+    zfactors = np.where(exists, zfactors, np.nan)
+    if single.any():
+        aj, bj, Aj, Bj, aij_x = mixrule.get_phasedepvar(feed[..., None, :], P)
+        z_feed, valid = get_zfactor_arr(Aj[..., 0], Bj[..., 0], exists[..., 0])
+        zfactors = np.where(single[..., None] & exists, z_feed[..., None], zfactors)
+    return zfactors
+
+
+def get_initial_Kvalues_multiphase_arr(compset: ComponentSet,
+                                       P,
+                                       T):  ### Pressure and Temperature in field units
+    ### K-values (y / x) of the hydrocarbon liquid and aqueous phases against vapor, stacked along the second-to-last axis
+    ### Wilson K's start from a water-free hydrocarbon liquid and an aqueous phase of almost pure water
+    K = get_initial_Kvalues_arr(compset, P, T)
+    K = np.stack(np.broadcast_arrays(K, K), axis=-2).copy()
+    water = np.arange(len(compset)) == compset.water_index
+    K[..., 0, :] = np.where(water, K[..., 0, :] * 10 ** 4, K[..., 0, :])
+    K[..., 1, :] = np.where(water, K[..., 1, :], K[..., 1, :] * 10 ** 4)
+    return K
+
+
+@instr.profiled('rachford-rice')
+def solve_multiphase_rachford_rice_arr(z: np.ndarray,
+                                       K: np.ndarray,
+                                       max_iter: int = 50):
+    ### Vapor / hydrocarbon liquid / aqueous material balance for K-values of both liquids against vapor (..., 2, n)
+    ### Michelsen's convex formulation: minimize sum(beta) - sum(z_i * ln(E_i)), E_i = beta_V + beta_L / KL_i + beta_Q / KQ_i
+    ### over beta >= 0 by Newton steps with an active set, so phases vanish and reappear without any stage bookkeeping
+    ### Leading axes are conditions
+    ### Returns compositions (..., 3, n) normalized per phase (trial compositions for absent phases),
+    ### phase fractions (..., 3), iteration count and convergence flags
+    theta = np.concatenate((np.ones(K.shape[:-2] + (1,) + K.shape[-1:]), 1 / K), axis=-2)
+    present = z > 0
+    beta = np.full(K.shape[:-2] + (3,), 1 / 3)
+    eye = np.eye(3)
+    converged = np.zeros(K.shape[:-2], dtype=bool)
+
+    def get_objective(beta):
+        E = np.einsum('...jn,...j->...n', theta, beta)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return beta.sum(axis=-1) - np.sum(np.where(present, z * np.log(E), 0), axis=-1), E
+
+    objective, E = get_objective(beta)
+    for i in range(max_iter):
+        t = np.where(present, z / E, 0)
+        gradient = 1 - np.einsum('...jn,...n->...j', theta, t)
+        hessian = np.einsum('...jn,...kn,...n->...jk', theta, theta, t / E)
+        ### Phases at the bound stay there unless the gradient pulls them in
+        free = (beta > 0) | (gradient < 0)
+        converged = np.max(np.where(free, abs(gradient), 0), axis=-1) < 10 ** -12
+        if converged.all():
+            break
+        hessian = np.where(free[..., :, None] & free[..., None, :], hessian, eye)
+        ### Identical liquid phases (or a liquid equal to vapor) make the hessian singular
+        hessian = hessian + eye * 10 ** -12 * np.trace(hessian, axis1=-2, axis2=-1)[..., None, None]
+        delta = -np.linalg.solve(hessian, np.where(free, gradient, 0)[..., None])[..., 0]
+        ### Step is cut where a phase fraction reaches zero, phases already at the bound are projected back onto it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where((delta < 0) & (beta > 0), -beta / delta, np.inf)
+        alpha = np.minimum(1, ratio.min(axis=-1))[..., None]
+        ### Step halving wherever the objective does not decrease
+        for j in range(20):
+            beta_new = np.where(ratio <= alpha, 0, np.maximum(beta + alpha * delta, 0))
+            objective_new, E_new = get_objective(beta_new)
+            increased = ~(objective_new <= objective + 10 ** -14 * abs(objective))
+            if not increased.any():
+                break
+            alpha = np.where(increased[..., None], alpha / 2, alpha)
+        beta = np.where(converged[..., None], beta, beta_new)
+        objective = np.where(converged, objective, objective_new)
+        E = np.where(converged[..., None], E, E_new)
+    X = np.where(present, z / E, 0)[..., None, :] * theta
+    X = X / X.sum(axis=-1, keepdims=True)
+    return X, beta, i + 1, converged
+
+
+def get_single_phase_arr(mixrule,
+                         z: np.ndarray,
+                         P,
+                         water_index,
+                         K: np.ndarray = None):
+    ### Phase index (0 - vapor, 1 - liquid, 2 - aqueous) of a single-phase feed, one rule for the flash and for the
+    ### stability test; leading axes are conditions
+    ### K - vapor-liquid K-values off the trivial solution (a negative flash, or the stationary point of a stable feed)
+    ### name the phase by the side of the two-phase region: liquid fraction >= 1 - liquid, <= 0 - vapor
+    ### Without them, or at K = 1, vapor by the molar volume criterion of is_vapor_like at the lowest Gibbs energy root
+    ### of the feed; liquid is aqueous when water is the main component
+    lnphi, zj, root_vapor = get_lnphi_min_gibbs_arr(mixrule, z[..., None, :], P)
+    vapor = is_vapor_like(mixrule, z, P, zj[..., 0])
+    if K is not None:
+        x, y, L = get_equilibrium_composition_arr(z, K)
+        off_trivial = ~(abs(K - 1) < 10 ** -3).all(axis=-1)
+        vapor = np.where(off_trivial & (L <= 0), True, np.where(off_trivial & (L >= 1), False, vapor))
+    aqueous = z[..., water_index] > 0.5 if water_index is not None else np.zeros_like(vapor)
+    return np.where(vapor, 0, np.where(aqueous, 2, 1))
+
+
+def arrange_multiphase_arr(mixrule,
+                           z: np.ndarray,
+                           P,
+                           K: np.ndarray,
+                           X: np.ndarray,
+                           beta: np.ndarray,
+                           zfactors: np.ndarray,
+                           water_index: int):
+    ### Phase identification of a converged three-phase flash, leading axes are conditions
+    ### Liquids that collapsed onto vapor or onto each other are merged, water-richer liquid is reported as aqueous,
+    ### absent phases get NaN compositions and z-factors, a single remaining phase gets the feed composition
+    ### Returns compositions (..., 3, n), phase fractions (..., 3) as V/L/Q and z-factors (..., 3)
+    present = z > 0
+    X, beta, zfactors = X.copy(), beta.copy(), zfactors.copy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lnK = np.where(present[..., None, :], np.log(K), 0)
+    same_LV = np.max(abs(lnK[..., 0, :]), axis=-1) < 10 ** -3
+    same_QV = np.max(abs(lnK[..., 1, :]), axis=-1) < 10 ** -3
+    same_LQ = np.max(abs(lnK[..., 0, :] - lnK[..., 1, :]), axis=-1) < 10 ** -3
+    trivial = same_LV & same_QV
+    beta[..., 0] += np.where(same_LV, beta[..., 1], 0) + np.where(same_QV, beta[..., 2], 0)
+    beta[..., 1] = np.where(same_LV, 0, beta[..., 1])
+    beta[..., 2] = np.where(same_QV, 0, beta[..., 2])
+    ### Water-richer liquid is the aqueous phase
+    swap = X[..., 1, water_index] > X[..., 2, water_index]
+    X[..., 1:, :] = np.where(swap[..., None, None], X[..., :0:-1, :], X[..., 1:, :])
+    beta[..., 1:] = np.where(swap[..., None], beta[..., :0:-1], beta[..., 1:])
+    zfactors[..., 1:] = np.where(swap[..., None], zfactors[..., :0:-1], zfactors[..., 1:])
+    ### Two liquids of the same composition are one liquid, named by its water content
+    merged = same_LQ & ~same_LV & ~same_QV
+    to_aqueous = merged & (X[..., 2, water_index] > 0.5)
+    liquids = beta[..., 1] + beta[..., 2]
+    beta[..., 1] = np.where(merged, np.where(to_aqueous, 0, liquids), beta[..., 1])
+    beta[..., 2] = np.where(merged, np.where(to_aqueous, liquids, 0), beta[..., 2])
+    ### No split at all - single phase named by volume and water content
+    single_phase = get_single_phase_arr(mixrule, z, P, water_index)
+    beta = np.where(trivial[..., None], np.arange(3) == single_phase[..., None], beta)
+    zfactors = np.where(trivial[..., None] & (single_phase[..., None] == 0), zfactors[..., :1], zfactors)
+    exists = beta > 0
+    single = (exists.sum(axis=-1) == 1)[..., None, None]
+    equicomp = np.where(exists[..., None], np.where(single, z[..., None, :], X), np.nan)
+    phase_fractions = beta / beta.sum(axis=-1, keepdims=True)
+    zfactors = get_single_phase_zfactors_arr(mixrule, z, P, exists, zfactors)
+    return equicomp, phase_fractions, zfactors
+
+
+def get_mixing_matrix(compset: ComponentSet,
+                      ai: np.ndarray):
+    ### (1 - kij) * sqrt(ai * aj) used by the van der Waals mixing rules
+    sqrt_a = np.sqrt(ai)
+    return sqrt_a[..., :, None] * sqrt_a[..., None, :] * (1 - compset.kij)
+
+
+class MixingRule:
+    ### Van der Waals mixing rules of a component set at fixed temperature(s)
+    ### ai, bi and the dense (1 - kij) * sqrt(ai * aj) matrix are built once and reused by every iteration,
+    ### so aj is a quadratic form and Aij' a matrix-vector product
+    ### T may be an array of conditions, then ai and aij get the same leading axes
+    ### cached = False bypasses compdepvar_cache, for temperatures that are not met again (iterations on T)
+    @instr.profiled('mixing rules')
+    def __init__(self,
+                 compset: ComponentSet,
+                 T,
+                 cached: bool = True):
+        self.T = np.asarray(T, dtype=float)
+        if cached:
+            self.ai, self.bi = get_compdepvar_arr(compset, self.T)
+        else:
+            self.ai, self.bi, kappa, alfa = get_eos_params_arr(compset, self.T[..., None])
+        self.aij = get_mixing_matrix(compset, self.ai)
+        self.compset = compset
+
+    def take(self, rows):
+        ### Mixing rules of a subset of conditions
+        subset = object.__new__(MixingRule)
+        subset.compset = self.compset
+        subset.T = self.T[rows]
+        subset.ai = self.ai[rows]
+        subset.bi = self.bi
+        subset.aij = self.aij[rows]
+        return subset
+
+    @instr.profiled('mixing rules')
+    def get_phasedepvar(self,
+                        X: np.ndarray,
+                        P):
+        ### X - phase compositions with phases along the second-to-last axis
+        P = np.asarray(P, dtype=float)[..., None]
+        return get_phasedepvar_arr(X, self.bi, self.aij, P, self.T[..., None])
+
+    @instr.profiled('mixing rules')
+    def get_phasecompdepvar(self,
+                            aj: np.ndarray,
+                            bj: np.ndarray,
+                            aij_x: np.ndarray):
+        return get_phasecompdepvar_arr(aj, bj, self.bi, aij_x)
+
+    def get_daij_dT(self):
+        ### Temperature derivative of the aij matrix: aij * (d ln(ai) / dT + d ln(aj) / dT) / 2
+        dlnai_dT = get_dlnalpha_dT_arr(self.compset, self.T[..., None])
+        return self.aij * (dlnai_dT[..., :, None] + dlnai_dT[..., None, :]) / 2
+
+
+def get_phasedepvar_arr(X: np.ndarray,
+                        bi: np.ndarray,
+                        aij: np.ndarray,
+                        P,
+                        T):
+    ### X - phase compositions with phases along the second-to-last axis
+    ### P and T must broadcast against the phase axis
+    ### Returns mixture aj, bj and dimensionless Aj, Bj per phase, plus aij.x sums used for Aij'
+    if kern.enabled and X.ndim >= 2 and (aij.ndim == 2 or aij.shape[:-2] == X.shape[:-2]):
+        n = X.shape[-1]
+        aij_x, aj, bj = kern.phasedepvar_kernel(np.ascontiguousarray(X, dtype=float).reshape(-1, X.shape[-2], n),
+                                                np.ascontiguousarray(bi, dtype=float),
+                                                np.ascontiguousarray(aij, dtype=float).reshape(-1, n, n))
+        aij_x = aij_x.reshape(X.shape)
+        aj = aj.reshape(X.shape[:-1])
+        bj = bj.reshape(X.shape[:-1])
+    else:
+        aij_x = np.einsum('...ij,...pj->...pi', aij, X)
+        aj = np.einsum('...pi,...pi->...p', X, aij_x)
+        bj = X @ bi
+    Aj = aj * P / R_field ** 2 / T ** 2
+    Bj = bj * P / R_field / T
+    return aj, bj, Aj, Bj, aij_x
+
+
+def get_phasecompdepvar_arr(aj: np.ndarray,
+                            bj: np.ndarray,
+                            bi: np.ndarray,
+                            aij_x: np.ndarray):
+    ### Aij' and Bij' with phases along the second-to-last axis
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Aijprime = 2 * aij_x / aj[..., None]
+        Bijprime = bi / bj[..., None]
+    return Aijprime, Bijprime
+
+
+@instr.profiled('cubic')
+def get_zfactor_arr(Aj: np.ndarray,
+                    Bj: np.ndarray,
+                    vapor: np.ndarray,
+                    full_output: bool = False):
+    ### Closed-form solution of the Peng-Robinson cubic for arrays of (A, B)
+    ### z^3 + a2*z^2 + a1*z + a0 = 0, one real root via Cardano, three real roots via the trigonometric form
+    ### vapor - True where the vapor root (largest) is wanted, False for the liquid root (smallest)
+    ### Returns selected z-factors and a mask that is False where no root above B exists (z-factor is NaN there)
+    ### full_output - also a mask of degenerate cubics: discriminant within CUBIC_DEGENERATE_TOL of zero (relative to
+    ### q^3 and r^2), i.e. a repeated root; it is solved as exactly repeated, so the vapor and liquid roots coincide
+    ### there or are as close as the cubic allows, and phase identification by root choice is ambiguous
+    Aj, Bj, vapor = np.broadcast_arrays(np.asarray(Aj, dtype=float), np.asarray(Bj, dtype=float), vapor)
+    instr.profiler.count('cubic roots', Aj.size)
+    if kern.enabled:
+        zj, valid, degenerate = kern.zfactor_kernel(Aj.ravel(), Bj.ravel(), np.asarray(vapor, dtype=bool).ravel(),
+                                                    CUBIC_DEGENERATE_TOL)
+        zj, valid, degenerate = zj.reshape(Aj.shape), valid.reshape(Aj.shape), degenerate.reshape(Aj.shape)
+    else:
+        a2 = -(1 - Bj)
+        a1 = Aj - 2 * Bj - 3 * Bj ** 2
+        a0 = -(Aj * Bj - Bj ** 2 - Bj ** 3)
+        q = 1 / 3 * a1 - 1 / 9 * a2 ** 2
+        r = 1 / 6 * (a1 * a2 - 3 * a0) - 1 / 27 * a2 ** 3
+        D = q ** 3 + r ** 2
+        degenerate = np.abs(D) <= CUBIC_DEGENERATE_TOL * (np.abs(q) ** 3 + r ** 2)
+        one_root = (D > 0) & ~degenerate
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ### D > 0 - one real root and a pair of complex conjugate roots
+            sqrt_D = np.sqrt(np.where(one_root, D, 0))
+            z_single = np.cbrt(r + sqrt_D) + np.cbrt(r - sqrt_D) - a2 / 3
+            ### D <= 0 - all roots are real (at least two equal for D = 0)
+            minus_q = np.where(one_root, 0, -q)
+            cos_arg = np.where(minus_q > 0, r / np.sqrt(minus_q ** 3), 0)
+            theta = np.arccos(np.clip(cos_arg, -1, 1))[..., None] / 3 + np.array([0, 2, 4]) * math.pi / 3
+            roots = 2 * np.sqrt(minus_q)[..., None] * np.cos(theta) - (a2 / 3)[..., None]
+            roots = np.where(one_root[..., None], z_single[..., None], roots)
+            valid_roots = roots > Bj[..., None]
+        z_max = np.where(valid_roots, roots, -np.inf).max(axis=-1)
+        z_min = np.where(valid_roots, roots, np.inf).min(axis=-1)
+        valid = valid_roots.any(axis=-1)
+        zj = np.where(valid, np.where(vapor, z_max, z_min), np.nan)
+    if instr.profiler.enabled:
+        instr.profiler.count('degenerate cubic roots', int(np.count_nonzero(degenerate)))
+    if full_output:
+        return zj, valid, degenerate
+    return zj, valid
+
+
+@instr.profiled('fugacity')
+def get_fugacities_arr(Aj: np.ndarray,
+                       Bj: np.ndarray,
+                       Aijprime: np.ndarray,
+                       Bijprime: np.ndarray,
+                       zj: np.ndarray):
+    ### Fugacity coefficients with phases along the second-to-last axis, NaN where the expression is undefined
+    if kern.enabled:
+        Aj, Bj, zj = (np.asarray(value, dtype=float) for value in (Aj, Bj, zj))
+        shape = np.broadcast_shapes(np.shape(Aijprime), np.shape(Bijprime), Aj.shape + (1,), Bj.shape + (1,),
+                                    zj.shape + (1,))
+        phases = shape[:-1]
+        fugacit = kern.fugacities_kernel(np.broadcast_to(Aj, phases).ravel(),
+                                         np.broadcast_to(Bj, phases).ravel(),
+                                         np.broadcast_to(Aijprime, shape).reshape(-1, shape[-1]),
+                                         np.broadcast_to(Bijprime, shape).reshape(-1, shape[-1]),
+                                         np.broadcast_to(zj, phases).ravel())
+        return fugacit.reshape(shape)
+    Aj = Aj[..., None]
+    Bj = Bj[..., None]
+    zj = zj[..., None]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        lnphi = -np.log(zj - Bj) + (zj - 1) * Bijprime \
+                - Aj / (2 * math.sqrt(2) * Bj) * (Aijprime - Bijprime) \
+                * np.log((zj + (math.sqrt(2) + 1) * Bj) / (zj - (math.sqrt(2) - 1) * Bj))
+        return np.exp(lnphi)
+
+
+@instr.profiled('fugacity derivatives')
+def get_lnphi_derivatives_arr(mixrule: MixingRule,
+                              X: np.ndarray,
+                              P,
+                              vapor=(True, False),
+                              derivatives: tuple = ('n', 'T', 'P')):
+    ### ln(phi) and its analytic derivatives with respect to mole numbers, temperature and pressure,
+    ### phases along the second-to-last axis; P is a scalar or an array over the conditions of mixrule
+    ### vapor - root selection per phase, default is (vapor, liquid) as in get_Kvalues_arr
+    ### Derivatives are taken at one mole of each phase: d ln(phi_i) / d n_j of a phase with N moles is dlnphi_dn / N
+    ### Returns lnphi (..., phases, components), dlnphi_dn (..., phases, components, components),
+    ### dlnphi_dT and dlnphi_dP (..., phases, components) and z-factors; derivatives not asked for are None
+    aj, bj, Aj, Bj, aij_x = mixrule.get_phasedepvar(X, P)
+    Aijprime, Bijprime = mixrule.get_phasecompdepvar(aj, bj, aij_x)
+    zj, zj_valid = get_zfactor_arr(Aj, Bj, np.asarray(vapor))
+    Z = zj[..., None]
+    A = Aj[..., None]
+    B = Bj[..., None]
+    sqrt2 = math.sqrt(2)
+    dlnphi_dn = dlnphi_dT = dlnphi_dP = None
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        Lg = np.log((Z + (1 + sqrt2) * B) / (Z + (1 - sqrt2) * B))
+        C = A / (2 * sqrt2 * B)
+        D = Aijprime - Bijprime
+        lnphi = (Z - 1) * Bijprime - np.log(Z - B) - C * D * Lg
+        ### Implicit derivatives of the cubic root and of the log term through A, B and Z
+        f_Z = 3 * Z ** 2 - 2 * (1 - B) * Z + (A - 3 * B ** 2 - 2 * B)
+        f_A = Z - B
+        f_B = Z ** 2 - (6 * B + 2) * Z - (A - 2 * B - 3 * B ** 2)
+        Lg_Z = 1 / (Z + (1 + sqrt2) * B) - 1 / (Z + (1 - sqrt2) * B)
+        Lg_B = (1 + sqrt2) / (Z + (1 + sqrt2) * B) - (1 - sqrt2) / (Z + (1 - sqrt2) * B)
+        if 'n' in derivatives:
+            ### Derivatives with respect to unnormalized compositions x_k
+            A_k = A * Aijprime
+            B_k = B * Bijprime
+            Z_k = -(f_A * A_k + f_B * B_k) / f_Z
+            Lg_k = Lg_Z * Z_k + Lg_B * B_k
+            C_k = (A_k / B - A * B_k / B ** 2) / (2 * sqrt2)
+            D_ik = 2 * mixrule.aij[..., None, :, :] / aj[..., None, None] \
+                   - Aijprime[..., :, None] * Aijprime[..., None, :] + Bijprime[..., :, None] * Bijprime[..., None, :]
+            dlnphi_dx = -Bijprime[..., :, None] * Bijprime[..., None, :] * (Z[..., None] - 1) \
+                        + Bijprime[..., :, None] * Z_k[..., None, :] \
+                        - ((Z_k - B_k) / (Z - B))[..., None, :] \
+                        - C_k[..., None, :] * D[..., :, None] * Lg[..., None] \
+                        - C[..., None] * D_ik * Lg[..., None] \
+                        - C[..., None] * D[..., :, None] * Lg_k[..., None, :]
+            ### ln(phi) is homogeneous of degree zero in mole numbers
+            dlnphi_dn = dlnphi_dx - np.einsum('...ik,...k->...i', dlnphi_dx, X)[..., None]
+        if 'P' in derivatives:
+            ### A and B are proportional to P, A / B and Aij', Bij' do not depend on it
+            P_arr = np.asarray(P, dtype=float)[..., None, None]
+            A_P = A / P_arr
+            B_P = B / P_arr
+            Z_P = -(f_A * A_P + f_B * B_P) / f_Z
+            Lg_P = Lg_Z * Z_P + Lg_B * B_P
+            dlnphi_dP = Bijprime * Z_P - (Z_P - B_P) / (Z - B) - C * D * Lg_P
+        if 'T' in derivatives:
+            ### aij depends on T through alpha; A ~ a / T^2, B ~ 1 / T, Bij' does not depend on T
+            T_arr = mixrule.T[..., None, None]
+            daij_dT = mixrule.get_daij_dT()
+            daij_x = np.einsum('...ij,...pj->...pi', daij_dT, X)
+            daj_dT = np.einsum('...pi,...pi->...p', X, daij_x)[..., None]
+            A_T = A * (daj_dT / aj[..., None] - 2 / T_arr)
+            B_T = -B / T_arr
+            Z_T = -(f_A * A_T + f_B * B_T) / f_Z
+            Lg_T = Lg_Z * Z_T + Lg_B * B_T
+            C_T = (A_T / B - A * B_T / B ** 2) / (2 * sqrt2)
+            D_T = 2 * daij_x / aj[..., None] - Aijprime * daj_dT / aj[..., None]
+            dlnphi_dT = Bijprime * Z_T - (Z_T - B_T) / (Z - B) - C_T * D * Lg - C * D_T * Lg - C * D * Lg_T
+    return lnphi, dlnphi_dn, dlnphi_dT, dlnphi_dP, zj
+
+
+def get_lnphi_dn_arr(mixrule: MixingRule,
+                     X: np.ndarray,
+                     P,
+                     vapor=(True, False)):
+    ### ln(phi), its derivatives with respect to mole numbers and z-factors from get_lnphi_derivatives_arr
+    lnphi, dlnphi_dn, dlnphi_dT, dlnphi_dP, zj = get_lnphi_derivatives_arr(mixrule, X, P, vapor, ('n',))
+    return lnphi, dlnphi_dn, zj
+
+
+@instr.profiled('K-update')
+def get_Kvalues_arr(mixrule: MixingRule,
+                    z: np.ndarray,
+                    K: np.ndarray,
+                    P):
+    ### One successive substitution step: returns updated K-values and z-factors (vapor, liquid)
+    ### Leading axes of z and K are conditions, matching the temperatures of mixrule; P is a scalar or an array over them
+    x, y, L = get_equilibrium_composition_arr(z, K)
+    X = np.stack((y, x), axis=-2)  # vapor, liquid
+    aj, bj, Aj, Bj, aij_x = mixrule.get_phasedepvar(X, P)
+    Aijprime, Bijprime = mixrule.get_phasecompdepvar(aj, bj, aij_x)
+    zj, zj_valid = get_zfactor_arr(Aj, Bj, np.array([True, False]))
+    fugacit = get_fugacities_arr(Aj, Bj, Aijprime, Bijprime, zj)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return fugacit[..., 1, :] / fugacit[..., 0, :], zj
+
+
+@instr.profiled('K-update')
+def get_Kvalues_multiphase_arr(mixrule: MixingRule,
+                               z: np.ndarray,
+                               K: np.ndarray,
+                               P):
+    ### One successive substitution step of the three-phase flash, both liquids updated together:
+    ### K (..., 2, n) of hydrocarbon liquid and aqueous phases against vapor; returns updated K's and z-factors (..., 3)
+    X, beta, iterations, converged = solve_multiphase_rachford_rice_arr(z, K)
+    aj, bj, Aj, Bj, aij_x = mixrule.get_phasedepvar(X, P)
+    Aijprime, Bijprime = mixrule.get_phasecompdepvar(aj, bj, aij_x)
+    zj, zj_valid = get_zfactor_arr(Aj, Bj, np.array([True, False, False]))
+    fugacit = get_fugacities_arr(Aj, Bj, Aijprime, Bijprime, zj)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return fugacit[..., 1:, :] / fugacit[..., :1, :], zj
+
+
+@instr.profiled('K-update')
+def get_Kvalues_newton_arr(mixrule: MixingRule,
+                           z: np.ndarray,
+                           K: np.ndarray,
+                           P: float):
+    ### One Newton step on the vapor-liquid fugacity equations ln(f_i^V) - ln(f_i^L) = 0 in vapor mole numbers,
+    ### with the analytic Jacobian from get_lnphi_dn_arr; single condition only
+    ### Returns updated K-values and z-factors, or None where the state is not two-phase (0 < V < 1)
+    x, y, L = get_equilibrium_composition_arr(z, K)
+    beta = 1 - L
+    if not 0 < beta < 1:
+        return None
+    lnphi, dlnphi_dn, zj = get_lnphi_dn_arr(mixrule, np.stack((y, x)), P)
+    lnK_new = lnphi[1] - lnphi[0]  # successive substitution value, kept for absent components
+    present = z > 0
+    y_p, x_p = y[present], x[present]
+    g = np.log(K[present]) - lnK_new[present]
+    J = (np.diag(1 / y_p) - 1 + dlnphi_dn[0][np.ix_(present, present)]) / beta \
+        + (np.diag(1 / x_p) - 1 + dlnphi_dn[1][np.ix_(present, present)]) / (1 - beta)
+    try:
+        dv = np.linalg.solve(J, -g)
+    except np.linalg.LinAlgError:
+        return None
+    v = beta * y_p
+    l = (1 - beta) * x_p
+    for i in range(30):
+        ### Step halving keeps both phases' mole numbers positive
+        if (v + dv > 0).all() and (l - dv > 0).all():
+            break
+        dv = dv / 2
+    else:
+        return None
+    v = v + dv
+    l = l - dv
+    lnK_new[present] = np.log(v / v.sum()) - np.log(l / l.sum())
+    if not np.isfinite(lnK_new).all():
+        return None
+    return np.exp(lnK_new), zj
+
+
+def get_lnphi_min_gibbs_arr(mixrule: MixingRule,
+                            X: np.ndarray,
+                            P):
+    ### ln(phi) of compositions X (phases along the second-to-last axis) taking the cubic root with the lowest Gibbs energy
+    ### Returns lnphi, z-factors and the root selection (True where the vapor root is taken)
+    X2 = np.concatenate((X, X), axis=-2)
+    phases = X.shape[-2]
+    aj, bj, Aj, Bj, aij_x = mixrule.get_phasedepvar(X2, P)
+    Aijprime, Bijprime = mixrule.get_phasecompdepvar(aj, bj, aij_x)
+    zj, zj_valid = get_zfactor_arr(Aj, Bj, np.repeat([True, False], phases))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lnphi = np.log(get_fugacities_arr(Aj, Bj, Aijprime, Bijprime, zj))
+        gibbs = np.nansum(X2 * lnphi, axis=-1)
+    use_liquid = (gibbs[..., phases:] < gibbs[..., :phases])
+    lnphi = np.where(use_liquid[..., None], lnphi[..., phases:, :], lnphi[..., :phases, :])
+    zj = np.where(use_liquid, zj[..., phases:], zj[..., :phases])
+    return lnphi, zj, ~use_liquid
+
+
+def is_vapor_like(mixrule: MixingRule,
+                  x: np.ndarray,
+                  P,
+                  zj):
+    ### Single-phase label from the molar volume to covolume ratio (vapor if V/b > 1.75, i.e. Z > 1.75 * B)
+    Bj = np.sum(x * mixrule.bi, axis=-1) * np.asarray(P, dtype=float) / R_field / mixrule.T
+    return zj > 1.75 * Bj
+
+
+@instr.profiled('stability')
+def stability_test_arr(compset: ComponentSet,
+                       mixrule: MixingRule,
+                       z: np.ndarray,
+                       P: float,
+                       max_iter: int = 100,
+                       tol: float = 1e-10):
+    ### Michelsen tangent plane distance stability analysis of feed z for a single condition
+    ### Vapor-like (W = z * K) and liquid-like (W = z / K) trial phases start from Wilson K-values and are solved
+    ### together by successive substitution on ln W: ln W_i = ln z_i + ln phi_i(z) - ln phi_i(w)
+    ### Feeds with water get a third, water-rich trial (W = 1 for water, z * 10^-4 for the rest), as Wilson K's
+    ### never lead to an aqueous phase
+    ### Returns stability flag, stationary-point K-values (a flash warm start for an unstable feed; for a stable one
+    ### the K's of the nearest non-trivial stationary point, for get_single_phase_arr, or None), modified tangent
+    ### plane distances of the trials and the feed z-factor
+    present = z > 0
+    lnphi_z, z_feed, vapor = get_lnphi_min_gibbs_arr(mixrule, z[None, :], P)
+    with np.errstate(divide='ignore'):
+        d = np.log(z) + lnphi_z[0]
+    K_wilson = get_initial_Kvalues_arr(compset, P, mixrule.T)
+    W = np.stack((z * K_wilson, z / K_wilson))
+    if compset.water_index is not None and z[compset.water_index] > 0:
+        water = np.arange(len(z)) == compset.water_index
+        W = np.concatenate((W, np.where(water, 1, z * 10 ** -4)[None, :]))
+    tm = np.zeros(len(W))
+    trivial = np.zeros(len(W), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for i in range(max_iter):
+            w = W / W.sum(axis=-1, keepdims=True)
+            lnphi_w, zj, vapor = get_lnphi_min_gibbs_arr(mixrule, w, P)
+            lnW = np.where(present, d - lnphi_w, -np.inf)
+            change = np.sum(np.where(present, lnW - np.log(W), 0) ** 2, axis=-1)
+            W = np.exp(lnW)
+            trivial = np.sum(np.where(present, lnW - np.log(z), 0) ** 2, axis=-1) < 1e-4
+            if ((change < tol) | trivial).all():
+                break
+        tm = 1 + np.sum(np.where(present, W * (np.log(W) + lnphi_w - d - 1), 0), axis=-1)
+    unstable = ~trivial & (tm < -1e-8)
+    if not unstable.any():
+        ### K's of the nearest non-trivial vapor-like (y = W) or liquid-like (x = W) stationary point name the phase
+        nontrivial = ~trivial[:2]
+        if not nontrivial.any():
+            return True, None, tm, float(z_feed[0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            K = W[0] / z if np.argmin(np.where(nontrivial, tm[:2], np.inf)) == 0 else z / W[1]
+        return True, np.where(present, K, 1), tm, float(z_feed[0])
+    ### Vapor-liquid K's from the vapor-like and liquid-like stationary points; the three-phase flash that follows
+    ### an unstable wet feed starts from its own initial K's
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if unstable[:2].all():
+            K = W[0] / W[1]
+        elif unstable[0]:
+            K = W[0] / z
+        elif unstable[1]:
+            K = z / W[1]
+        else:
+            K = K_wilson
+    K = np.where(present & np.isfinite(K), K, K_wilson)
+    return False, K, tm, float(z_feed[0])
+
+
+def get_Kvalues_error_arr(K: np.ndarray,
+                          K_new: np.ndarray,
+                          three_phase: bool):
+    ### RMS change of the K-values of a condition (trailing axes)
+    ### Three-phase K's span tens of decades (hydrocarbons over the aqueous phase), so their change is taken in ln K
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if three_phase:
+            return np.sqrt(np.mean((np.log(K) - np.log(K_new)) ** 2, axis=(-2, -1)))
+        return np.sqrt(np.mean((K - K_new) ** 2, axis=-1))
+
+
+def solve_Kvalues_arr(mixrule: MixingRule,
+                      z: np.ndarray,
+                      K: np.ndarray,
+                      P: float,
+                      convcrit,
+                      steps_limit,
+                      method: str = 'ss',
+                      show_log: bool = True):
+    ### K-value loop of a single condition: vapor-liquid K (n) or three-phase K (2, n) of get_Kvalues_multiphase_arr
+    ### method = 'ss' - plain successive substitution (STEPS 2-5 of flash_calc_PR_EOS)
+    ### method = 'accelerated' - successive substitution with dominant eigenvalue extrapolation of ln K
+    ### (GDEM, Mehra et al.) every few steps, switching to Newton with analytic fugacity derivatives
+    ### when the error ratio shows slow convergence (vapor-liquid only)
+    ### Returns K-values, z-factors (vapor, liquid[, aqueous]), iteration count, convergence flag and error history
+    three_phase = K.ndim == 2
+    get_Kvalues_func = get_Kvalues_multiphase_arr if three_phase else get_Kvalues_arr
+    accelerated = method == 'accelerated'
+    err_list = list()
+    calc_err = 10 ** 6
+    steps = 0
+    ss_steps = 0
+    newton = False
+    increment_prev = None
+    zfactors = np.full(3 if three_phase else 2, np.nan)
+    while calc_err >= convcrit:
+        steps += 1
+        update = get_Kvalues_newton_arr(mixrule, z, K, P) if newton else None
+        if update is None:
+            newton = False
+            K_new, zfactors = get_Kvalues_func(mixrule, z, K, P)
+            ss_steps += 1
+            if accelerated:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    increment = np.log(K_new) - np.log(K)
+                if increment_prev is not None and ss_steps % 5 == 0:
+                    eigenvalue = np.vdot(increment, increment) / np.vdot(increment_prev, increment)
+                    if 0 < eigenvalue < 1:
+                        K_new = K_new * np.exp(eigenvalue / (1 - eigenvalue) * increment)
+                        increment = None
+                increment_prev = increment
+        else:
+            K_new, zfactors = update
+        calc_err = float(get_Kvalues_error_arr(K, K_new, three_phase))
+        K = K_new
+        err_list.append(calc_err)
+        if show_log:
+            instr.logger.debug('K-values error at iteration: %.3e%s', calc_err, ' (Newton)' if update is not None else '')
+        if accelerated and not three_phase and not newton and len(err_list) >= 5 and 0.8 * err_list[-2] < err_list[-1] < 10 ** -2:
+            newton = True
+        if steps > steps_limit:
+            if show_log:
+                instr.logger.warning('K-values did not converge in %d iterations', steps_limit)
+            break
+    instr.profiler.count('K-value iterations', steps)
+    if instr.profiler.trace is not None:
+        instr.profiler.add_trace({'P [psi]': float(P),
+                                  'T [R]': float(mixrule.T),
+                                  'three_phase': three_phase,
+                                  'method': method,
+                                  'steps': steps,
+                                  'converged': calc_err < convcrit,
+                                  'err_list': err_list})
+    return K, zfactors, steps, calc_err < convcrit, err_list
+
+
+class KValueCache:
+    ### Bounded LRU store of converged ln K by feed (component set identity, composition, vapor-liquid or three-phase)
+    ### and conditions, for warm starts of the K-value loop instead of the Wilson estimate
+    ### lookup takes the nearest stored condition of the same feed, distance in (ln P, ln T); with extrapolate the line
+    ### through the two nearest points is followed to the requested condition (at most one spacing further),
+    ### so sequential sweeps start next to the solution. Nothing is returned beyond max_distance
+    def __init__(self,
+                 maxsize: int = 4096,
+                 max_distance: float = 0.25,
+                 extrapolate: bool = True):
+        self.maxsize = maxsize
+        self.max_distance = max_distance
+        self.extrapolate = extrapolate
+        self.hits = 0
+        self.misses = 0
+        self._feeds = dict()  # feed key: {(ln P, ln T): ln K}
+        self._order = OrderedDict()  # (feed key, (ln P, ln T)) in LRU order
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._order)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._order), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._feeds.clear()
+            self._order.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @staticmethod
+    def get_feed_key(compset: ComponentSet,
+                     z: np.ndarray,
+                     three_phase: bool):
+        # Composition is rounded, so renormalized copies of the same feed share the key
+        return compset.key, np.round(np.asarray(z, dtype=float), 10).tobytes(), three_phase
+
+    def store(self,
+              compset: ComponentSet,
+              z: np.ndarray,
+              P: float,
+              T: float,
+              K: np.ndarray,
+              three_phase: bool):
+        feed_key = self.get_feed_key(compset, z, three_phase)
+        point = (math.log(P), math.log(T))
+        lnK = np.log(K)
+        lnK.flags.writeable = False
+        with self._lock:
+            self._feeds.setdefault(feed_key, dict())[point] = lnK
+            self._order[(feed_key, point)] = None
+            self._order.move_to_end((feed_key, point))
+            while len(self._order) > self.maxsize:
+                (old_key, old_point), value = self._order.popitem(last=False)
+                points = self._feeds[old_key]
+                del points[old_point]
+                if not points:
+                    del self._feeds[old_key]
+
+    def lookup(self,
+               compset: ComponentSet,
+               z: np.ndarray,
+               P: float,
+               T: float,
+               three_phase: bool):
+        ### K-values for the warm start or None when no stored condition of the feed is close enough
+        feed_key = self.get_feed_key(compset, z, three_phase)
+        query = np.array([math.log(P), math.log(T)])
+        with self._lock:
+            points = self._feeds.get(feed_key)
+            if points:
+                coords = np.array(list(points))
+                distances = np.hypot(*(coords - query).T)
+                order = np.argsort(distances)[:2]
+            if not points or distances[order[0]] > self.max_distance:
+                self.misses += 1
+                return None
+            self.hits += 1
+            nearest = tuple(coords[order[0]])
+            self._order.move_to_end((feed_key, nearest))
+            lnK = points[nearest]
+            if self.extrapolate and len(order) == 2:
+                second = tuple(coords[order[1]])
+                step = coords[order[0]] - coords[order[1]]
+                t = np.clip(np.dot(query - coords[order[0]], step) / np.dot(step, step), -1, 1)
+                lnK = lnK + t * (lnK - points[second])
+        return np.exp(lnK)
+
+
+kvalue_cache = KValueCache()
+
+
+@instr.profiled('flash')
+def flash_PR_EOS_arr(compset: ComponentSet,
+                     z: np.ndarray,
+                     P_field: float,
+                     T_field: float,
+                     convcrit,
+                     steps_limit,
+                     method: str = 'ss',
+                     show_log: bool = True,
+                     stability_check: bool = False,
+                     warm_start: bool = False,
+                     full_output: bool = False):
+    ### Array-native flash: vapor-liquid for dry streams, simultaneous vapor / liquid / aqueous flash for streams with water
+    ### method - K-value solver of solve_Kvalues_arr ('ss' or 'accelerated')
+    ### stability_check - tangent plane stability test of the feed before the K-value loop: stable feeds are returned
+    ### as a single phase without iterating, unstable vapor-liquid feeds start from the stationary-point K's
+    ### warm_start - K-value loop starts from kvalue_cache when a nearby condition of the same feed is stored there;
+    ### converged results with two or more phases are stored
+    ### Returns compositions (vapor, liquid, aqueous along the first axis), phase fractions (V, L, Q),
+    ### z-factors (vapor, liquid, aqueous) and the number of K-value iterations
+    ### full_output - the final K-values (n) or (2, n) for three-phase feeds, NaN for a stable feed, and the
+    ### convergence flag are appended
+    n = len(compset)
+    equicomp = np.full((3, n), np.nan)
+    phase_fractions = np.full(3, np.nan)
+    zfactors = np.full(3, np.nan)
+    three_phase = compset.water_index is not None and z[compset.water_index] > 0
+    mixrule = MixingRule(compset, T_field)
+    ### STEP - 1: K's estimation
+    K_warm = kvalue_cache.lookup(compset, z, P_field, T_field, three_phase) if warm_start else None
+    if K_warm is not None:
+        K = K_warm
+    elif three_phase:
+        K = get_initial_Kvalues_multiphase_arr(compset, P_field, T_field)
+    else:
+        K = get_initial_Kvalues_arr(compset, P_field, T_field)
+    if stability_check:
+        stable, K_stationary, tm, z_feed = stability_test_arr(compset, mixrule, z, P_field)
+        if stable:
+            ### Single phase feed - no K-value iterations needed
+            phase = int(get_single_phase_arr(mixrule, z, P_field, compset.water_index, K_stationary))
+            equicomp[phase] = z
+            phase_fractions[:] = np.arange(3) == phase
+            zfactors[phase] = z_feed
+            if show_log:
+                instr.logger.info('Stable %s feed, flash skipped', ('vapor', 'liquid', 'aqueous')[phase])
+            if full_output:
+                return equicomp, phase_fractions, zfactors, 0, np.full(K.shape, np.nan), True
+            return equicomp, phase_fractions, zfactors, 0
+        if not three_phase and K_warm is None:
+            K = K_stationary
+    ### STEPS 2-5: compositions, fugacity coefficients and new K-values until convergence
+    K, zj, steps, converged, err_list = solve_Kvalues_arr(mixrule,
+                                                          z,
+                                                          K,
+                                                          P_field,
+                                                          convcrit,
+                                                          steps_limit,
+                                                          method,
+                                                          show_log)
+    if not converged:
+        instr.logger.warning('K-values not converged in %d iterations at %.2f psi, %.2f R', steps, P_field, T_field)
+    elif show_log:
+        instr.logger.info('Converged in %d iterations', steps)
+    if three_phase:
+        X, beta, rr_iterations, rr_converged = solve_multiphase_rachford_rice_arr(z, K)
+        equicomp, phase_fractions, zfactors = arrange_multiphase_arr(mixrule,
+                                                                     z,
+                                                                     P_field,
+                                                                     K,
+                                                                     X,
+                                                                     beta,
+                                                                     zj,
+                                                                     compset.water_index)
+    else:
+        x, y, L_final = get_equilibrium_composition_arr(z, K)
+        if not 0 < L_final < 1 or (abs(K - 1) < 10 ** -3).all():
+            ### Single phase, named by the same rule as a stable feed of the stability test
+            L_final = float(get_single_phase_arr(mixrule, z, P_field, None, K) == 1)
+        equicomp, phase_fractions = redefine_equicomp_arr(equicomp, phase_fractions, z, x, y, L_final)
+        phase_fractions, zfactors = arrange_two_phase_arr(mixrule, z, P_field, phase_fractions, zj)
+    if warm_start and converged and np.count_nonzero(phase_fractions > 0) >= 2:
+        kvalue_cache.store(compset, z, P_field, T_field, K, three_phase)
+    if full_output:
+        return equicomp, phase_fractions, zfactors, steps, K, bool(converged)
+    return equicomp, phase_fractions, zfactors, steps
+
+
+def solve_Kvalues_grid_arr(mixrule: MixingRule,
+                           Z: np.ndarray,
+                           K: np.ndarray,
+                           P: np.ndarray,
+                           convcrit,
+                           steps_limit):
+    ### Successive substitution K-value loop of solve_Kvalues_arr for many conditions at once
+    ### Z - feeds (conditions x components), P - one value per condition in field units,
+    ### K - vapor-liquid (conditions x components) or three-phase (conditions x 2 x components) K-values
+    ### Conditions leave the loop as soon as they converge, the rest keep iterating
+    m = len(Z)
+    three_phase = K.ndim == 3
+    get_Kvalues_func = get_Kvalues_multiphase_arr if three_phase else get_Kvalues_arr
+    zfactors = np.full((m, 3 if three_phase else 2), np.nan)
+    steps = np.zeros(m, dtype=int)
+    converged = np.zeros(m, dtype=bool)
+    active = np.arange(m)
+    while active.size:
+        steps[active] += 1
+        K_new, zj = get_Kvalues_func(mixrule.take(active), Z[active], K[active], P[active])
+        calc_err = get_Kvalues_error_arr(K[active], K_new, three_phase)
+        K[active] = K_new
+        zfactors[active] = zj
+        converged[active] = calc_err < convcrit
+        active = active[(calc_err >= convcrit) & (steps[active] <= steps_limit)]
+    return K, zfactors, steps, converged
+
+
+@instr.profiled('flash grid')
+def flash_grid_arr(compset: ComponentSet,
+                   z: np.ndarray,
+                   P: np.ndarray,
+                   T: np.ndarray,
+                   convcrit,
+                   steps_limit,
+                   full_output: bool = False):
+    ### Vectorized flash_PR_EOS_arr over a flat array of conditions
+    ### Returns compositions (conditions x [vapor, liquid, aqueous] x components), phase fractions (conditions x [V, L, Q]),
+    ### z-factors (conditions x [vapor, liquid, aqueous]), a convergence flag and the number of K-value iterations
+    ### full_output - the final K-values (conditions x components, or conditions x 2 x components for three-phase feeds)
+    ### are appended
+    m = len(P)
+    n = len(compset)
+    equicomp = np.full((m, 3, n), np.nan)
+    phase_fractions = np.full((m, 3), np.nan)
+    zfactors = np.full((m, 3), np.nan)
+    three_phase = compset.water_index is not None and z[compset.water_index] > 0
+    feed = np.broadcast_to(z, (m, n))
+    mixrule = MixingRule(compset, T)
+    if three_phase:
+        K = get_initial_Kvalues_multiphase_arr(compset, P[:, None], T[:, None])
+    else:
+        K = get_initial_Kvalues_arr(compset, P[:, None], T[:, None])
+    K, zj, iterations, converged = solve_Kvalues_grid_arr(mixrule, feed, K, P, convcrit, steps_limit)
+    if three_phase:
+        X, beta, rr_iterations, rr_converged = solve_multiphase_rachford_rice_arr(feed, K)
+        equicomp, phase_fractions, zfactors = arrange_multiphase_arr(mixrule,
+                                                                     feed,
+                                                                     P,
+                                                                     K,
+                                                                     X,
+                                                                     beta,
+                                                                     zj,
+                                                                     compset.water_index)
+    else:
+        x, y, L = get_equilibrium_composition_arr(feed, K)
+        single = np.flatnonzero((L <= 0) | (L >= 1) | (abs(K - 1) < 10 ** -3).all(axis=-1))
+        if single.size:
+            L[single] = get_single_phase_arr(mixrule.take(single), feed[single], P[single], None, K[single]) == 1
+        equicomp, phase_fractions = redefine_equicomp_arr(equicomp, phase_fractions, feed, x, y, L)
+        phase_fractions, zfactors = arrange_two_phase_arr(mixrule, feed, P, phase_fractions, zj)
+    if full_output:
+        return equicomp, phase_fractions, zfactors, converged, iterations, K
+    return equicomp, phase_fractions, zfactors, converged, iterations
 
 
-### All functions combined
 def flash_calc_PR_EOS(comppropDB: pd.DataFrame,
                       binarycoefDB: pd.DataFrame,
                       input_streamcomp: pd.DataFrame,
                       P_field: float,
                       T_field: float,
                       convcrit,
-                      steps_limit):
-    equicomp_df_sum = pd.DataFrame(columns=['vapor', 'liquid', 'aqueous'], index=input_streamcomp.index)
-    streamcomp = pd.DataFrame(columns=['Content [mol. fract.'], index=input_streamcomp.index)
-    phase_fractions = pd.Series([np.NaN, np.NaN, np.NaN], index=['V', 'L', 'Q'])
-    if input_streamcomp.loc['H2O']['Content [mol. fract.]'] == 0:
-        phases_num = 2
-    else:
-        phases_num = 3
-    for interphase in range(phases_num - 1):
-        if interphase == 0:
-            streamcomp = input_streamcomp
-        else:
-            streamcomp['Content [mol. fract.]'] = equicomp_df_sum['vapor']
-
-        ### STEP - 1: K's estimation using eq. (3-5) and (3-8)
-        Kvalues_init_df = get_initial_Kvalues(comppropDB,
-                                                   streamcomp,
-                                                   P_field,
-                                                   T_field)
-        err_list = list()
-        calc_err = 10 ** 6
-        steps = 0
-        while calc_err >= convcrit:
-            steps += 1
-            ### STEP - 2: Equlibrium compositions of phases calculation using K's from Step 1 (Methodology from GPSA)
-            ### Basic properties
-            compvar_df = get_compdepvar(comppropDB,
-                                             streamcomp,
-                                             T_field)
-            ### Equlibrium copositions
-            equicomp_df, L = get_equilibrium_composition_v1(streamcomp,
-                                                                 Kvalues_init_df,
-                                                                 True)
-            ### STEP 3: - Fugacity coefficients calculation
-            phasevar_df = get_phasedepvar(equicomp_df,
-                                               compvar_df,
-                                               binarycoefDB,
-                                               P_field,
-                                               T_field)
-            ### Phase-component dependent variables calculation
-            Aijprime_df, Bijprime_df = get_phasecompdepvar(phasevar_df,
-                                                                compvar_df,
-                                                                equicomp_df,
-                                                                binarycoefDB)
-            ### STEP 4: - Compressibility factors calculation
-            zfactors = pd.DataFrame(columns=['zj'], index=phasevar_df.index)
-            for phase in phasevar_df.index:
-                zfactors.loc[phase]['zj'] = get_zfactor(phasevar_df.loc[phase]['Aj'],
-                                                             phasevar_df.loc[phase]['Bj'],
-                                                             phase)
-            ### Fugacity coefficients factors calculation
-            fugacit_df = get_fugacities(streamcomp,
-                                             phasevar_df,
-                                             Aijprime_df,
-                                             Bijprime_df,
-                                             zfactors)
-            ### STEP 5: - New set of K-values calculation
-            Kvalues_df = get_Kvalues(fugacit_df)
-            calc_err = Kvalues_comparison(Kvalues_init_df, Kvalues_df)
-            err_list.append(calc_err)
-            Kvalues_init_df['Kign'] = Kvalues_df['Kign']
-            print('K-values error at iteration: {:.3e}'.format(calc_err))
-            if steps > steps_limit:
-                print('WARNING: K-values did not converged!')
-                break
-
-        equicomp_df_final, L_final = get_equilibrium_composition_v1(streamcomp,
-                                                                         Kvalues_init_df,
-                                                                         True)
-        if (abs(Kvalues_df['Kign'] - 1) < 10 ** -3).all():
-            equicomp_df_sum['vapor'] = streamcomp['Content [mol. fract.]']
-            phase_fractions['V'], phase_fractions['L'], phase_fractions['Q'] = 1, 0, 0
-            break
-        equicomp_df_sum, phase_fractions = redefine_equicomp(equicomp_df_final,
-                                                                  equicomp_df_sum,
-                                                                  phase_fractions,
-                                                                  L_final,
-                                                                  interphase,
-                                                                  phases_num)
-        if steps <= steps_limit:
-            print('Converged in {} iterations\n'.format(steps - 1))
+                      steps_limit,
+                      method: str = 'ss',
+                      stability_check: bool = False,
+                      warm_start: bool = False):
+    compset = ComponentSet(comppropDB, binarycoefDB, input_streamcomp.index)
+    z = input_streamcomp['Content [mol. fract.]'].to_numpy(dtype=float)
+    equicomp, phase_fractions, zfactors, iterations = flash_PR_EOS_arr(compset,
+                                                                       z,
+                                                                       P_field,
+                                                                       T_field,
+                                                                       convcrit,
+                                                                       steps_limit,
+                                                                       method,
+                                                                       stability_check=stability_check,
+                                                                       warm_start=warm_start)
+    equicomp_df_sum = pd.DataFrame(equicomp.T, columns=['vapor', 'liquid', 'aqueous'], index=input_streamcomp.index)
+    phase_fractions = pd.Series(phase_fractions, index=['V', 'L', 'Q'])
+    zfactors = pd.DataFrame({'zj': zfactors}, index=['vapor', 'liquid', 'aqueous'])
     return equicomp_df_sum, phase_fractions, zfactors
 
 
+def flash_grid(comppropDB: pd.DataFrame,
+               binarycoefDB: pd.DataFrame,
+               input_streamcomp: pd.DataFrame,
+               P_array,
+               T_array,
+               convcrit=10 ** -4,
+               steps_limit=50):
+    ### Flash of one stream over many pressure/temperature conditions (field units) in a single vectorized call
+    ### P_array and T_array are broadcast against each other, e.g. P[:, None] and T[None, :] for a full grid
+    ### Returns arrays shaped as the broadcast conditions:
+    ### compositions (..., 3, components) with vapor/liquid/aqueous phases, phase fractions (..., 3) as V/L/Q,
+    ### z-factors (..., 3) for vapor/liquid/aqueous, convergence flags (...) and K-value iteration counts (...)
+    P, T = np.broadcast_arrays(np.asarray(P_array, dtype=float), np.asarray(T_array, dtype=float))
+    shape = P.shape
+    compset = ComponentSet(comppropDB, binarycoefDB, input_streamcomp.index)
+    z = input_streamcomp['Content [mol. fract.]'].to_numpy(dtype=float)
+    equicomp, phase_fractions, zfactors, converged, iterations = flash_grid_arr(compset,
+                                                                                z,
+                                                                                P.ravel(),
+                                                                                T.ravel(),
+                                                                                convcrit,
+                                                                                steps_limit)
+    return (equicomp.reshape(shape + equicomp.shape[1:]),
+            phase_fractions.reshape(shape + (3,)),
+            zfactors.reshape(shape + (3,)),
+            converged.reshape(shape),
+            iterations.reshape(shape))
+
+
 def get_phase_molar_weigh(comppropDB: pd.DataFrame,
                           equicomp_df: pd.DataFrame,
                           phase: str):
@@ -491,13 +1423,9 @@ def get_liquid_phase_density(comppropDB: pd.DataFrame,
     auxvar2 = (equicomp_df[phase] * (comppropDB['Characteristic Volume [m3/kgmole]'] ** (1/3))).sum()
     auxvar3 = (equicomp_df[phase] * (comppropDB['Characteristic Volume [m3/kgmole]'] ** (2/3))).sum()
     Vasteriskmix = 0.25 * (auxvar1 + 3 * auxvar2 * auxvar3)
-    auxvar4 = 0
-    for component1 in equicomp_df.index:
-        Tc1 = UnitsConverter.Temperature.C_to_R(comppropDB.loc[component1]['Tcrit [C]'])
-        Tc2 = UnitsConverter.Temperature.C_to_R(comppropDB['Tcrit [C]'])
-        auxvar4 += (equicomp_df.loc[component1][phase] * equicomp_df['liquid'] * \
-                   np.sqrt(Tc1 * comppropDB.loc[component1]['Characteristic Volume [m3/kgmole]'] * \
-                           Tc2 * comppropDB['Characteristic Volume [m3/kgmole]'])).sum()
+    ### sum_i sum_j x_i x_j sqrt(Tc_i V_i Tc_j V_j) is the square of sum_i x_i sqrt(Tc_i V_i)
+    Tc = UnitsConverter.Temperature.C_to_R(comppropDB['Tcrit [C]'])
+    auxvar4 = (equicomp_df[phase] * np.sqrt(Tc * comppropDB['Characteristic Volume [m3/kgmole]'])).sum() ** 2
     Tcmix = auxvar4 / Vasteriskmix
     ### Main variables calculation
     Tr = T_field / Tcmix
@@ -506,10 +1434,10 @@ def get_liquid_phase_density(comppropDB: pd.DataFrame,
         if Tr < 0.95:
             V0R = 1 - 1.52816 * (1 - Tr) ** (1 / 3) + 1.43907 * (1 - Tr) ** (2 / 3) - 0.81446 * (1 - Tr) + 0.190454 * (1 - Tr) ** (4 / 3)
         else:
-            print('\tCostald density correlation ERROR! (Tr >= 0.95 for {} phase)'.format(phase))
+            instr.logger.warning('Costald density correlation error: Tr >= 0.95 for %s phase', phase)
             return np.NaN
     else:
-        print('\tCostald density correlation ERROR! (Tr >= 1.0 for {} phase)'.format(phase))
+        instr.logger.warning('Costald density correlation error: Tr >= 1.0 for %s phase', phase)
         return np.NaN
     ### Density calculation
     Vs = V0R * (1 - wSRKmix * VdeltaR) * Vasteriskmix  # [m3/kgmol]
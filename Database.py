@@ -0,0 +1,126 @@
+from __future__ import annotations
+import os
+import json
+import hashlib
+import numpy as np
+import Lazy as lazy
+pd = lazy.lazy_import('pandas')
+
+### Binary cache of the xlsx databases
+### Each spreadsheet is compiled once into a flat float64 matrix (.npy, memory-mappable and shared between
+### processes through the page cache) plus a JSON index with row/column names, text columns and source stamp.
+### Cache is rebuilt when the source mtime/size changes and its content hash differs from the compiled one.
+CACHE_DIRNAME = '.dbcache'
+
+
+def get_file_hash(path: str):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_cache_paths(xlsx_path: str,
+                    cache_dir: str = None):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(xlsx_path)), CACHE_DIRNAME)
+    basename = os.path.splitext(os.path.basename(xlsx_path))[0]
+    return os.path.join(cache_dir, basename + '.json'), os.path.join(cache_dir, basename + '.npy')
+
+
+def write_atomic(path: str,
+                 write_func):
+    ### Writing to a temporary file and renaming, so concurrent readers never see a partial file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as file:
+        write_func(file)
+    os.replace(tmp_path, path)
+
+
+def write_meta(meta_path: str,
+               meta: dict):
+    # Non-string cells of text columns (e.g. CAS numbers that Excel turned into dates) are kept as text
+    write_atomic(meta_path, lambda file: file.write(json.dumps(meta, default=str).encode('utf-8')))
+
+
+def compile_database(xlsx_path: str,
+                     index_col: str,
+                     meta_path: str,
+                     values_path: str):
+    stat = os.stat(xlsx_path)
+    df = pd.read_excel(xlsx_path, index_col=index_col)
+    numeric_columns = [column for column in df.columns if pd.api.types.is_numeric_dtype(df[column])]
+    text_columns = [column for column in df.columns if column not in numeric_columns]
+    meta = {'source': os.path.abspath(xlsx_path),
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': get_file_hash(xlsx_path),
+            'index_name': df.index.name,
+            'index': [str(name) for name in df.index],
+            'columns': [str(column) for column in df.columns],
+            'numeric_columns': [str(column) for column in numeric_columns],
+            'numeric_dtypes': [str(df[column].dtype) for column in numeric_columns],
+            'text_columns': {str(column): df[column].tolist() for column in text_columns}}
+    values = np.ascontiguousarray(df[numeric_columns].to_numpy(dtype=np.float64))
+    os.makedirs(os.path.dirname(values_path), exist_ok=True)
+    write_atomic(values_path, lambda file: np.save(file, values))
+    write_meta(meta_path, meta)
+    return meta
+
+
+def cache_is_valid(meta: dict,
+                   xlsx_path: str,
+                   meta_path: str,
+                   values_path: str):
+    if not os.path.exists(values_path):
+        return False
+    stat = os.stat(xlsx_path)
+    if meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size:
+        return True
+    ### Source was touched - compiled data is still good if the content did not change
+    if meta['size'] != stat.st_size or meta['sha256'] != get_file_hash(xlsx_path):
+        return False
+    meta['mtime_ns'] = stat.st_mtime_ns
+    write_meta(meta_path, meta)
+    return True
+
+
+def build_dataframe(meta: dict,
+                    values: np.ndarray):
+    index = pd.Index(meta['index'], name=meta['index_name'])
+    df = pd.DataFrame(values, index=index, columns=meta['numeric_columns'], copy=False)
+    for column, dtype in zip(meta['numeric_columns'], meta['numeric_dtypes']):
+        if dtype != 'float64':
+            df[column] = df[column].astype(dtype)
+    for column, data in meta['text_columns'].items():
+        df[column] = data
+    if list(df.columns) != meta['columns']:
+        df = df[meta['columns']]
+    return df
+
+
+def load_database(xlsx_path: str,
+                  index_col: str,
+                  cache_dir: str = None):
+    ### Returns the database DataFrame as pd.read_excel(xlsx_path, index_col=index_col) would,
+    ### with numeric data memory-mapped from the compiled cache
+    meta_path, values_path = get_cache_paths(xlsx_path, cache_dir)
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, 'rb') as file:
+            meta = json.loads(file.read().decode('utf-8'))
+    if meta is None or not cache_is_valid(meta, xlsx_path, meta_path, values_path):
+        meta = compile_database(xlsx_path, index_col, meta_path, values_path)
+    values = np.load(values_path, mmap_mode='r')
+    return build_dataframe(meta, values)
+
+
+def load_comppropDB(xlsx_path: str,
+                    cache_dir: str = None):
+    return load_database(xlsx_path, 'Name', cache_dir)
+
+
+def load_binarycoefDB(xlsx_path: str,
+                      cache_dir: str = None):
+    return load_database(xlsx_path, 'index_col', cache_dir)
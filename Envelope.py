@@ -0,0 +1,222 @@
+from __future__ import annotations
+import math
+import numpy as np
+import Lazy as lazy
+import Calculations_v4 as calc
+import Instrumentation as instr
+import Saturation as sat
+pd = lazy.lazy_import('pandas')
+
+### Phase envelope (vapor-liquid saturation curve) of a fixed composition by Newton continuation (Michelsen, 1980)
+### Unknowns X = (ln K_1 .. ln K_n, ln T, ln P), K_i = y_i / x_i, with n + 2 equations
+###     ln K_i + ln phi_i(y, T, P) - ln phi_i(x, T, P) = 0,    sum(y_i - x_i) = 0,    X_s - S = 0
+### where x = z / (1 - beta + beta * K) and y = K * x: beta = 1 keeps y at the feed (dew point of a vapor feed),
+### beta = 0 keeps x at the feed (bubble point of a liquid feed)
+### Each point is predicted from the previous one with the sensitivities dX/dS (same Jacobian as the Newton corrector)
+### and corrected by a few Newton steps; the specified variable s is the one changing fastest along the curve,
+### so the trace passes the cricondenbar, the cricondentherm and the critical point, where all ln K change sign
+### and the dew branch continues as the bubble branch. Step size grows while the corrector converges quickly.
+MAX_LNK_STEP = 0.5  # largest predicted change of ln K per point
+MAX_LNT_STEP = 0.05  # largest predicted change of ln T per point
+MAX_LNP_STEP = 0.25  # largest predicted change of ln P per point
+CRITICAL_GAP = 0.02  # a ln K specification never lands closer than this to zero (trivial solution)
+NEWTON_TOL = 10 ** -9
+RESIDUAL_TOL = 10 ** -12  # near the critical point the Jacobian is ill-conditioned and dX stalls above NEWTON_TOL
+NEWTON_MAX_ITER = 10  # corrector iterations before the step is halved
+MIN_STEP = 10 ** -6  # tracing stops when the step has to be cut below this
+
+
+def get_envelope_equations(compset: calc.ComponentSet,
+                           z: np.ndarray,
+                           X: np.ndarray,
+                           beta: float,
+                           spec: int,
+                           S: float):
+    ### Saturation equations of Saturation.py with the specification X[spec] = S appended: F (n + 2), J (n + 2, n + 2)
+    n = len(z)
+    F, J = sat.get_saturation_equations(compset, z, X[:n], math.exp(X[n]), math.exp(X[n + 1]), beta)
+    e = np.zeros(n + 2)
+    e[spec] = 1
+    return np.append(F, X[spec] - S), np.vstack((J, e))
+
+
+def solve_envelope_point(compset: calc.ComponentSet,
+                         z: np.ndarray,
+                         X: np.ndarray,
+                         beta: float,
+                         spec: int,
+                         S: float):
+    ### Newton corrector from the predicted X; returns X, Jacobian and iterations, or None on failure
+    ### A predicted point far off the curve may overflow K or the fugacities; such steps give non-finite
+    ### equations and are rejected (the step is then halved), so the floating point warnings are not shown
+    n = len(z)
+    present = z > 0
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for iteration in range(1, NEWTON_MAX_ITER + 1):
+            F, J = get_envelope_equations(compset, z, X, beta, spec, S)
+            if not np.isfinite(F).all() or not np.isfinite(J).all():
+                return None
+            try:
+                dX = np.linalg.solve(J, -F)
+            except np.linalg.LinAlgError:
+                return None
+            ### Damping of large corrections in ln T and ln P
+            dX = dX * min(1, 0.1 / max(abs(dX[n]), abs(dX[n + 1]), 10 ** -300))
+            X = X + dX
+            if np.abs(X[:n][present]).max() < 10 ** -4:
+                return None  # trivial solution, both phases identical
+            if np.abs(dX).max() < NEWTON_TOL:
+                return X, J, iteration
+        F, J = get_envelope_equations(compset, z, X, beta, spec, S)
+    if np.abs(F).max() < RESIDUAL_TOL and np.isfinite(J).all():
+        return X, J, NEWTON_MAX_ITER
+    return None
+
+
+def get_step_limits(n: int):
+    return np.concatenate((np.full(n, MAX_LNK_STEP), [MAX_LNT_STEP, MAX_LNP_STEP]))
+
+
+def get_extremum(lnT: np.ndarray,
+                 lnP: np.ndarray,
+                 index: int,
+                 variable: np.ndarray):
+    ### Maximum of variable (lnT or lnP) on the quadratic through the point and its neighbours, parametrized by chord
+    ### length; returns T and P of the maximum
+    if index == 0 or index == len(lnT) - 1:
+        return math.exp(lnT[index]), math.exp(lnP[index])
+    rows = slice(index - 1, index + 2)
+    s = np.concatenate(([0], np.cumsum(np.hypot(np.diff(lnT[rows]), np.diff(lnP[rows])))))
+    coef_T = np.polyfit(s, lnT[rows], 2)
+    coef_P = np.polyfit(s, lnP[rows], 2)
+    coef = np.polyfit(s, variable[rows], 2)
+    s_max = np.clip(-coef[1] / (2 * coef[0]), s[0], s[2]) if coef[0] < 0 else s[1]
+    return math.exp(np.polyval(coef_T, s_max)), math.exp(np.polyval(coef_P, s_max))
+
+
+@instr.profiled('envelope')
+def trace_phase_envelope_arr(compset: calc.ComponentSet,
+                             z: np.ndarray,
+                             P_start: float,
+                             P_max: float = 15000,
+                             beta: float = 1.0,
+                             max_points: int = 500,
+                             initial_step: float = 0.1,
+                             show_log: bool = False):
+    ### Saturation curve of feed z from P_start (field units) up through the critical point and back to P_start
+    ### beta = 1 starts on the dew branch, beta = 0 on the bubble branch
+    ### Returns T and P of the points (m), ln K (m, n), dew point flags (m), Newton iterations (m) and the key points
+    ### {'critical', 'cricondenbar', 'cricondentherm'}: (T, P) or None where not found on the traced part
+    z = np.asarray(z, dtype=float)
+    n = len(z)
+    if np.count_nonzero(z) < 2:
+        raise ValueError('Phase envelope needs at least two components in the feed')
+    T0 = float(sat.get_wilson_saturation_T(compset, z, P_start, beta))
+    X = np.concatenate((np.log(calc.get_initial_Kvalues_arr(compset, P_start, T0)), [math.log(T0), math.log(P_start)]))
+    spec = n + 1
+    feed_vapor = beta == 1
+    result = solve_envelope_point(compset, z, X, beta, spec, X[spec])
+    if result is None:
+        raise ValueError('No saturation point found at {:.2f} psi'.format(P_start))
+    X, J, iterations = result
+    points = [X]
+    iterations_list = [iterations]
+    dew = [feed_vapor]
+    critical = None
+    limits = get_step_limits(n)
+    dS = initial_step
+    while len(points) < max_points:
+        ### Sensitivities of the last point, the fastest changing variable becomes the specification
+        e = np.zeros(n + 2)
+        e[-1] = 1
+        try:
+            dX_dS = np.linalg.solve(J, e)
+        except np.linalg.LinAlgError:
+            break
+        new_spec = int(np.argmax(np.abs(dX_dS)))
+        dS = dS * dX_dS[new_spec]
+        dX_dS = dX_dS / dX_dS[new_spec]
+        spec = new_spec
+        dS = math.copysign(min(abs(dS), (limits / np.maximum(np.abs(dX_dS), 10 ** -300)).min()), dS)
+        ### Passing the critical point (ln K of the key component changes sign) turns the dew branch into the bubble one
+        key = int(np.argmax(np.abs(X[:n]) * (z > 0)))
+        retried = False
+        while abs(dS) >= MIN_STEP:
+            if spec < n and abs(X[spec] + dS) < CRITICAL_GAP and not retried:
+                dS = math.copysign(CRITICAL_GAP, dS) - X[spec]  # stepping over the critical point, halved if it fails
+            X_predicted = X + dX_dS * dS
+            crossing = X[key] * X_predicted[key] < 0
+            result = solve_envelope_point(compset, z, X_predicted, beta, spec, X_predicted[spec])
+            if result is not None and (X[key] * result[0][key] < 0) == crossing:
+                break
+            dS = dS / 2
+            retried = True
+        else:
+            ### Usually a three-phase region or a cusp of the curve
+            instr.logger.warning('Phase envelope tracing stopped at %.2f R, %.2f psi', math.exp(X[n]), math.exp(X[n + 1]))
+            break
+        X_new, J, iterations = result
+        if crossing:
+            feed_vapor = not feed_vapor
+            if critical is None:
+                ### Critical point by linear interpolation between the points
+                t = X[key] / (X[key] - X_new[key])
+                critical = (math.exp(X[n] + t * (X_new[n] - X[n])),
+                            math.exp(X[n + 1] + t * (X_new[n + 1] - X[n + 1])))
+        X = X_new
+        points.append(X)
+        iterations_list.append(iterations)
+        dew.append(feed_vapor)
+        if show_log:
+            instr.logger.debug('Envelope point %d: %.2f R, %.2f psi, %d Newton steps', len(points), math.exp(X[n]),
+                               math.exp(X[n + 1]), iterations)
+        if X[n + 1] < math.log(P_start) or X[n + 1] > math.log(P_max):
+            break
+        if iterations <= 3 and not retried:
+            dS = dS * 1.5
+    points = np.array(points)
+    lnT = points[:, n]
+    lnP = points[:, n + 1]
+    key_points = {'critical': critical,
+                  'cricondenbar': get_extremum(lnT, lnP, int(np.argmax(lnP)), lnP),
+                  'cricondentherm': get_extremum(lnT, lnP, int(np.argmax(lnT)), lnT)}
+    if show_log:
+        instr.logger.info('Phase envelope: %d points, %d Newton steps', len(points), sum(iterations_list))
+    return np.exp(lnT), np.exp(lnP), points[:, :n], np.array(dew), np.array(iterations_list), key_points
+
+
+def get_phase_envelope(comppropDB: pd.DataFrame,
+                       binarycoefDB: pd.DataFrame,
+                       input_streamcomp: pd.DataFrame,
+                       P_start_bara: float = 1.0,
+                       P_max_bara: float = 1000.0,
+                       dry: bool = False,
+                       show_log: bool = False):
+    ### Phase envelope of a stream composition in [bara] and [C]
+    ### dry - water removed from the feed: the first liquid of a wet stream is water-rich on most of its curve,
+    ###       the hydrocarbon envelope is traced on the dry basis
+    ### Returns the points (T, P, dew/bubble branch, Newton iterations) and the key points as DataFrames
+    compset = calc.ComponentSet(comppropDB, binarycoefDB, input_streamcomp.index)
+    z = input_streamcomp['Content [mol. fract.]'].to_numpy(dtype=float)
+    if dry and compset.water_index is not None:
+        z = z.copy()
+        z[compset.water_index] = 0
+        if not z.sum() > 0:
+            raise ValueError('Feed has no components other than water, there is no dry basis envelope')
+        z = z / z.sum()
+    T, P, lnK, dew, iterations, key_points = trace_phase_envelope_arr(
+        compset,
+        z,
+        calc.UnitsConverter.Pressure.bar_to_psi(P_start_bara),
+        calc.UnitsConverter.Pressure.bar_to_psi(P_max_bara),
+        show_log=show_log)
+    envelope_df = pd.DataFrame({'T [C]': calc.UnitsConverter.Temperature.R_to_C(T),
+                                'P [bara]': calc.UnitsConverter.Pressure.psi_to_kPa(P) / 100,
+                                'branch': np.where(dew, 'dew', 'bubble'),
+                                'iterations': iterations})
+    key_points_df = pd.DataFrame([(np.nan, np.nan) if point is None else
+                                  (calc.UnitsConverter.Temperature.R_to_C(point[0]),
+                                   calc.UnitsConverter.Pressure.psi_to_kPa(point[1]) / 100)
+                                  for point in key_points.values()],
+                                 index=list(key_points), columns=['T [C]', 'P [bara]'])
+    return envelope_df, key_points_df
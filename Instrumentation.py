@@ -0,0 +1,125 @@
+import json
+import math
+import time
+import logging
+import functools
+import threading
+
+### Instrumentation of the flash engine
+### - 'flash' logger instead of console prints: set_log_level('DEBUG') shows per-iteration K-value errors,
+###   'INFO' convergence summaries, 'WARNING' (default) only problems
+### - counters and timers per stage (initial K, compdepvar, rachford-rice, mixing rules, cubic, fugacity, K-update, ...),
+###   off by default; a disabled profiled call costs one attribute check. Stage times are inclusive,
+###   e.g. K-update contains the mixing rules, cubic and fugacity stages it calls
+### - optional trace of the per-iteration K-value error history (err_list) of every K-value loop, exported as JSON lines
+logger = logging.getLogger('flash')
+
+
+def set_log_level(level):
+    ### level - logging level name ('DEBUG', 'INFO', 'WARNING', ...) or number;
+    ### messages go to the console unless the application configured its own handlers
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.times = dict()
+        self.counters = dict()
+        self.trace = None
+
+    def enable(self, trace: bool = False):
+        self.enabled = True
+        if trace and self.trace is None:
+            self.trace = list()
+
+    def disable(self):
+        self.enabled = False
+        self.trace = None
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.times.clear()
+            self.counters.clear()
+            if self.trace is not None:
+                self.trace = list()
+
+    def add(self,
+            stage: str,
+            elapsed: float):
+        with self.lock:
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+            self.times[stage] = self.times.get(stage, 0) + elapsed
+
+    def count(self,
+              name: str,
+              number: int = 1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + number
+
+    def add_trace(self, record: dict):
+        if self.trace is not None:
+            with self.lock:
+                self.trace.append(record)
+
+    def report(self):
+        ### Calls and total time of each stage plus the counters
+        with self.lock:
+            return {'stages': {stage: {'calls': self.calls[stage], 'time [ms]': self.times[stage] * 1000}
+                               for stage in sorted(self.times, key=self.times.get, reverse=True)},
+                    'counters': dict(self.counters)}
+
+    def print_report(self):
+        report = self.report()
+        print('{:<20}{:>10}{:>14}{:>14}'.format('stage', 'calls', 'time [ms]', 'per call [us]'))
+        for stage, values in report['stages'].items():
+            print('{:<20}{:>10}{:>14.2f}{:>14.2f}'.format(stage,
+                                                              values['calls'],
+                                                              values['time [ms]'],
+                                                              values['time [ms]'] / values['calls'] * 1000))
+        for name, value in report['counters'].items():
+            print('{:<20}{:>10}'.format(name, value))
+
+    def export_trace(self, path: str):
+        ### One JSON object per K-value loop: conditions, method, steps, convergence and the error of every iteration
+        with self.lock, open(path, 'w') as file:
+            for record in self.trace or list():
+                file.write(json.dumps(record) + '\n')
+
+
+profiler = Profiler()
+
+
+def get_json_safe(data):
+    ### NaN (absent phase) becomes null, so reports, result files and service responses are strict JSON
+    if isinstance(data, dict):
+        return {key: get_json_safe(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [get_json_safe(value) for value in data]
+    if isinstance(data, float) and math.isnan(data):
+        return None
+    return data
+
+
+def profiled(stage: str):
+    ### Decorator adding the call and its time to the stage while the profiler is enabled
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.add(stage, time.perf_counter() - start_time)
+        return wrapper
+    return decorator
@@ -1,30 +1,43 @@
 import os
 
+### xlsx files of a directory by kind, the directory is listed once and the names are kept for the next calls
+### (scan_directory(directory, refresh=True) after adding files)
+FILE_KINDS = {'comppropDB': 'CompProp', 'binarycoefDB': 'BinaryCoef', 'streamcomp': 'StreamComposition'}
+scanned_directories = dict()
+
+def scan_directory(directory: str,
+                   refresh: bool = False):
+    key = os.path.abspath(directory)
+    if refresh or key not in scanned_directories:
+        names = {kind: [] for kind in FILE_KINDS}
+        for filename in os.listdir(directory):
+            if filename[-5:] == '.xlsx':
+                for kind, marker in FILE_KINDS.items():
+                    if marker in filename:
+                        names[kind].append(filename)
+        scanned_directories[key] = names
+    return scanned_directories[key]
+
 def get_comppropDB_names(directory: str):
-    all_filenames = os.listdir(directory)
-    comppropDB_names_list = []
-    for filename in all_filenames:
-        if filename[-5:] == '.xlsx' and 'CompProp' in filename:
-            comppropDB_names_list.append(filename)
-    return comppropDB_names_list
-## update to use DB files outside from main.py directory
+    return list(scan_directory(directory)['comppropDB'])
 
 def get_binarycoefDB_names(directory: str):
-    all_filenames = os.listdir(directory)
-    binarycoefDB__names_list = []
-    for filename in all_filenames:
-        if filename[-5:] == '.xlsx' and 'BinaryCoef' in filename:
-            binarycoefDB__names_list.append(filename)
-    return binarycoefDB__names_list
-## update to use DB files outside from main.py directory
+    return list(scan_directory(directory)['binarycoefDB'])
 
 def get_streamcomp_names(directory: str):
-    all_filenames = os.listdir(directory)
-    streamcomp_names_list = []
-    for filename in all_filenames:
-        if filename[-5:] == '.xlsx' and 'StreamComposition' in filename:
-            streamcomp_names_list.append(filename)
-    return streamcomp_names_list
+    return list(scan_directory(directory)['streamcomp'])
+
+def get_database_path(directory: str,
+                      kind: str,
+                      path: str = None):
+    ### Explicit database path as given, otherwise the first database of this kind ('comppropDB' or 'binarycoefDB')
+    ### found in the directory
+    if path:
+        return path
+    names = scan_directory(directory)[kind]
+    if not names:
+        raise FileNotFoundError('No {} xlsx file in {}'.format(FILE_KINDS[kind], os.path.abspath(directory)))
+    return os.path.join(directory, names[0])
 
 def select_file(filenames_list: list):
    print('\tSelect file from listed below:')
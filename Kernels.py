@@ -0,0 +1,201 @@
+import os
+import math
+import functools
+import numpy as np
+import Lazy as lazy
+numba = lazy.lazy_import('numba', optional=True)  # compiled kernels only
+
+### Optional compiled kernels of the PR-EOS inner loop: cubic root selection, fugacity coefficients,
+### Rachford-Rice and the mixing-rule sums
+### Kernels are plain loops over flattened conditions, compiled by Numba when it is installed; machine code is cached
+### on disk (__pycache__ next to this file, or NUMBA_CACHE_DIR when that is not writable), so only the first launch
+### after a change pays the compilation. Without Numba the NumPy implementations in Calculations_v4 are used -
+### the loops here are never run by the interpreter there. Both paths give the same results to round-off.
+### enabled - compiled kernels are used when available; FLASH_KERNELS=numpy in the environment switches them off
+enabled = numba is not None and os.environ.get('FLASH_KERNELS', 'numba') != 'numpy'
+EPS = float(np.finfo(float).eps)
+
+
+def jit(function):
+    ### Compiled kernel with NumPy error semantics (division by zero gives inf/NaN), the function itself without Numba
+    ### Numba is imported and the kernel compiled (or loaded from the disk cache) on the first call, not at import
+    if numba is None:
+        return function
+    compiled = None
+
+    @functools.wraps(function)
+    def kernel(*args):
+        nonlocal compiled
+        if compiled is None:
+            compiled = numba.njit(cache=True, nogil=True, error_model='numpy')(function)
+        return compiled(*args)
+    return kernel
+
+
+def get_backend():
+    return 'numba {}'.format(numba.__version__) if enabled else 'numpy'
+
+
+@jit
+def zfactor_kernel(Aj: np.ndarray,
+                   Bj: np.ndarray,
+                   vapor: np.ndarray,
+                   degenerate_tol: float):
+    ### get_zfactor_arr on 1-d arrays: vapor (largest) or liquid (smallest) root above B, NaN and invalid if none,
+    ### degenerate where the discriminant is within degenerate_tol of zero (solved as a repeated root)
+    m = Aj.shape[0]
+    zj = np.empty(m)
+    valid = np.empty(m, dtype=np.bool_)
+    degenerate = np.empty(m, dtype=np.bool_)
+    for k in range(m):
+        A = Aj[k]
+        B = Bj[k]
+        a2 = -(1 - B)
+        a1 = A - 2 * B - 3 * B ** 2
+        a0 = -(A * B - B ** 2 - B ** 3)
+        q = 1 / 3 * a1 - 1 / 9 * a2 ** 2
+        r = 1 / 6 * (a1 * a2 - 3 * a0) - 1 / 27 * a2 ** 3
+        D = q ** 3 + r ** 2
+        degenerate[k] = abs(D) <= degenerate_tol * (abs(q) ** 3 + r ** 2)
+        z_max = -np.inf
+        z_min = np.inf
+        if D > 0 and not degenerate[k]:
+            ### One real root and a pair of complex conjugate roots
+            sqrt_D = math.sqrt(D)
+            root = np.cbrt(r + sqrt_D) + np.cbrt(r - sqrt_D) - a2 / 3
+            if root > B:
+                z_max = root
+                z_min = root
+        else:
+            ### All roots are real
+            minus_q = -q
+            cos_arg = r / math.sqrt(minus_q ** 3) if minus_q > 0 else 0.
+            theta = math.acos(min(1., max(-1., cos_arg))) / 3
+            for j in range(3):
+                root = 2 * math.sqrt(minus_q) * math.cos(theta + j * 2 * math.pi / 3) - a2 / 3
+                if root > B:
+                    z_max = max(z_max, root)
+                    z_min = min(z_min, root)
+        valid[k] = z_max > -np.inf
+        if not valid[k]:
+            zj[k] = np.nan
+        elif vapor[k]:
+            zj[k] = z_max
+        else:
+            zj[k] = z_min
+    return zj, valid, degenerate
+
+
+@jit
+def fugacities_kernel(Aj: np.ndarray,
+                      Bj: np.ndarray,
+                      Aijprime: np.ndarray,
+                      Bijprime: np.ndarray,
+                      zj: np.ndarray):
+    ### get_fugacities_arr on phases (m) x components (n), NaN where the expression is undefined
+    m, n = Aijprime.shape
+    fugacit = np.empty((m, n))
+    sqrt2 = math.sqrt(2)
+    for k in range(m):
+        A = Aj[k]
+        B = Bj[k]
+        Z = zj[k]
+        log_ZB = np.log(Z - B)
+        C = A / (2 * sqrt2 * B)
+        Lg = np.log((Z + (sqrt2 + 1) * B) / (Z - (sqrt2 - 1) * B))
+        for i in range(n):
+            fugacit[k, i] = np.exp(-log_ZB + (Z - 1) * Bijprime[k, i] - C * (Aijprime[k, i] - Bijprime[k, i]) * Lg)
+    return fugacit
+
+
+@jit
+def rachford_rice_kernel(z: np.ndarray,
+                         K: np.ndarray,
+                         max_iter: int):
+    ### Vapor fraction loop of solve_rachford_rice_arr on conditions (m) x components (n), same bracketing,
+    ### Leibovici-Neoschil Newton steps and stopping rule; returns V, iterations, convergence and all-liquid /
+    ### all-vapor flags
+    m, n = K.shape
+    V_arr = np.empty(m)
+    iterations = np.zeros(m, dtype=np.int64)
+    converged = np.zeros(m, dtype=np.bool_)
+    all_liquid = np.zeros(m, dtype=np.bool_)
+    all_vapor = np.zeros(m, dtype=np.bool_)
+    for k in range(m):
+        K_max = -np.inf
+        K_min = np.inf
+        undefined = False
+        for i in range(n):
+            if z[k, i] > 0:
+                if np.isnan(K[k, i]):
+                    undefined = True
+                K_max = max(K_max, K[k, i])
+                K_min = min(K_min, K[k, i])
+        V_arr[k] = 0.5
+        if undefined:
+            continue
+        all_liquid[k] = K_max <= 1
+        all_vapor[k] = K_min >= 1
+        if all_liquid[k] or all_vapor[k]:
+            V_arr[k] = 0. if all_liquid[k] else 1.
+            converged[k] = True
+            continue
+        V_min = 1 / (1 - K_max)
+        V_max = 1 / (1 - K_min)
+        if not (np.isfinite(V_min) and np.isfinite(V_max)):
+            continue
+        V_low = V_min
+        V_high = V_max
+        V = 0.5
+        for iteration in range(max_iter):
+            f = 0.
+            df = 0.
+            for i in range(n):
+                Km1 = K[k, i] - 1
+                denom = 1 + V * Km1
+                term = z[k, i] * Km1 / denom
+                f += term
+                df -= term * Km1 / denom
+            if f > 0:
+                V_low = V
+            if f < 0:
+                V_high = V
+            dist_low = V - V_min
+            dist_high = V_max - V
+            F = dist_low * dist_high * f
+            dF = (dist_high - dist_low) * f + dist_low * dist_high * df
+            step = F / dF
+            V_new = V - step
+            done = abs(step) <= 4 * EPS * max(1., abs(V)) or f == 0
+            if not (V_new > V_low and V_new < V_high) and not done:
+                V_new = (V_low + V_high) / 2
+            V = V_new
+            iterations[k] += 1
+            if done:
+                converged[k] = True
+                break
+        V_arr[k] = V
+    return V_arr, iterations, converged, all_liquid, all_vapor
+
+
+@jit
+def phasedepvar_kernel(X: np.ndarray,
+                       bi: np.ndarray,
+                       aij: np.ndarray):
+    ### Mixing-rule sums of get_phasedepvar_arr on conditions (m) x phases (p) x components (n):
+    ### aij.x (m, p, n), aj = x.aij.x and bj = x.bi (m, p); aij is (m, n, n) or (1, n, n) shared by all conditions
+    m, p, n = X.shape
+    aij_x = np.zeros((m, p, n))
+    aj = np.zeros((m, p))
+    bj = np.zeros((m, p))
+    for k in range(m):
+        a = aij[k if aij.shape[0] > 1 else 0]
+        for j in range(p):
+            for i in range(n):
+                s = 0.
+                for l in range(n):
+                    s += a[i, l] * X[k, j, l]
+                aij_x[k, j, i] = s
+                aj[k, j] += X[k, j, i] * s
+                bj[k, j] += X[k, j, i] * bi[i]
+    return aij_x, aj, bj
@@ -0,0 +1,33 @@
+import sys
+import importlib.util
+
+### Deferred imports of heavy libraries (pandas, pyarrow, numba)
+### The module object is bound at once and its code runs on the first attribute access, so importing the solver
+### modules costs only numpy; a run that never touches a DataFrame never loads pandas
+### Modules that use these names in annotations need `from __future__ import annotations` (annotations are not
+### evaluated at definition time then)
+
+
+def lazy_import(name: str,
+                optional: bool = False):
+    ### name - module name; the parent package of a submodule is imported at once, only the submodule is deferred
+    ### optional - None instead of ImportError when the module is not installed
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        if optional:
+            return None
+        raise ModuleNotFoundError('No module named {!r}'.format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def is_loaded(name: str):
+    ### True once the module code has actually run (a pending lazy module does not count)
+    module = sys.modules.get(name)
+    return module is not None and not isinstance(module, importlib.util._LazyModule)
@@ -0,0 +1,132 @@
+from __future__ import annotations
+import numpy as np
+import Lazy as lazy
+import Calculations_v4 as calc
+import Instrumentation as instr
+pd = lazy.lazy_import('pandas')
+
+### Phase properties of flash results: molar weights, vapor density from the PR z-factor, COSTALD liquid density
+### (Hankinson-Thomson) for the hydrocarbon liquid and aqueous phases and the mixture density
+### Compositions are arrays with phases along the second-to-last axis, (..., 3, n) for (vapor, liquid, aqueous),
+### so one call covers a single flash or a whole batch; P and T in field units, scalars or arrays over the leading axes
+### COSTALD mixing rules reduce to matrix products with the per-component constants of PropertySet:
+###     V* = (sum x_i V_i + 3 * sum x_i V_i^(1/3) * sum x_i V_i^(2/3)) / 4,    Tc = (sum x_i sqrt(Tc_i V_i))^2 / V*
+### Absent phases (phase fraction 0) give NaN
+PHASES = ('vapor', 'liquid', 'aqueous')
+R_SI = 8.31446261815324  # [J/(mole*K)]
+
+
+class PropertySet:
+    ### Per-component constants of the property correlations, ordered as the stream composition index
+    def __init__(self,
+                 comppropDB: pd.DataFrame,
+                 components):
+        self.names = list(components)
+        props = comppropDB.loc[self.names]
+        self.MW = np.ascontiguousarray(props['MW [g/mole]'].to_numpy(dtype=float))
+        self.w_SRK = np.ascontiguousarray(props['SRK Acentricity'].to_numpy(dtype=float))
+        V = props['Characteristic Volume [m3/kgmole]'].to_numpy(dtype=float)
+        Tc = calc.UnitsConverter.Temperature.C_to_R(props['Tcrit [C]'].to_numpy(dtype=float))
+        ### Columns of the COSTALD mixing rules: V, V^(1/3), V^(2/3), sqrt(Tc * V)
+        self.costald = np.ascontiguousarray(np.stack((V, V ** (1 / 3), V ** (2 / 3), np.sqrt(Tc * V)), axis=-1))
+
+    def __len__(self):
+        return len(self.names)
+
+
+def get_molar_weights_arr(propset: PropertySet,
+                          X: np.ndarray):
+    return X @ propset.MW  # [g/mole]
+
+
+def get_costald_density_arr(propset: PropertySet,
+                            X: np.ndarray,
+                            T,
+                            MW: np.ndarray = None):
+    ### COSTALD saturated liquid density [kg/m3] of compositions X at T [R], same correlation as
+    ### get_liquid_phase_density; NaN outside its range 0.25 < Tr < 0.95 and for empty compositions
+    ### T broadcasts against the leading axes of X
+    T = np.asarray(T, dtype=float)
+    if MW is None:
+        MW = get_molar_weights_arr(propset, X)
+    sums = X @ propset.costald
+    w_mix = X @ propset.w_SRK
+    V_mix = 0.25 * (sums[..., 0] + 3 * sums[..., 1] * sums[..., 2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Tr = T / (sums[..., 3] ** 2 / V_mix)
+        in_range = (Tr > 0.25) & (Tr < 0.95)
+        Tr = np.where(in_range, Tr, 0.5)
+        VdeltaR = (-0.296123 + 0.386914 * Tr - 0.0427258 * Tr ** 2 - 0.0480645 * Tr ** 3) / (Tr - 1.00001)
+        V0R = 1 - 1.52816 * (1 - Tr) ** (1 / 3) + 1.43907 * (1 - Tr) ** (2 / 3) - 0.81446 * (1 - Tr) \
+              + 0.190454 * (1 - Tr) ** (4 / 3)
+        Vs = V0R * (1 - w_mix * VdeltaR) * V_mix  # [m3/kgmol]
+        return np.where(in_range, MW / Vs, np.nan)
+
+
+def get_vapor_density_arr(MW: np.ndarray,
+                          P,
+                          T,
+                          zfactor: np.ndarray):
+    ### Real-gas density [kg/m3] from the molar weight, P [psi], T [R] and z-factor, as get_vapor_phase_density
+    P = calc.UnitsConverter.Pressure.psi_to_kPa(np.asarray(P, dtype=float))
+    T = calc.UnitsConverter.Temperature.R_to_K(np.asarray(T, dtype=float))
+    return MW / (zfactor * R_SI * T / P)
+
+
+def get_mix_density_arr(densities: np.ndarray,
+                        phase_fractions: np.ndarray,
+                        MW: np.ndarray):
+    ### Mixture density [kg/m3] over the present phases (phase fraction > 0), phases along the last axis;
+    ### NaN where the density of a present phase is unknown
+    present = phase_fractions > 0
+    mass = np.where(present, phase_fractions * MW, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        volume = np.where(present, mass / densities, 0)
+        return mass.sum(axis=-1) / volume.sum(axis=-1)
+
+
+@instr.profiled('phase properties')
+def get_phase_properties_arr(propset: PropertySet,
+                             equicomp: np.ndarray,
+                             phase_fractions: np.ndarray,
+                             zfactors: np.ndarray,
+                             P,
+                             T):
+    ### Properties of (vapor, liquid, aqueous) phases of flash results: equicomp (..., 3, n), phase_fractions and
+    ### zfactors (..., 3); P [psi] and T [R] broadcast against the leading axes
+    ### Returns {'MW': (..., 3) [g/mole], 'densities': (..., 3) [kg/m3], 'density mix': (...) [kg/m3]}
+    present = phase_fractions > 0
+    X = np.where(present[..., None], np.nan_to_num(equicomp), 0)
+    MW = get_molar_weights_arr(propset, X)
+    densities = np.empty(MW.shape)
+    densities[..., 0] = get_vapor_density_arr(MW[..., 0], P, T, zfactors[..., 0])
+    densities[..., 1:] = get_costald_density_arr(propset, X[..., 1:, :], np.asarray(T, dtype=float)[..., None],
+                                                 MW[..., 1:])
+    failed = present[..., 1:] & np.isnan(densities[..., 1:])
+    if failed.any():
+        instr.logger.warning('Costald density correlation error: Tr out of range for %d of %d liquid phases',
+                             failed.sum(), present[..., 1:].sum())
+    densities = np.where(present, densities, np.nan)
+    return {'MW': np.where(present, MW, np.nan),
+            'densities': densities,
+            'density mix': get_mix_density_arr(densities, phase_fractions, MW)}
+
+
+def get_phase_properties(comppropDB: pd.DataFrame,
+                         equicomp_df: pd.DataFrame,
+                         phase_fractions: pd.Series,
+                         zfactors: pd.DataFrame,
+                         P_field: float,
+                         T_field: float):
+    ### DataFrame front end for the outputs of flash_calc_PR_EOS: molar weights and densities by phase (V, L, Q)
+    ### and the mixture density
+    propset = PropertySet(comppropDB, equicomp_df.index)
+    properties = get_phase_properties_arr(propset,
+                                          equicomp_df[list(PHASES)].to_numpy(dtype=float).T,
+                                          phase_fractions[['V', 'L', 'Q']].to_numpy(dtype=float),
+                                          zfactors.loc[list(PHASES), 'zj'].to_numpy(dtype=float),
+                                          P_field,
+                                          T_field)
+    phaseMW = pd.Series(properties['MW'], index=['V', 'L', 'Q'])
+    densities = pd.Series(properties['densities'], index=['V', 'L', 'Q'])
+    return phaseMW, densities, float(properties['density mix'])
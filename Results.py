@@ -0,0 +1,368 @@
+from __future__ import annotations
+import os
+import numpy as np
+import Lazy as lazy
+import Calculations_v4 as calc
+pd = lazy.lazy_import('pandas')
+pa = lazy.lazy_import('pyarrow', optional=True)  # Parquet/Arrow output only
+
+### Long-format flash results table: one row per case, phase and component, phase properties repeated on each row
+### Rows are collected column-wise and written in batches - CSV is appended to (header written once),
+### Parquet/Arrow files get one row group / record batch per flush and are always written anew
+COLUMNS = ['case', 'P [bara]', 'T [C]', 'phase', 'component', 'fraction [mol. fract.]',
+           'phase fraction [mol. fract.]', 'zj', 'MW [g/mole]', 'density [kg/m3]']
+PHASES = ('vapor', 'liquid', 'aqueous')
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+### Flash results packed in float64: one flat vector per result (FlashResult), one column-major 2-D table per batch
+### (FlashBatch), laid out as SCALAR_COLUMNS followed by the compositions (phase-major) and the K-values y / x of
+### the hydrocarbon liquid and the aqueous phase (second row NaN for vapor-liquid feeds); field units (psi, R)
+SCALAR_COLUMNS = ['P [psi]', 'T [R]', 'V', 'L', 'Q', 'zj vapor', 'zj liquid', 'zj aqueous']
+K_PHASES = ('liquid', 'aqueous')
+
+
+def get_format(path: str):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError('Unsupported results file type "{}", use one of: {}'.format(extension, ', '.join(FORMATS)))
+    return FORMATS[extension]
+
+
+def get_result_columns(components):
+    components = list(components)
+    return (SCALAR_COLUMNS
+            + ['{} {}'.format(phase, component) for phase in PHASES for component in components]
+            + ['K {} {}'.format(phase, component) for phase in K_PHASES for component in components])
+
+
+def get_result_fields(values: np.ndarray,
+                      n: int):
+    ### Views of the flash fields in result vectors (..., 8 + 5 * n): P, T, phase fractions (..., 3),
+    ### z-factors (..., 3), compositions (..., 3, n) and K-values (..., 2, n)
+    shape = values.shape[:-1]
+    return {'P': values[..., 0],
+            'T': values[..., 1],
+            'phase_fractions': values[..., 2:5],
+            'zfactors': values[..., 5:8],
+            'equicomp': values[..., 8:8 + 3 * n].reshape(shape + (3, n)),
+            'K': values[..., 8 + 3 * n:].reshape(shape + (2, n))}
+
+
+def pack_result(P_field,
+                T_field,
+                equicomp: np.ndarray,
+                phase_fractions: np.ndarray,
+                zfactors: np.ndarray,
+                K: np.ndarray):
+    ### Result vectors (..., 8 + 5 * n) from the outputs of flash_PR_EOS_arr / flash_grid_arr with full_output,
+    ### leading axes are conditions; vapor-liquid K-values (..., n) go to the first K row
+    n = equicomp.shape[-1]
+    shape = equicomp.shape[:-2]
+    values = np.empty(shape + (8 + 5 * n,))
+    fields = get_result_fields(values, n)
+    fields['P'][...] = P_field
+    fields['T'][...] = T_field
+    fields['phase_fractions'][...] = phase_fractions
+    fields['zfactors'][...] = zfactors
+    fields['equicomp'][...] = equicomp
+    K = np.asarray(K, dtype=float)
+    if K.ndim == len(shape) + 1:
+        fields['K'][..., 0, :] = K
+        fields['K'][..., 1, :] = np.nan
+    else:
+        fields['K'][...] = K
+    return values
+
+
+class FlashResult:
+    ### One flash in a single float64 vector; fields are views into it
+    __slots__ = ('components', 'values', 'converged', 'iterations')
+
+    def __init__(self,
+                 components,
+                 values: np.ndarray,
+                 converged: bool,
+                 iterations: int):
+        self.components = tuple(components)
+        self.values = np.ascontiguousarray(values, dtype=float)
+        if self.values.shape != (8 + 5 * len(self.components),):
+            raise ValueError('Result vector of {} values does not match {} components'.format(self.values.size,
+                                                                                            len(self.components)))
+        self.converged = bool(converged)
+        self.iterations = int(iterations)
+
+    def __getstate__(self):
+        return self.components, self.values, self.converged, self.iterations
+
+    def __setstate__(self, state):
+        self.components, self.values, self.converged, self.iterations = state
+
+    def __repr__(self):
+        return 'FlashResult({} components, {:.2f} psi, {:.2f} R, V/L/Q {}, {} iterations{})'.format(
+            len(self.components), self.P, self.T, np.round(self.phase_fractions, 6).tolist(), self.iterations,
+            '' if self.converged else ', not converged')
+
+    def get(self, field: str):
+        return get_result_fields(self.values, len(self.components))[field]
+
+    @property
+    def P(self):
+        return float(self.values[0])  # [psi]
+
+    @property
+    def T(self):
+        return float(self.values[1])  # [R]
+
+    @property
+    def phase_fractions(self):
+        return self.get('phase_fractions')
+
+    @property
+    def zfactors(self):
+        return self.get('zfactors')
+
+    @property
+    def equicomp(self):
+        return self.get('equicomp')
+
+    @property
+    def K(self):
+        return self.get('K')
+
+    def to_frames(self):
+        ### Outputs of flash_calc_PR_EOS: compositions by phase, phase fractions (V, L, Q) and z-factors
+        equicomp_df = pd.DataFrame(self.equicomp.T, columns=list(PHASES), index=list(self.components))
+        phase_fractions = pd.Series(self.phase_fractions, index=['V', 'L', 'Q'])
+        zfactors = pd.DataFrame({'zj': self.zfactors}, index=list(PHASES))
+        return equicomp_df, phase_fractions, zfactors
+
+
+class FlashBatch:
+    ### Flash results of one component set packed in a column-major table (results x 8 + 5 * n), so that every column
+    ### is contiguous: fields, NumPy, pandas and Arrow exports are views of the same memory
+    def __init__(self,
+                 components,
+                 table: np.ndarray,
+                 converged: np.ndarray,
+                 iterations: np.ndarray):
+        self.components = tuple(components)
+        self.table = np.asfortranarray(table, dtype=float)
+        if self.table.ndim != 2 or self.table.shape[1] != 8 + 5 * len(self.components):
+            raise ValueError('Result table of shape {} does not match {} components'.format(self.table.shape,
+                                                                                          len(self.components)))
+        self.converged = np.ascontiguousarray(converged, dtype=bool)
+        self.iterations = np.ascontiguousarray(iterations, dtype=np.int64)
+        if self.converged.shape != (len(self.table),) or self.iterations.shape != (len(self.table),):
+            raise ValueError('Convergence flags and iteration counts must have one value per result')
+
+    @classmethod
+    def from_results(cls, results):
+        results = list(results)
+        if not results:
+            raise ValueError('No results to pack')
+        components = results[0].components
+        if any(result.components != components for result in results):
+            raise ValueError('Results of different component sets cannot be packed in one batch')
+        table = np.empty((len(results), 8 + 5 * len(components)), order='F')
+        for i, result in enumerate(results):
+            table[i] = result.values
+        return cls(components,
+                   table,
+                   [result.converged for result in results],
+                   [result.iterations for result in results])
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index: int):
+        ### A single result (its values are copied out of the column-major table)
+        return FlashResult(self.components, self.table[index], self.converged[index], self.iterations[index])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self):
+        return 'FlashBatch({} results, {} components, {} not converged)'.format(len(self), len(self.components),
+                                                                                 int((~self.converged).sum()))
+
+    def get(self, field: str):
+        ### Field views (results, ...): P, T, phase_fractions, zfactors, equicomp, K
+        n = len(self.components)
+        columns = {'P': 0, 'T': 1, 'phase_fractions': slice(2, 5), 'zfactors': slice(5, 8),
+                   'equicomp': slice(8, 8 + 3 * n), 'K': slice(8 + 3 * n, 8 + 5 * n)}[field]
+        values = self.table[:, columns]
+        if field in ('equicomp', 'K'):
+            ### Column-major (results, phases * n) is (results, n, phases) in Fortran order - no copy either way
+            values = values.reshape((len(self), n, -1), order='F').transpose(0, 2, 1)
+        return values
+
+    @property
+    def columns(self):
+        return get_result_columns(self.components)
+
+    def to_numpy(self):
+        ### The result table itself (results x columns), column-major
+        return self.table
+
+    def to_pandas(self):
+        ### Wide DataFrame over the table (the float block is the table's memory) plus convergence and iterations
+        df = pd.DataFrame(self.table, columns=self.columns, copy=False)
+        df['converged'] = self.converged
+        df['iterations'] = self.iterations
+        return df
+
+    def to_arrow(self):
+        ### Arrow table with one column per table column; float64 columns wrap the table's memory, the convergence
+        ### flags are bit-packed by Arrow (a copy)
+        if pa is None:
+            raise ImportError('pyarrow is required for Arrow export')
+        arrays = [pa.array(self.table[:, j]) for j in range(self.table.shape[1])]
+        arrays += [pa.array(self.converged), pa.array(self.iterations)]
+        return pa.Table.from_arrays(arrays, names=self.columns + ['converged', 'iterations'])
+
+
+def flash_result(compset: calc.ComponentSet,
+                 z: np.ndarray,
+                 P_field: float,
+                 T_field: float,
+                 convcrit,
+                 steps_limit,
+                 method: str = 'ss',
+                 stability_check: bool = False,
+                 warm_start: bool = False):
+    ### flash_PR_EOS_arr packed in a FlashResult
+    equicomp, phase_fractions, zfactors, iterations, K, converged = calc.flash_PR_EOS_arr(compset,
+                                                                                          z,
+                                                                                          P_field,
+                                                                                          T_field,
+                                                                                          convcrit,
+                                                                                          steps_limit,
+                                                                                          method,
+                                                                                          show_log=False,
+                                                                                          stability_check=stability_check,
+                                                                                          warm_start=warm_start,
+                                                                                          full_output=True)
+    return FlashResult(compset.names,
+                       pack_result(P_field, T_field, equicomp, phase_fractions, zfactors, K),
+                       converged,
+                       iterations)
+
+
+def flash_batch(compset: calc.ComponentSet,
+                z: np.ndarray,
+                P_field: np.ndarray,
+                T_field: np.ndarray,
+                convcrit,
+                steps_limit):
+    ### flash_grid_arr over flat arrays of conditions (field units, broadcast against each other) packed in a FlashBatch
+    P, T = np.broadcast_arrays(np.asarray(P_field, dtype=float).ravel(), np.asarray(T_field, dtype=float).ravel())
+    equicomp, phase_fractions, zfactors, converged, iterations, K = calc.flash_grid_arr(compset,
+                                                                                        z,
+                                                                                        P,
+                                                                                        T,
+                                                                                        convcrit,
+                                                                                        steps_limit,
+                                                                                        full_output=True)
+    table = np.empty((len(P), 8 + 5 * len(compset)), order='F')
+    table[:] = pack_result(P, T, equicomp, phase_fractions, zfactors, K)
+    return FlashBatch(compset.names, table, converged, iterations)
+
+
+class ResultSink:
+    def __init__(self,
+                 path: str,
+                 buffer_rows: int = 100000,
+                 append: bool = True):
+        self.path = path
+        self.format = get_format(path)
+        if self.format != 'csv' and pa is None:
+            raise ImportError('pyarrow is required to write {} files'.format(self.format))
+        self.buffer_rows = buffer_rows
+        self.buffer = {column: list() for column in COLUMNS}
+        self.buffered = 0
+        self.writer = None
+        append = append and self.format == 'csv' and os.path.exists(path) and os.path.getsize(path) > 0
+        self.mode = 'a' if append else 'w'
+        self.header = not append
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self,
+               case: str,
+               P_bar: float,
+               T_C: float,
+               components,
+               equicomp: np.ndarray,
+               phase_fractions: np.ndarray,
+               zfactors: np.ndarray,
+               MW: np.ndarray = None,
+               densities: np.ndarray = None):
+        ### Rows of one flash: equicomp (vapor, liquid, aqueous x components), phase fractions, z-factors and
+        ### optional MW and densities per phase in the same order; absent phases (NaN compositions) are skipped
+        components = list(components)
+        n = len(components)
+        for i, phase in enumerate(PHASES):
+            if np.isnan(equicomp[i]).all():
+                continue
+            self.buffer['case'].extend([case] * n)
+            self.buffer['P [bara]'].extend([P_bar] * n)
+            self.buffer['T [C]'].extend([T_C] * n)
+            self.buffer['phase'].extend([phase] * n)
+            self.buffer['component'].extend(components)
+            self.buffer['fraction [mol. fract.]'].extend(np.asarray(equicomp[i], dtype=float).tolist())
+            self.buffer['phase fraction [mol. fract.]'].extend([float(phase_fractions[i])] * n)
+            self.buffer['zj'].extend([float(zfactors[i])] * n)
+            self.buffer['MW [g/mole]'].extend([np.nan if MW is None else float(MW[i])] * n)
+            self.buffer['density [kg/m3]'].extend([np.nan if densities is None else float(densities[i])] * n)
+            self.buffered += n
+        if self.buffered >= self.buffer_rows:
+            self.flush()
+
+    def append_frames(self,
+                      case: str,
+                      P_bar: float,
+                      T_C: float,
+                      equicomp_df: pd.DataFrame,
+                      phase_fractions: pd.Series,
+                      zfactors: pd.DataFrame,
+                      MW: pd.Series = None,
+                      densities: pd.Series = None):
+        ### append() for the DataFrame/Series outputs of flash_calc_PR_EOS (phase properties indexed V, L, Q)
+        self.append(case,
+                    P_bar,
+                    T_C,
+                    equicomp_df.index,
+                    equicomp_df[list(PHASES)].to_numpy(dtype=float).T,
+                    phase_fractions[['V', 'L', 'Q']].to_numpy(dtype=float),
+                    zfactors['zj'].reindex(PHASES).to_numpy(dtype=float),
+                    None if MW is None else MW[['V', 'L', 'Q']].to_numpy(dtype=float),
+                    None if densities is None else densities[['V', 'L', 'Q']].to_numpy(dtype=float))
+
+    def flush(self):
+        if not self.buffered:
+            return
+        df = pd.DataFrame(self.buffer, columns=COLUMNS)
+        if self.format == 'csv':
+            df.to_csv(self.path, mode=self.mode, header=self.header, index=False)
+            self.mode = 'a'
+            self.header = False
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                if self.format == 'parquet':
+                    import pyarrow.parquet as pq
+                    self.writer = pq.ParquetWriter(self.path, table.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.path, table.schema)
+            self.writer.write_table(table)
+        self.buffer = {column: list() for column in COLUMNS}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
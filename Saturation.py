@@ -0,0 +1,291 @@
+from __future__ import annotations
+import math
+import numpy as np
+import Lazy as lazy
+import Calculations_v4 as calc
+import Instrumentation as instr
+pd = lazy.lazy_import('pandas')
+
+### Saturation points of many feeds of one component set at once: dew/bubble pressure at T, dew/bubble temperature at P,
+### water dew temperature and water content of the saturated gas
+### Feeds are rows of z (m, n), P and T are scalars or arrays over them, everything in field units
+### Dew and bubble points solve the n + 1 equations
+###     ln K_i + ln phi_i(y) - ln phi_i(x) = 0,    sum(y_i - x_i) = 0
+### with x = z / (1 - beta + beta * K), y = K * x (beta = 1 - dew point, y is the feed; beta = 0 - bubble point)
+### for ln K and ln P or ln T by Newton from Wilson estimates, all feeds in one vectorized iteration;
+### converged feeds drop out of the iteration. Each phase takes its cubic root with the lowest Gibbs energy.
+### Jacobian columns come from the analytic ln(phi) derivatives of get_lnphi_derivatives_arr
+### Dew and bubble points of a wet feed are those of the vapor-liquid problem; the hydrocarbon dew point is usually
+### taken on the water-free basis and the aqueous one from water_dew_temperature. Single-component feeds give NaN
+MAX_LNT_STEP = 0.1  # largest Newton change of ln T
+MAX_LNP_STEP = 0.5  # largest Newton change of ln P
+
+
+def get_saturation_equations(compset: calc.ComponentSet,
+                             z: np.ndarray,
+                             lnK: np.ndarray,
+                             T,
+                             P,
+                             beta,
+                             derivatives: tuple = ('T', 'P')):
+    ### Residuals F (..., n + 1) and Jacobian (..., n + 1, n + 2) of the saturation equations, Jacobian columns are
+    ### ln K (n), ln T and ln P; the T and P columns are filled only for the variables in derivatives
+    n = z.shape[-1]
+    T = np.asarray(T, dtype=float)
+    P = np.asarray(P, dtype=float)
+    beta = np.asarray(beta, dtype=float)[..., None]
+    K = np.exp(lnK)
+    denominator = 1 - beta + beta * K
+    x = z / denominator
+    y = K * x
+    dx_dlnK = -x * beta * K / denominator
+    dy_dlnK = y * (1 - beta) / denominator
+    x_sum = x.sum(axis=-1, keepdims=True)
+    y_sum = y.sum(axis=-1, keepdims=True)
+    phases = np.stack((y / y_sum, x / x_sum), axis=-2)
+    mixrule = calc.MixingRule(compset, T, cached='T' not in derivatives)
+    vapor = calc.get_lnphi_min_gibbs_arr(mixrule, phases, P)[2]
+    lnphi, dlnphi_dn, dlnphi_dT, dlnphi_dP, zj = calc.get_lnphi_derivatives_arr(mixrule,
+                                                                                phases,
+                                                                                P,
+                                                                                vapor,
+                                                                                ('n',) + tuple(derivatives))
+    lnphi_diff = lnphi[..., 0, :] - lnphi[..., 1, :]
+    F = np.concatenate((lnK + lnphi_diff, y_sum - x_sum), axis=-1)
+    J = np.zeros(z.shape[:-1] + (n + 1, n + 2))
+    J[..., :n, :n] = np.eye(n) + dlnphi_dn[..., 0, :, :] / y_sum[..., None] * dy_dlnK[..., None, :] \
+                     - dlnphi_dn[..., 1, :, :] / x_sum[..., None] * dx_dlnK[..., None, :]
+    J[..., n, :n] = dy_dlnK - dx_dlnK
+    if 'T' in derivatives:
+        J[..., :n, n] = (dlnphi_dT[..., 0, :] - dlnphi_dT[..., 1, :]) * T[..., None]
+    if 'P' in derivatives:
+        J[..., :n, n + 1] = (dlnphi_dP[..., 0, :] - dlnphi_dP[..., 1, :]) * P[..., None]
+    return F, J
+
+
+def get_wilson_saturation_T(compset: calc.ComponentSet,
+                            z: np.ndarray,
+                            P,
+                            beta):
+    ### Saturation temperature of the Wilson K-values by bisection in ln T: sum(y_i - x_i) = 0 at vapor fraction beta
+    P = np.asarray(P, dtype=float)[..., None]
+    beta = np.asarray(beta, dtype=float)[..., None]
+    lnT_min = np.full(np.broadcast(z[..., 0], P[..., 0]).shape, math.log(50))
+    lnT_max = np.full_like(lnT_min, math.log(5000))
+    for i in range(60):
+        lnT = (lnT_min + lnT_max) / 2
+        K = calc.get_initial_Kvalues_arr(compset, P, np.exp(lnT)[..., None])
+        too_hot = np.sum(z * (K - 1) / (1 - beta + beta * K), axis=-1) > 0
+        lnT_max = np.where(too_hot, lnT, lnT_max)
+        lnT_min = np.where(too_hot, lnT_min, lnT)
+    return np.exp((lnT_min + lnT_max) / 2)
+
+
+def get_wilson_saturation_P(compset: calc.ComponentSet,
+                            z: np.ndarray,
+                            T,
+                            beta):
+    ### Bubble (beta = 0) or dew (beta = 1) pressure of the Wilson K-values, closed form
+    Psat = compset.Pc * np.exp(5.37 * (1 + compset.w) * (1 - compset.Tc / np.asarray(T, dtype=float)[..., None]))
+    return np.where(np.asarray(beta) == 0, np.sum(z * Psat, axis=-1), 1 / np.sum(z / Psat, axis=-1))
+
+
+def solve_saturation(compset: calc.ComponentSet,
+                     z: np.ndarray,
+                     T,
+                     P,
+                     beta,
+                     variable: str,
+                     K: np.ndarray = None,
+                     max_iter: int = 30,
+                     tol: float = 10 ** -10):
+    ### Newton on the saturation equations for ln K and ln T (variable = 'T', P fixed) or ln P (variable = 'P', T fixed)
+    ### T and P - fixed value and initial estimate of the solved one; K - initial K-values, Wilson by default
+    ### Returns the solved T or P (NaN where not converged or trivial), K-values, convergence flags and iterations
+    z = np.atleast_2d(np.asarray(z, dtype=float))
+    m, n = z.shape
+    T = np.broadcast_to(np.asarray(T, dtype=float), (m,)).copy()
+    P = np.broadcast_to(np.asarray(P, dtype=float), (m,)).copy()
+    beta = np.broadcast_to(np.asarray(beta, dtype=float), (m,))
+    if K is None:
+        K = calc.get_initial_Kvalues_arr(compset, P[:, None], T[:, None])
+    lnK = np.log(np.broadcast_to(K, (m, n))).copy()
+    column, max_step = (n, MAX_LNT_STEP) if variable == 'T' else (n + 1, MAX_LNP_STEP)
+    converged = np.zeros(m, dtype=bool)
+    iterations = np.zeros(m, dtype=int)
+    active = np.ones(m, dtype=bool)
+    present = z > 0
+    for iteration in range(1, max_iter + 1):
+        rows = np.flatnonzero(active)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            F, J = get_saturation_equations(compset, z[rows], lnK[rows], T[rows], P[rows], beta[rows], (variable,))
+        J = np.concatenate((J[..., :n], J[..., column:column + 1]), axis=-1)
+        finite = np.isfinite(F).all(axis=-1) & np.isfinite(J).all(axis=(-2, -1))
+        dX = np.zeros((len(rows), n + 1))
+        try:
+            dX[finite] = np.linalg.solve(J[finite], -F[finite][..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            ### A singular row fails the batch solve, rows are solved one by one then
+            for i in np.flatnonzero(finite):
+                try:
+                    dX[i] = np.linalg.solve(J[i], -F[i])
+                except np.linalg.LinAlgError:
+                    finite[i] = False
+        dX = dX * np.minimum(1, max_step / np.maximum(np.abs(dX[:, n]), 10 ** -300))[:, None]
+        lnK[rows] += dX[:, :n]
+        if variable == 'T':
+            T[rows] *= np.exp(dX[:, n])
+        else:
+            P[rows] *= np.exp(dX[:, n])
+        iterations[rows] = iteration
+        trivial = (np.abs(np.where(present[rows], lnK[rows], 0)).max(axis=-1) < 10 ** -4)
+        done = np.abs(dX).max(axis=-1) < tol
+        converged[rows] = done & finite & ~trivial
+        active[rows] = ~(done | ~finite | trivial)
+        if not active.any():
+            break
+    instr.profiler.count('saturation iterations', int(iterations.sum()))
+    value = np.where(converged, T if variable == 'T' else P, np.nan)
+    return value, np.exp(lnK), converged, iterations
+
+
+@instr.profiled('saturation')
+def dew_pressure(compset: calc.ComponentSet,
+                 z: np.ndarray,
+                 T,
+                 K: np.ndarray = None):
+    ### Dew point pressure at temperature T; of the two dew pressures of a retrograde feed the one nearest
+    ### to the Wilson estimate (normally the lower one) is found
+    z = np.atleast_2d(np.asarray(z, dtype=float))
+    return solve_saturation(compset, z, T, get_wilson_saturation_P(compset, z, T, 1), 1, 'P', K)
+
+
+@instr.profiled('saturation')
+def bubble_pressure(compset: calc.ComponentSet,
+                    z: np.ndarray,
+                    T,
+                    K: np.ndarray = None):
+    z = np.atleast_2d(np.asarray(z, dtype=float))
+    return solve_saturation(compset, z, T, get_wilson_saturation_P(compset, z, T, 0), 0, 'P', K)
+
+
+@instr.profiled('saturation')
+def dew_temperature(compset: calc.ComponentSet,
+                    z: np.ndarray,
+                    P,
+                    K: np.ndarray = None):
+    z = np.atleast_2d(np.asarray(z, dtype=float))
+    return solve_saturation(compset, z, get_wilson_saturation_T(compset, z, P, 1), P, 1, 'T', K)
+
+
+@instr.profiled('saturation')
+def bubble_temperature(compset: calc.ComponentSet,
+                       z: np.ndarray,
+                       P,
+                       K: np.ndarray = None):
+    z = np.atleast_2d(np.asarray(z, dtype=float))
+    return solve_saturation(compset, z, get_wilson_saturation_T(compset, z, P, 0), P, 0, 'T', K)
+
+
+@instr.profiled('saturation')
+def water_dew_temperature(compset: calc.ComponentSet,
+                          z: np.ndarray,
+                          P):
+    ### Temperature at which an aqueous phase first condenses from the gas at pressure P, NaN for feeds without water
+    ### Starts from the Wilson water saturation temperature and an incipient phase of almost pure water
+    ### (K = 1e5 for the other components; Wilson K's of heavy hydrocarbons would lead to the hydrocarbon dew point)
+    z = np.atleast_2d(np.asarray(z, dtype=float))
+    m, n = z.shape
+    w = compset.water_index
+    T_dew = np.full(m, np.nan)
+    K = np.full((m, n), np.nan)
+    converged = np.zeros(m, dtype=bool)
+    iterations = np.zeros(m, dtype=int)
+    rows = np.flatnonzero(z[:, w] > 0) if w is not None else np.arange(0)
+    if not len(rows):
+        return T_dew, K, converged, iterations
+    P = np.broadcast_to(np.asarray(P, dtype=float), (m,))[rows]
+    T = compset.Tc[w] / (1 - (np.log(z[rows, w]) - np.log(compset.Pc[w] / P)) / (5.37 * (1 + compset.w[w])))
+    K0 = np.where(np.arange(n) == w, z[rows, w][:, None], 10 ** 5)
+    T_dew[rows], K[rows], converged[rows], iterations[rows] = solve_saturation(compset, z[rows], T, P, 1, 'T', K0)
+    ### A hydrocarbon liquid found instead of the aqueous one is not the water dew point
+    aqueous = K[:, w] < np.delete(K, w, axis=-1).min(axis=-1)
+    return np.where(aqueous, T_dew, np.nan), K, converged & aqueous, iterations
+
+
+@instr.profiled('saturation')
+def water_saturation(compset: calc.ComponentSet,
+                     z: np.ndarray,
+                     P,
+                     T,
+                     max_iter: int = 50,
+                     tol: float = 10 ** -12):
+    ### Water mole fraction of the gas saturated with water at P and T, for the dry part of the feeds z
+    ### Successive substitution on the aqueous phase in equilibrium with the gas: with r_i = phi_i(gas) / phi_i(aqueous)
+    ### sum(x_i) = y_w * r_w + (1 - y_w) * sum(dry_i * r_i) = 1 gives the water fraction y_w in closed form
+    ### Returns the water fraction (NaN where water does not condense at P and T), convergence flags and iterations
+    z = np.atleast_2d(np.asarray(z, dtype=float))
+    m, n = z.shape
+    w = compset.water_index
+    if w is None:
+        return np.full(m, np.nan), np.zeros(m, dtype=bool), np.zeros(m, dtype=int)
+    water = np.arange(n) == w
+    dry = np.where(water, 0, z)
+    dry = dry / dry.sum(axis=-1, keepdims=True)
+    P = np.broadcast_to(np.asarray(P, dtype=float), (m,))
+    T = np.broadcast_to(np.asarray(T, dtype=float), (m,))
+    mixrule = calc.MixingRule(compset, T)
+    y_w = np.clip(calc.get_initial_Kvalues_arr(compset, P[:, None], T[:, None])[:, w], 0, 1)
+    x = np.broadcast_to(np.where(water, 1.0, 0.0), (m, n))
+    converged = np.zeros(m, dtype=bool)
+    iterations = np.zeros(m, dtype=int)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for iteration in range(1, max_iter + 1):
+            y = dry * (1 - y_w)[:, None] + water * y_w[:, None]
+            lnphi, zj, vapor = calc.get_lnphi_min_gibbs_arr(mixrule, np.stack((y, x), axis=-2), P)
+            r = np.exp(lnphi[:, 0, :] - lnphi[:, 1, :])
+            a = r[:, w]
+            b = np.sum(dry * r, axis=-1)
+            y_w_new = np.where(converged, y_w, (1 - b) / (a - b))
+            x = y * r
+            x = x / x.sum(axis=-1, keepdims=True)
+            iterations = np.where(converged, iterations, iteration)
+            converged = converged | (np.abs(y_w_new - y_w) < tol)
+            y_w = np.clip(y_w_new, 0, 1)
+            if converged.all():
+                break
+    valid = converged & (y_w > 0) & (y_w < 1)
+    return np.where(valid, y_w, np.nan), valid, iterations
+
+
+def get_saturation_table(comppropDB: pd.DataFrame,
+                         binarycoefDB: pd.DataFrame,
+                         streamcomps: dict,
+                         P_bara: float,
+                         T_C: float):
+    ### Saturation points of stream compositions {name: input_streamcomp} in [bara] and [C]:
+    ### hydrocarbon dew/bubble pressures at T_C and dew/bubble temperatures at P_bara (water-free basis),
+    ### water dew temperature at P_bara and the water content of the gas saturated at P_bara and T_C
+    ### Streams with the same components are solved as one batch
+    P = calc.UnitsConverter.Pressure.bar_to_psi(P_bara)
+    T = calc.UnitsConverter.Temperature.C_to_R(T_C)
+    groups = dict()
+    for name, streamcomp in streamcomps.items():
+        groups.setdefault(tuple(streamcomp.index), list()).append(name)
+    table = list()
+    for components, names in groups.items():
+        compset = calc.ComponentSet(comppropDB, binarycoefDB, components)
+        z = np.array([streamcomps[name]['Content [mol. fract.]'].to_numpy(dtype=float) for name in names])
+        dry = z.copy()
+        if compset.water_index is not None:
+            dry[:, compset.water_index] = 0
+        with np.errstate(invalid='ignore'):
+            dry = dry / dry.sum(axis=-1, keepdims=True)
+        columns = {'dew P [bara]': calc.UnitsConverter.Pressure.psi_to_kPa(dew_pressure(compset, dry, T)[0]) / 100,
+                   'bubble P [bara]': calc.UnitsConverter.Pressure.psi_to_kPa(bubble_pressure(compset, dry, T)[0]) / 100,
+                   'dew T [C]': calc.UnitsConverter.Temperature.R_to_C(dew_temperature(compset, dry, P)[0]),
+                   'bubble T [C]': calc.UnitsConverter.Temperature.R_to_C(bubble_temperature(compset, dry, P)[0]),
+                   'water dew T [C]': calc.UnitsConverter.Temperature.R_to_C(water_dew_temperature(compset, z, P)[0]),
+                   'water content [mol. fract.]': water_saturation(compset, z, P, T)[0]}
+        table.append(pd.DataFrame(columns, index=names))
+    return pd.concat(table).reindex(list(streamcomps))
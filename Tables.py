@@ -0,0 +1,243 @@
+from __future__ import annotations
+import json
+import numpy as np
+import Lazy as lazy
+import Calculations_v4 as calc
+import Properties as prop
+import Instrumentation as instr
+pd = lazy.lazy_import('pandas')
+
+### Interpolating flash lookup tables of one stream composition over P [bara] and T [C]
+### Values sit on a rectilinear mesh with nonuniform axes: phase fractions, z-factors, phase densities (vapor, liquid,
+### aqueous), mixture density and phase compositions; any number of points is interpolated bilinearly at once
+### The mesh starts from a coarse grid; a line is inserted through the cells whose bilinear value at the centre misses
+### the flash there by more than the tolerances, worst cells first and a capped number of lines per pass, so the lines
+### gather at the phase boundaries
+### Error bound of a cell is twice the largest deviation at the centres of the cell and its neighbours on the final mesh
+### (centre deviations alone understate the error next to the phase boundaries); NaN where a phase is absent
+### Tables are stored as .npz: the arrays plus a JSON header with components, feed and settings
+FIELDS = ('phase fractions', 'zfactors', 'densities', 'density mix', 'compositions')
+PHASES = ('vapor', 'liquid', 'aqueous')
+convcrit = 10 ** -6
+steps_limit = 100
+
+
+def get_flash_values(compset: calc.ComponentSet,
+                     propset: prop.PropertySet,
+                     z: np.ndarray,
+                     P_bara: np.ndarray,
+                     T_C: np.ndarray,
+                     densities: bool = True):
+    ### Table fields at the points (P_bara, T_C); densities with Properties.get_phase_properties_arr
+    P_field = calc.UnitsConverter.Pressure.bar_to_psi(P_bara)
+    T_field = calc.UnitsConverter.Temperature.C_to_R(T_C)
+    equicomp, phase_fractions, zfactors, converged, iterations = calc.flash_grid_arr(compset,
+                                                                                     z,
+                                                                                     P_field,
+                                                                                     T_field,
+                                                                                     convcrit,
+                                                                                     steps_limit)
+    values = {'phase fractions': phase_fractions,
+              'zfactors': zfactors,
+              'compositions': equicomp}
+    if densities:
+        properties = prop.get_phase_properties_arr(propset, equicomp, phase_fractions, zfactors, P_field, T_field)
+        values['densities'] = properties['densities']
+        values['density mix'] = properties['density mix']
+    return values
+
+
+def get_centre_errors(values: dict,
+                      centre_values: dict,
+                      fields=FIELDS):
+    ### Deviation of the bilinear value at the cell centres (mean of the corners) from the flash there,
+    ### per field with components reduced to the largest deviation per phase
+    errors = dict()
+    for field in fields:
+        grid = values[field]
+        interpolated = (grid[:-1, :-1] + grid[1:, :-1] + grid[:-1, 1:] + grid[1:, 1:]) / 4
+        error = np.abs(interpolated - centre_values[field].reshape(interpolated.shape))
+        errors[field] = error.max(axis=-1) if field == 'compositions' else error
+    return errors
+
+
+def get_error_bounds(errors: dict):
+    ### Twice the largest centre deviation over each cell and its neighbours
+    bounds = dict()
+    for field, error in errors.items():
+        padded = np.pad(error, ((1, 1), (1, 1)) + ((0, 0),) * (error.ndim - 2), constant_values=np.nan)
+        bound = error
+        for di in (0, 1, 2):
+            for dj in (0, 1, 2):
+                bound = np.fmax(bound, padded[di:di + error.shape[0], dj:dj + error.shape[1]])
+        bounds[field] = 2 * bound
+    return bounds
+
+
+class FlashTable:
+    def __init__(self,
+                 components,
+                 z: np.ndarray,
+                 P_axis: np.ndarray,
+                 T_axis: np.ndarray,
+                 values: dict,
+                 errors: dict,
+                 settings: dict = None):
+        self.components = list(components)
+        self.z = np.asarray(z, dtype=float)
+        self.P_axis = np.asarray(P_axis, dtype=float)  # [bara]
+        self.T_axis = np.asarray(T_axis, dtype=float)  # [C]
+        self.values = values  # field: (P points, T points, ...)
+        self.errors = errors  # field: (P cells, T cells, ...)
+        self.settings = settings or dict()
+
+    @property
+    def shape(self):
+        return len(self.P_axis), len(self.T_axis)
+
+    def query(self,
+              P_bara,
+              T_C,
+              fields=FIELDS):
+        ### Bilinear interpolation at the points (P_bara, T_C) of any matching shapes
+        ### Returns values and error bounds by field; NaN outside the table
+        P, T = np.broadcast_arrays(np.asarray(P_bara, dtype=float), np.asarray(T_C, dtype=float))
+        i = np.clip(np.searchsorted(self.P_axis, P, side='right') - 1, 0, len(self.P_axis) - 2)
+        j = np.clip(np.searchsorted(self.T_axis, T, side='right') - 1, 0, len(self.T_axis) - 2)
+        u = (P - self.P_axis[i]) / (self.P_axis[i + 1] - self.P_axis[i])
+        v = (T - self.T_axis[j]) / (self.T_axis[j + 1] - self.T_axis[j])
+        outside = (u < 0) | (u > 1) | (v < 0) | (v > 1)
+        values = dict()
+        errors = dict()
+        for field in fields:
+            grid = self.values[field]
+            tail = (None,) * (grid.ndim - 2)
+            uu = u[(...,) + tail]
+            vv = v[(...,) + tail]
+            value = (1 - uu) * (1 - vv) * grid[i, j] + uu * (1 - vv) * grid[i + 1, j] \
+                    + (1 - uu) * vv * grid[i, j + 1] + uu * vv * grid[i + 1, j + 1]
+            error = self.errors[field][i, j]
+            values[field] = np.where(outside[(...,) + tail], np.nan, value)
+            errors[field] = np.where(outside[(...,) + (None,) * (error.ndim - outside.ndim)], np.nan, error)
+        return values, errors
+
+    def save(self, path: str):
+        header = {'components': self.components,
+                  'z': self.z.tolist(),
+                  'settings': self.settings}
+        arrays = {'P_axis': self.P_axis, 'T_axis': self.T_axis}
+        for field in FIELDS:
+            arrays['values/' + field] = self.values[field]
+            arrays['errors/' + field] = self.errors[field]
+        np.savez_compressed(path, header=np.array(json.dumps(header)), **arrays)
+
+
+def load_table(path: str):
+    with np.load(path) as data:
+        header = json.loads(str(data['header']))
+        return FlashTable(header['components'],
+                          header['z'],
+                          data['P_axis'],
+                          data['T_axis'],
+                          {field: data['values/' + field] for field in FIELDS},
+                          {field: data['errors/' + field] for field in FIELDS},
+                          header['settings'])
+
+
+def select_lines(centres: np.ndarray,
+                 scores: np.ndarray,
+                 max_lines: int):
+    ### Centres of at most max_lines cells with the highest positive scores (worst tolerance ratio across the axis),
+    ### sorted; returns the centres and the number of wanted lines that were left out
+    wanted = np.flatnonzero(scores > 0)
+    chosen = wanted[np.argsort(-scores[wanted], kind='stable')[:max(max_lines, 0)]]
+    return np.sort(centres[chosen]), len(wanted) - len(chosen)
+
+
+@instr.profiled('flash table')
+def build_table(comppropDB: pd.DataFrame,
+                binarycoefDB: pd.DataFrame,
+                input_streamcomp: pd.DataFrame,
+                P_range: tuple,
+                T_range: tuple,
+                P_points: int = 9,
+                T_points: int = 9,
+                tol_fraction: float = 10 ** -3,
+                tol_zfactor: float = 10 ** -3,
+                max_levels: int = 6,
+                max_axis_points: int = 65,
+                max_lines_per_pass: int = 12,
+                show_log: bool = False):
+    ### Table over P_range [bara] x T_range [C] starting from P_points x T_points; cells are refined until the
+    ### phase fractions and z-factors at their centres are within tol_fraction / tol_zfactor of the flash,
+    ### for at most max_levels passes and max_axis_points lines per axis
+    ### A line runs through the whole mesh, so a three-phase boundary that cuts many cells would make the mesh grow
+    ### with the square of the lines; each pass inserts at most max_lines_per_pass lines per axis, through the cells
+    ### furthest off the tolerances first. Cells still off the tolerances when a cap stops the refinement are logged
+    ### and counted in settings['unresolved cells'] (their error bounds stay as computed)
+    compset = calc.ComponentSet(comppropDB, binarycoefDB, input_streamcomp.index)
+    propset = prop.PropertySet(comppropDB, compset.names)
+    z = input_streamcomp['Content [mol. fract.]'].to_numpy(dtype=float)
+    P_axis = np.linspace(P_range[0], P_range[1], P_points)
+    T_axis = np.linspace(T_range[0], T_range[1], T_points)
+
+    def flash(P_axis, T_axis, densities=False, known=None):
+        ### Values on the mesh P_axis x T_axis; known - (values, P_axis, T_axis) of a coarser mesh of the same lines,
+        ### only the points off its lines are flashed
+        P, T = np.meshgrid(P_axis, T_axis, indexing='ij')
+        missing = np.ones(P.shape, dtype=bool)
+        if known is not None:
+            old_values, old_P, old_T = known
+            rows = np.searchsorted(P_axis, old_P)
+            columns = np.searchsorted(T_axis, old_T)
+            missing[np.ix_(rows, columns)] = False
+        new_values = get_flash_values(compset, propset, z, P[missing], T[missing], densities)
+        values = dict()
+        for field, value in new_values.items():
+            values[field] = np.empty(P.shape + value.shape[1:])
+            values[field][missing] = value
+            if known is not None:
+                values[field][np.ix_(rows, columns)] = old_values[field]
+        return values
+
+    def get_scores(errors):
+        ### Largest ratio of the centre deviation to its tolerance per cell, 0 for cells within the tolerances
+        ratio = np.fmax(errors['phase fractions'].max(axis=-1) / tol_fraction,
+                        np.nan_to_num(errors['zfactors']).max(axis=-1) / tol_zfactor)
+        return np.where(ratio > 1, ratio, 0)
+
+    values = flash(P_axis, T_axis)
+    capped = False
+    for level in range(max_levels):
+        P_centres = (P_axis[:-1] + P_axis[1:]) / 2
+        T_centres = (T_axis[:-1] + T_axis[1:]) / 2
+        scores = get_scores(get_centre_errors(values, flash(P_centres, T_centres), ('phase fractions', 'zfactors')))
+        if show_log:
+            instr.logger.info('Flash table level %d: %d x %d points, %d cells to refine',
+                              level, len(P_axis), len(T_axis), np.count_nonzero(scores))
+        if not scores.any():
+            break
+        new_P, skipped_P = select_lines(P_centres, scores.max(axis=1),
+                                        min(max_lines_per_pass, max_axis_points - len(P_axis)))
+        new_T, skipped_T = select_lines(T_centres, scores.max(axis=0),
+                                        min(max_lines_per_pass, max_axis_points - len(T_axis)))
+        capped = capped or skipped_P > 0 or skipped_T > 0
+        if not len(new_P) and not len(new_T):
+            break
+        known = (values, P_axis, T_axis)
+        P_axis = np.sort(np.concatenate((P_axis, new_P)))
+        T_axis = np.sort(np.concatenate((T_axis, new_T)))
+        values = flash(P_axis, T_axis, known=known)
+    values = flash(P_axis, T_axis, densities=True)
+    P_centres = (P_axis[:-1] + P_axis[1:]) / 2
+    T_centres = (T_axis[:-1] + T_axis[1:]) / 2
+    centre_errors = get_centre_errors(values, flash(P_centres, T_centres, densities=True))
+    unresolved = int(np.count_nonzero(get_scores(centre_errors)))
+    if unresolved:
+        instr.logger.warning('Flash table: %d of %d cells above the tolerances on the final %d x %d mesh (%s)',
+                             unresolved, (len(P_axis) - 1) * (len(T_axis) - 1), len(P_axis), len(T_axis),
+                             'line caps reached' if capped else 'max_levels reached')
+    errors = get_error_bounds(centre_errors)
+    settings = {'tol_fraction': tol_fraction, 'tol_zfactor': tol_zfactor, 'convcrit': convcrit,
+                'unresolved cells': unresolved}
+    return FlashTable(compset.names, z, P_axis, T_axis, values, errors, settings)
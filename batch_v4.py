@@ -0,0 +1,502 @@
+from __future__ import annotations
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+import itertools
+from collections import deque
+import numpy as np
+import Lazy as lazy
+import Interfaces as intrf
+import Calculations_v4 as calc
+import Database as db
+import Properties as prop
+import Results as res
+import Instrumentation as instr
+pd = lazy.lazy_import('pandas')
+futures_process = lazy.lazy_import('concurrent.futures.process')  # parallel runs only
+
+### Non-interactive flash runner
+### Case table (CSV or JSONL) rows: 'stream' - stream composition xlsx (relative to the case file),
+### 'P [bara]', 'T [C]' and an optional 'case' name; e.g.
+###     case,stream,P [bara],T [C]
+###     sep-1,Stream4 (Tarasov) - StreamComposition.xlsx,50,0
+### Databases are loaded once, each stream file once; results are written per case as soon as it is flashed,
+### so memory does not grow with the number of cases
+### Usage: python batch_v4.py cases.csv results.jsonl [--workers 8]
+convcrit = 10 ** -4
+steps_limit = 50
+METHODS = ('ss', 'accelerated')
+PHASES = ('vapor', 'liquid', 'aqueous')
+SUMMARY_FIELDS = ['case', 'stream', 'P [bara]', 'T [C]',
+                  'V', 'L', 'Q', 'zj vapor', 'zj liquid', 'zj aqueous',
+                  'iterations', 'converged', 'time [ms]', 'error']
+
+
+def read_cases(cases_path: str):
+    ### Yields case dicts one by one, the table is never loaded whole
+    with open(cases_path, newline='') as file:
+        if cases_path.endswith('.jsonl'):
+            rows = (json.loads(line) for line in file if line.strip())
+        else:
+            rows = csv.DictReader(file)
+        for number, row in enumerate(rows):
+            yield {'case': row.get('case') or str(number + 1),
+                   'stream': row['stream'],
+                   'P [bara]': float(row['P [bara]']),
+                   'T [C]': float(row['T [C]'])}
+
+
+class StreamCache:
+    ### Stream compositions and component sets by file path, read from Excel once per file;
+    ### component sets of inline compositions ({component: fraction}) by component names
+    def __init__(self,
+                 comppropDB: pd.DataFrame,
+                 binarycoefDB: pd.DataFrame,
+                 directory: str):
+        self.comppropDB = comppropDB
+        self.binarycoefDB = binarycoefDB
+        self.directory = directory
+        self.streams = dict()
+        self.compsets = dict()
+
+    def get(self, stream: str):
+        path = os.path.join(self.directory, stream)
+        if path not in self.streams:
+            input_streamcomp = pd.read_excel(path, index_col='Name')
+            compset = calc.ComponentSet(self.comppropDB, self.binarycoefDB, input_streamcomp.index)
+            z = input_streamcomp['Content [mol. fract.]'].to_numpy(dtype=float)
+            self.streams[path] = (compset, z)
+        return self.streams[path]
+
+    def get_composition(self, composition: dict):
+        names = tuple(composition)
+        if names not in self.compsets:
+            self.compsets[names] = calc.ComponentSet(self.comppropDB, self.binarycoefDB, names)
+        return self.compsets[names], np.array([composition[name] for name in names], dtype=float)
+
+    def get_case(self, case: dict):
+        if 'composition' in case:
+            return self.get_composition(case['composition'])
+        return self.get(case['stream'])
+
+
+def flash_case(case: dict,
+               streams: StreamCache,
+               method: str = 'ss',
+               stability_check: bool = False,
+               warm_start: bool = False):
+    ### Flash of one case (stream file or inline composition, P [bara], T [C])
+    ### Returns the component set, conditions in field units and the flash_PR_EOS_arr results with the convergence flag
+    P_bar, T_C = float(case['P [bara]']), float(case['T [C]'])
+    ### The solver takes any number, an unphysical condition would come back as a normal-looking result
+    if not P_bar > 0:
+        raise ValueError('P [bara] must be above 0, got {}'.format(case['P [bara]']))
+    if not T_C > -273.15:
+        raise ValueError('T [C] must be above -273.15, got {}'.format(case['T [C]']))
+    ### flash_PR_EOS_arr runs the successive substitution for any other method string
+    if method not in METHODS:
+        raise ValueError('method must be one of {}, got {}'.format(', '.join(METHODS), method))
+    compset, z = streams.get_case(case)
+    P_field = calc.UnitsConverter.Pressure.kPa_to_psi(calc.UnitsConverter.Pressure.bar_to_kPa(P_bar))
+    T_field = calc.UnitsConverter.Temperature.C_to_R(T_C)
+    equicomp, phase_fractions, zfactors, iterations, K, converged = calc.flash_PR_EOS_arr(
+        compset,
+        z,
+        P_field,
+        T_field,
+        convcrit,
+        steps_limit,
+        method,
+        show_log=instr.logger.isEnabledFor(logging.INFO),
+        stability_check=stability_check,
+        warm_start=warm_start,
+        full_output=True)
+    return compset, P_field, T_field, equicomp, phase_fractions, zfactors, iterations, converged
+
+
+def get_record(case: dict,
+               compset,
+               equicomp: np.ndarray,
+               phase_fractions: np.ndarray,
+               zfactors: np.ndarray,
+               iterations: int,
+               converged: bool):
+    ### A case that hits steps_limit keeps its last iterate with converged = False, it is not an error
+    record = dict(case)
+    record.update(zip(('V', 'L', 'Q'), phase_fractions.tolist()))
+    record.update(zip(('zj vapor', 'zj liquid', 'zj aqueous'), zfactors.tolist()))
+    record['iterations'] = iterations
+    record['converged'] = converged
+    record['components'] = list(compset.names)
+    record['compositions'] = {phase: dict(zip(compset.names, equicomp[i].tolist()))
+                              for i, phase in enumerate(PHASES) if not np.isnan(equicomp[i]).all()}
+    return record
+
+
+def run_case(case: dict,
+             streams: StreamCache,
+             method: str = 'ss',
+             stability_check: bool = False,
+             warm_start: bool = False):
+    ### Flash of one case; a failed case gives a record with the error message instead of stopping the batch
+    start_time = time.perf_counter()
+    record = dict(case)
+    try:
+        compset, P_field, T_field, equicomp, phase_fractions, zfactors, iterations, converged = flash_case(
+            case,
+            streams,
+            method,
+            stability_check,
+            warm_start)
+    except Exception as error:
+        record['error'] = '{}: {}'.format(type(error).__name__, error)
+        return record
+    record = get_record(case, compset, equicomp, phase_fractions, zfactors, iterations, converged)
+    record['time [ms]'] = (time.perf_counter() - start_time) * 1000
+    record['error'] = ''
+    return record
+
+
+class JSONLWriter:
+    ### Full records with phase compositions, one JSON object per line
+    def __init__(self, output_path: str):
+        self.file = open(output_path, 'w')
+
+    def write(self, record: dict):
+        ### NaN (absent phase) is written as null
+        record = {key: None if isinstance(value, float) and np.isnan(value) else value for key, value in record.items()}
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVWriter:
+    ### Summary rows (phase fractions, z-factors, iterations), one per case
+    def __init__(self, output_path: str):
+        self.file = open(output_path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=SUMMARY_FIELDS, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, record: dict):
+        self.writer.writerow(record)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class LongTableWriter:
+    ### Phase and component rows of Results.ResultSink, buffered; failed cases are left out of the table
+    ### Phase MW and densities are computed here from the record, property constants are kept per component set
+    ### A record without any phase composition gives no rows
+    def __init__(self,
+                 output_path: str,
+                 comppropDB: pd.DataFrame):
+        self.sink = res.ResultSink(output_path, append=False)
+        self.comppropDB = comppropDB
+        self.propsets = dict()
+
+    def write(self, record: dict):
+        if record['error']:
+            return
+        compositions = record['compositions']
+        components = record['components']
+        equicomp = np.array([[compositions[phase][component] for component in components]
+                             if phase in compositions else [np.nan] * len(components) for phase in PHASES])
+        phase_fractions = np.array([record['V'], record['L'], record['Q']], dtype=float)
+        zfactors = np.array([record['zj vapor'], record['zj liquid'], record['zj aqueous']], dtype=float)
+        propset = self.propsets.get(tuple(components))
+        if propset is None:
+            propset = self.propsets[tuple(components)] = prop.PropertySet(self.comppropDB, components)
+        P_field = calc.UnitsConverter.Pressure.kPa_to_psi(calc.UnitsConverter.Pressure.bar_to_kPa(float(record['P [bara]'])))
+        T_field = calc.UnitsConverter.Temperature.C_to_R(float(record['T [C]']))
+        properties = prop.get_phase_properties_arr(propset, equicomp, phase_fractions, zfactors, P_field, T_field)
+        self.sink.append(record['case'],
+                         record['P [bara]'],
+                         record['T [C]'],
+                         components,
+                         equicomp,
+                         phase_fractions,
+                         zfactors,
+                         properties['MW'],
+                         properties['densities'])
+
+    def close(self):
+        self.sink.close()
+
+
+def get_writer(output_path: str,
+               comppropDB: pd.DataFrame,
+               long_format: bool = False):
+    ### .jsonl - full records, .parquet/.arrow/.feather or long_format - long table, otherwise CSV summary
+    if output_path.endswith('.jsonl'):
+        return JSONLWriter(output_path)
+    if long_format or res.get_format(output_path) != 'csv':
+        return LongTableWriter(output_path, comppropDB)
+    return CSVWriter(output_path)
+
+
+def run_batch(cases_path: str,
+              output_path: str,
+              comppropDB: pd.DataFrame,
+              binarycoefDB: pd.DataFrame,
+              method: str = 'ss',
+              stability_check: bool = False,
+              show_log: bool = True,
+              long_format: bool = False,
+              warm_start: bool = False):
+    ### Flashes every case of the table in order and streams the records to output_path (see get_writer)
+    ### Returns the number of cases, the number of failed ones and the number of cases that did not converge
+    streams = StreamCache(comppropDB, binarycoefDB, os.path.dirname(os.path.abspath(cases_path)))
+    cases_num = 0
+    failed_num = 0
+    unconverged_num = 0
+    start_time = time.perf_counter()
+    writer = get_writer(output_path, comppropDB, long_format)
+    try:
+        for case in read_cases(cases_path):
+            record = run_case(case, streams, method, stability_check, warm_start)
+            writer.write(record)
+            cases_num += 1
+            if record['error']:
+                failed_num += 1
+                if show_log:
+                    print('Case {} failed - {}'.format(case['case'], record['error']))
+            elif not record['converged']:
+                unconverged_num += 1
+                if show_log:
+                    print('Case {} not converged in {} iterations'.format(case['case'], record['iterations']))
+    finally:
+        writer.close()
+    if show_log:
+        print('{} cases ({} failed, {} not converged) in {:.1f} s'.format(cases_num,
+                                                                          failed_num,
+                                                                          unconverged_num,
+                                                                          time.perf_counter() - start_time))
+    return cases_num, failed_num, unconverged_num
+
+
+### Process pool driver
+### Each worker loads the databases once in the pool initializer (memory-mapped binary cache, shared through
+### the page cache) and keeps its own stream cache; cases go to the workers in chunks and come back in input order.
+### Only a bounded number of chunks is in flight, so memory stays flat for any table length.
+worker_state = dict()
+
+
+def init_worker(comppropDB_path: str,
+                binarycoefDB_path: str,
+                directory: str,
+                method: str,
+                stability_check: bool,
+                warm_start: bool = False):
+    comppropDB = db.load_comppropDB(comppropDB_path)
+    binarycoefDB = db.load_binarycoefDB(binarycoefDB_path)
+    worker_state['streams'] = StreamCache(comppropDB, binarycoefDB, directory)
+    worker_state['method'] = method
+    worker_state['stability_check'] = stability_check
+    worker_state['warm_start'] = warm_start
+
+
+def run_chunk(cases: list):
+    return [run_case(case,
+                     worker_state['streams'],
+                     worker_state['method'],
+                     worker_state['stability_check'],
+                     worker_state['warm_start'])
+            for case in cases]
+
+
+def get_chunks(cases,
+               chunksize: int):
+    cases = iter(cases)
+    while True:
+        chunk = list(itertools.islice(cases, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_failed_records(cases: list,
+                       error: str):
+    return [dict(case, error=error) for case in cases]
+
+
+class WorkerPool:
+    ### ProcessPoolExecutor that is restarted when a worker process dies (e.g. killed or crashed in native code)
+    ### function(chunk) runs in the workers and returns one record per case of the chunk
+    def __init__(self,
+                 workers: int,
+                 initargs: tuple,
+                 initializer=init_worker,
+                 function=run_chunk):
+        self.workers = workers
+        self.initargs = initargs
+        self.initializer = initializer
+        self.function = function
+        self.executor = self.start()
+
+    def start(self):
+        return futures_process.ProcessPoolExecutor(self.workers, initializer=self.initializer, initargs=self.initargs)
+
+    def restart(self, executor):
+        ### Only the pool that broke is replaced, futures of an already replaced pool do not restart it again
+        if executor is self.executor:
+            executor.shutdown(wait=False)
+            self.executor = self.start()
+
+    def submit(self, chunk: list):
+        try:
+            return self.executor, self.executor.submit(self.function, chunk)
+        except futures_process.BrokenProcessPool:
+            self.restart(self.executor)
+            return self.executor, self.executor.submit(self.function, chunk)
+
+    def get_records(self,
+                    chunk: list,
+                    executor,
+                    future):
+        ### Records of a submitted chunk; after a worker death the chunk is rerun case by case,
+        ### so only the case that kills its worker is lost
+        try:
+            return future.result()
+        except futures_process.BrokenProcessPool:
+            self.restart(executor)
+            if len(chunk) == 1:
+                return get_failed_records(chunk, 'BrokenProcessPool: worker process terminated')
+            records = list()
+            for case in chunk:
+                records.extend(self.get_records([case], *self.submit([case])))
+            return records
+        except Exception as error:
+            return get_failed_records(chunk, '{}: {}'.format(type(error).__name__, error))
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def run_batch_parallel(cases_path: str,
+                       output_path: str,
+                       comppropDB_path: str,
+                       binarycoefDB_path: str,
+                       workers: int = None,
+                       chunksize: int = 16,
+                       method: str = 'ss',
+                       stability_check: bool = False,
+                       show_log: bool = True,
+                       long_format: bool = False,
+                       warm_start: bool = False):
+    ### run_batch over a process pool, same records in the same order
+    ### Returns the number of cases, the number of failed ones and the number of cases that did not converge
+    workers = workers or os.cpu_count()
+    initargs = (os.path.abspath(comppropDB_path),
+                os.path.abspath(binarycoefDB_path),
+                os.path.dirname(os.path.abspath(cases_path)),
+                method,
+                stability_check,
+                warm_start)
+    pool = WorkerPool(workers, initargs)
+    pending = deque()
+    cases_num = 0
+    failed_num = 0
+    unconverged_num = 0
+    start_time = time.perf_counter()
+    ### The database cache is compiled by now, the long table writer only maps it
+    writer = get_writer(output_path, db.load_comppropDB(comppropDB_path), long_format)
+
+    def write_next():
+        nonlocal cases_num, failed_num, unconverged_num
+        chunk, executor, future = pending.popleft()
+        for record in pool.get_records(chunk, executor, future):
+            writer.write(record)
+            cases_num += 1
+            if record['error']:
+                failed_num += 1
+                if show_log:
+                    print('Case {} failed - {}'.format(record['case'], record['error']))
+            elif not record['converged']:
+                unconverged_num += 1
+                if show_log:
+                    print('Case {} not converged in {} iterations'.format(record['case'], record['iterations']))
+
+    try:
+        for chunk in get_chunks(read_cases(cases_path), chunksize):
+            pending.append((chunk,) + pool.submit(chunk))
+            if len(pending) > 2 * workers:
+                write_next()
+        while pending:
+            write_next()
+    finally:
+        pool.shutdown()
+        writer.close()
+    if show_log:
+        print('{} cases ({} failed, {} not converged) in {:.1f} s on {} workers'.format(cases_num,
+                                                                                        failed_num,
+                                                                                        unconverged_num,
+                                                                                        time.perf_counter() - start_time,
+                                                                                        workers))
+    return cases_num, failed_num, unconverged_num
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch PR-EOS flash of a case table')
+    parser.add_argument('cases', help='case table, .csv or .jsonl')
+    parser.add_argument('output', help='results file: .jsonl (records with compositions), .csv (summary) or '
+                                       '.parquet/.arrow (long table, needs pyarrow)')
+    parser.add_argument('--compprop', help='components properties database xlsx')
+    parser.add_argument('--binarycoef', help='binary interaction coefficients database xlsx')
+    parser.add_argument('--method', choices=METHODS, default='ss')
+    parser.add_argument('--stability-check', action='store_true', help='stability test before each flash')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='start each flash from the K-values of the nearest converged case of the same stream')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, 0 - one per CPU')
+    parser.add_argument('--chunksize', type=int, default=16, help='cases sent to a worker at once')
+    parser.add_argument('--long', action='store_true', help='long table (phase and component rows) for .csv output')
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='flash log: DEBUG - K-value errors of every iteration, INFO - convergence summaries')
+    parser.add_argument('--profile', action='store_true', help='print time per flash stage (serial runs only)')
+    parser.add_argument('--trace', help='write K-value iteration histories as .jsonl (serial runs only)')
+    args = parser.parse_args()
+    instr.set_log_level(args.log_level)
+    if args.profile or args.trace:
+        instr.profiler.enable(trace=bool(args.trace))
+    cwd = os.getcwd()
+    comppropDB_path = intrf.get_database_path(cwd, 'comppropDB', args.compprop)
+    binarycoefDB_path = intrf.get_database_path(cwd, 'binarycoefDB', args.binarycoef)
+    if args.workers == 1:
+        comppropDB = db.load_comppropDB(comppropDB_path)
+        binarycoefDB = db.load_binarycoefDB(binarycoefDB_path)
+        run_batch(args.cases,
+                  args.output,
+                  comppropDB,
+                  binarycoefDB,
+                  args.method,
+                  args.stability_check,
+                  long_format=args.long,
+                  warm_start=args.warm_start)
+        if args.profile:
+            instr.profiler.print_report()
+        if args.trace:
+            instr.profiler.export_trace(args.trace)
+    else:
+        ### Compiling the database cache before the workers start, so they only map it
+        db.load_comppropDB(comppropDB_path)
+        db.load_binarycoefDB(binarycoefDB_path)
+        run_batch_parallel(args.cases,
+                           args.output,
+                           comppropDB_path,
+                           binarycoefDB_path,
+                           args.workers,
+                           args.chunksize,
+                           args.method,
+                           args.stability_check,
+                           long_format=args.long,
+                           warm_start=args.warm_start)
+
+
+if __name__ == '__main__':
+    main()
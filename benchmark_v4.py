@@ -0,0 +1,359 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import Interfaces as intrf
+import Calculations_v4 as calc
+import Database as db
+import Instrumentation as instr
+import Kernels as kern
+import batch_v4 as batch
+
+### Benchmark and regression harness over the shipped Stream* - StreamComposition.xlsx files
+### Every stream is flashed at the reference P/T points; wall time, K-value iterations and cubic solves are recorded
+### and compositions, phase fractions and z-factors are compared against the golden values with tolerances
+### Usage: python benchmark_v4.py [--report benchmark_report.json]    - check against the golden values
+###        python benchmark_v4.py --update-golden                      - store current results as golden values
+### Exit code is 1 when any case does not converge or is off the golden values, the flash with the stability test
+### disagrees with the full flash, the batch long table writer fails, or the solver import is over its budget
+GOLDEN_NAME = 'benchmark_golden.json'
+REFERENCE_POINTS = [(10, 20), (50, 0), (70, -20), (30, 40), (100, 10)]  # [bara], [C]
+### Extra points where only the flash with the stability test is checked against the full flash (no golden values):
+### wet feeds with an aqueous phase the vapor-like and liquid-like trials alone do not find, and dense single phases
+### near the envelope, where the vapor / liquid label depends on the side of the two-phase region
+STABILITY_POINTS = {'Stream1 (GPSA exmpl) - StreamComposition.xlsx': [(200, -60)],
+                    'Stream2 - StreamComposition.xlsx': [(200, 150)],
+                    'Stream3 (UKPG K-1 ovrhd) - StreamComposition.xlsx': [(60, -60), (120, -60), (200, -60)],
+                    'Stream4 (Tarkhovskoe) - StreamComposition.xlsx': [(120, 10), (200, 10), (200, -20), (200, -60)],
+                    'Stream5 (Lugovoe) - StreamComposition.xlsx': [(200, -60)],
+                    'Stream6 (Lugovoe Saturated) - StreamComposition.xlsx': [(1, 20), (5, 60), (120, 150), (200, 150)],
+                    'Stream8 (GPSA Dew Point exmpl) - StreamComposition.xlsx': [(200, -60)]}
+convcrit = 10 ** -4
+steps_limit = 100  # the successive substitution needs 56 iterations for Stream8 at 100 bara / 10 C
+### STABILITY_POINTS lie next to phase boundaries, where K's stopped at convcrit may leave a trace phase that is not
+### there (Stream4 at 120 bara / 10 C gives V = 0.0009 with the accelerated solver), so they are flashed tighter
+stability_convcrit = 10 ** -8
+stability_steps_limit = 300
+TOLERANCES = {'composition': 10 ** -4, 'phase fraction': 10 ** -4, 'zfactor': 10 ** -4}
+### Import of the solver in a fresh interpreter (python -X importtime), numpy excluded as the one library it needs;
+### pandas must not be loaded by the import at all; budgets [ms] are for the import without numpy, about twice the
+### median measured on slower machines (42 ms for Calculations_v4, 75 ms for batch_v4), so noise does not fail a run
+IMPORT_BUDGETS_MS = {'Calculations_v4': 90, 'Interfaces': 10, 'batch_v4': 160}
+IMPORT_REPEATS = 5
+
+
+def get_case_key(stream: str,
+                 P_bar: float,
+                 T_C: float):
+    return '{} | {:g} bara | {:g} C'.format(stream, P_bar, T_C)
+
+
+def run_case(compset: calc.ComponentSet,
+             z: np.ndarray,
+             P_bar: float,
+             T_C: float,
+             repeats: int,
+             method: str):
+    ### Best and median wall time of repeated flashes, counters and results of the last one
+    P_field = calc.UnitsConverter.Pressure.kPa_to_psi(calc.UnitsConverter.Pressure.bar_to_kPa(P_bar))
+    T_field = calc.UnitsConverter.Temperature.C_to_R(T_C)
+    times = list()
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        equicomp, phase_fractions, zfactors, iterations, K, converged = calc.flash_PR_EOS_arr(compset,
+                                                                                              z,
+                                                                                              P_field,
+                                                                                              T_field,
+                                                                                              convcrit,
+                                                                                              steps_limit,
+                                                                                              method,
+                                                                                              show_log=False,
+                                                                                              full_output=True)
+        times.append(time.perf_counter() - start_time)
+    ### Cubic roots solved by one flash, counted on an extra untimed run
+    instr.profiler.reset()
+    instr.profiler.enable()
+    calc.flash_PR_EOS_arr(compset, z, P_field, T_field, convcrit, steps_limit, method, show_log=False)
+    instr.profiler.disable()
+    return {'time min [ms]': min(times) * 1000,
+            'time median [ms]': float(np.median(times)) * 1000,
+            'iterations': int(iterations),
+            'cubic solves': instr.profiler.counters.get('cubic roots', 0),
+            'stability path consistent': check_stability_path(compset, z, P_field, T_field, method, phase_fractions,
+                                                              zfactors),
+            'result': {'converged': converged,
+                       'phase fractions': phase_fractions.tolist(),
+                       'zfactors': zfactors.tolist(),
+                       'compositions': equicomp.tolist()}}
+
+
+def run_stability_check(compset: calc.ComponentSet,
+                        z: np.ndarray,
+                        P_bar: float,
+                        T_C: float,
+                        method: str):
+    P_field = calc.UnitsConverter.Pressure.kPa_to_psi(calc.UnitsConverter.Pressure.bar_to_kPa(P_bar))
+    T_field = calc.UnitsConverter.Temperature.C_to_R(T_C)
+    equicomp, phase_fractions, zfactors, iterations = calc.flash_PR_EOS_arr(compset,
+                                                                            z,
+                                                                            P_field,
+                                                                            T_field,
+                                                                            stability_convcrit,
+                                                                            stability_steps_limit,
+                                                                            method,
+                                                                            show_log=False)
+    return check_stability_path(compset, z, P_field, T_field, method, phase_fractions, zfactors,
+                                stability_convcrit, stability_steps_limit)
+
+
+def check_stability_path(compset: calc.ComponentSet,
+                          z: np.ndarray,
+                          P_field: float,
+                          T_field: float,
+                          method: str,
+                          phase_fractions: np.ndarray,
+                          zfactors: np.ndarray,
+                          convcrit: float = convcrit,
+                          steps_limit: int = steps_limit,
+                          tolerances: dict = TOLERANCES):
+    ### The flash with the stability test must find the same phases as the full flash, and a single phase must get
+    ### the same z-factor (the feed's); multiphase results of both are flashed alike and not compared further
+    ### A phase counts as present above the phase fraction tolerance: next to a phase boundary the K-value loop may
+    ### stop at a trace of the incipient phase (V = 3.5e-10 for Stream4 at 120 bara / 10 C with the accelerated solver)
+    equicomp, stable_fractions, stable_zfactors, iterations = calc.flash_PR_EOS_arr(compset,
+                                                                                    z,
+                                                                                    P_field,
+                                                                                    T_field,
+                                                                                    convcrit,
+                                                                                    steps_limit,
+                                                                                    method,
+                                                                                    show_log=False,
+                                                                                    stability_check=True)
+    exists = phase_fractions > tolerances['phase fraction']
+    if not np.array_equal(exists, stable_fractions > tolerances['phase fraction']):
+        return False
+    if np.count_nonzero(exists) != 1:
+        return True
+    return bool(np.max(np.abs(phase_fractions - stable_fractions)) <= tolerances['phase fraction']
+                and np.abs(zfactors[exists] - stable_zfactors[exists]).max() <= tolerances['zfactor'])
+
+
+def check_long_table(comppropDB: pd.DataFrame,
+                     compset: calc.ComponentSet,
+                     z: np.ndarray,
+                     P_bar: float = 10,
+                     T_C: float = 20):
+    ### batch_v4 long table of a flashed case and of a case without any phase composition (as a flash at P < 0 used
+    ### to give): one row per component of each present phase, no rows and no error for the empty one
+    P_field = calc.UnitsConverter.Pressure.kPa_to_psi(calc.UnitsConverter.Pressure.bar_to_kPa(P_bar))
+    T_field = calc.UnitsConverter.Temperature.C_to_R(T_C)
+    equicomp, phase_fractions, zfactors, iterations = calc.flash_PR_EOS_arr(compset,
+                                                                            z,
+                                                                            P_field,
+                                                                            T_field,
+                                                                            convcrit,
+                                                                            steps_limit,
+                                                                            show_log=False)
+    case = {'stream': 'check', 'P [bara]': P_bar, 'T [C]': T_C}
+    records = [batch.get_record(dict(case, case='flashed'), compset, equicomp, phase_fractions, zfactors, iterations,
+                                True),
+               batch.get_record(dict(case, case='empty'), compset, np.full(equicomp.shape, np.nan),
+                                np.array([0.5, 0.5, 0]), np.full(3, np.nan), 2, False)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'long.csv')
+        writer = batch.LongTableWriter(path, comppropDB)
+        for record in records:
+            record['error'] = ''
+            writer.write(record)
+        writer.close()
+        table = pd.read_csv(path)
+    return bool(len(table) == len(compset) * np.count_nonzero(phase_fractions > 0)
+                and (table['case'] == 'flashed').all())
+
+
+def get_max_diff(values: list,
+                 golden: list):
+    ### Largest absolute difference and whether absent (NaN) entries are the same
+    values = np.array(values, dtype=float)
+    golden = np.array(golden, dtype=float)
+    same_phases = bool((np.isnan(values) == np.isnan(golden)).all())
+    diff = np.abs(values - golden)
+    return float(np.nanmax(diff)) if np.isfinite(diff).any() else 0.0, same_phases
+
+
+def compare(result: dict,
+            golden: dict,
+            tolerances: dict):
+    ### A case passes only when its K-value loop converged and the results are within tolerances of golden values
+    ### that converged as well
+    comparison = {'passed': result['converged'] and golden.get('converged', False)}
+    for name, key in (('composition', 'compositions'), ('phase fraction', 'phase fractions'), ('zfactor', 'zfactors')):
+        max_diff, same_phases = get_max_diff(result[key], golden[key])
+        comparison['max {} diff'.format(name)] = max_diff
+        comparison['passed'] &= same_phases and max_diff <= tolerances[name]
+        if not same_phases:
+            comparison['{} phases differ'.format(name)] = True
+    return comparison
+
+
+def run_benchmark(directory: str,
+                  comppropDB: pd.DataFrame,
+                  binarycoefDB: pd.DataFrame,
+                  golden: dict,
+                  repeats: int = 5,
+                  method: str = 'ss',
+                  tolerances: dict = TOLERANCES,
+                  show_log: bool = True):
+    ### Runs all stream files at the reference points; returns the report and the current results by case key
+    cases = list()
+    stability_checks = list()
+    results = dict()
+    for stream in sorted(intrf.get_streamcomp_names(directory)):
+        input_streamcomp = pd.read_excel(os.path.join(directory, stream), index_col='Name')
+        compset = calc.ComponentSet(comppropDB, binarycoefDB, input_streamcomp.index)
+        z = input_streamcomp['Content [mol. fract.]'].to_numpy(dtype=float)
+        for P_bar, T_C in REFERENCE_POINTS:
+            key = get_case_key(stream, P_bar, T_C)
+            case = run_case(compset, z, P_bar, T_C, repeats, method)
+            results[key] = case.pop('result')
+            case = dict({'case': key, 'stream': stream, 'P [bara]': P_bar, 'T [C]': T_C,
+                         'converged': results[key]['converged']}, **case)
+            if key in golden:
+                case.update(compare(results[key], golden[key], tolerances))
+            else:
+                case['passed'] = None
+            if not case['stability path consistent'] or not results[key]['converged']:
+                case['passed'] = False
+            cases.append(case)
+            if show_log:
+                print('{:<70} {:>8.2f} ms {:>4} it {:>6} cubic  {}'.format(key,
+                                                                          case['time median [ms]'],
+                                                                          case['iterations'],
+                                                                          case['cubic solves'],
+                                                                          {True: 'ok', False: 'FAILED', None: 'no golden'}[case['passed']]))
+        for P_bar, T_C in STABILITY_POINTS.get(stream, []):
+            key = get_case_key(stream, P_bar, T_C)
+            stability_checks.append({'case': key, 'passed': run_stability_check(compset, z, P_bar, T_C, method)})
+            if show_log:
+                print('{:<70} stability path  {}'.format(key, 'ok' if stability_checks[-1]['passed'] else 'FAILED'))
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'pandas': pd.__version__,
+              'kernels': kern.get_backend(),
+              'platform': platform.platform(),
+              'settings': {'method': method,
+                           'repeats': repeats,
+                           'convcrit': convcrit,
+                           'steps_limit': steps_limit,
+                           'tolerances': tolerances},
+              'summary': {'cases': len(cases),
+                          'passed': sum(case['passed'] is True for case in cases),
+                          'failed': sum(case['passed'] is False for case in cases),
+                          'without golden': sum(case['passed'] is None for case in cases),
+                          'total time median [ms]': sum(case['time median [ms]'] for case in cases),
+                          'total time min [ms]': sum(case['time min [ms]'] for case in cases),
+                          'iterations': sum(case['iterations'] for case in cases),
+                          'cubic solves': sum(case['cubic solves'] for case in cases),
+                          'stability checks failed': sum(not check['passed'] for check in stability_checks)},
+              'cases': cases,
+              'stability checks': stability_checks}
+    return report, results
+
+
+def measure_import_time(module: str,
+                        repeats: int = IMPORT_REPEATS):
+    ### Median cumulative import time of module [ms], the part of it spent importing numpy [ms] and whether pandas
+    ### got loaded, each from a fresh interpreter
+    directory = os.path.dirname(os.path.abspath(__file__))
+    code = 'import {}, Lazy; print(Lazy.is_loaded("pandas"))'.format(module)
+    totals = []
+    numpy_times = []
+    pandas_loaded = False
+    for i in range(repeats):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=directory,
+                                   capture_output=True, text=True, check=True)
+        cumulative = dict()
+        for line in completed.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                self_time, cumulative_time, name = line[len('import time:'):].split('|')
+                if cumulative_time.strip().isdigit():
+                    cumulative[name.strip()] = int(cumulative_time) / 1000
+        totals.append(cumulative[module])
+        numpy_times.append(cumulative.get('numpy', 0.))
+        pandas_loaded = pandas_loaded or completed.stdout.strip() == 'True'
+    return float(np.median(totals)), float(np.median(numpy_times)), pandas_loaded
+
+
+def check_import_times(budgets_ms: dict = IMPORT_BUDGETS_MS):
+    ### {module: {'import [ms]', 'numpy [ms]', 'own [ms]', 'budget [ms]', 'pandas loaded', 'passed'}}
+    checks = dict()
+    for module, budget_ms in budgets_ms.items():
+        total, numpy_time, pandas_loaded = measure_import_time(module)
+        checks[module] = {'import [ms]': total,
+                          'numpy [ms]': numpy_time,
+                          'own [ms]': total - numpy_time,
+                          'budget [ms]': budget_ms,
+                          'pandas loaded': pandas_loaded,
+                          'passed': total - numpy_time <= budget_ms and not pandas_loaded}
+        print('import {:<20} {:8.1f} ms ({:.1f} ms without numpy, budget {} ms){}  {}'.format(
+            module, total, total - numpy_time, budget_ms, ', pandas loaded' if pandas_loaded else '',
+            'ok' if checks[module]['passed'] else 'OVER BUDGET'))
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flash benchmark and regression check over the Stream* files')
+    parser.add_argument('--directory', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='directory with the stream files and databases')
+    parser.add_argument('--golden', help='golden values json, {} in the directory by default'.format(GOLDEN_NAME))
+    parser.add_argument('--report', default='benchmark_report.json', help='machine-readable report')
+    parser.add_argument('--repeats', type=int, default=5, help='flashes per case for timing')
+    parser.add_argument('--method', choices=batch.METHODS, default='ss')
+    parser.add_argument('--update-golden', action='store_true', help='store the current results as golden values')
+    parser.add_argument('--skip-import-check', action='store_true', help='no import time check against the budgets')
+    args = parser.parse_args()
+    golden_path = args.golden or os.path.join(args.directory, GOLDEN_NAME)
+    comppropDB = db.load_comppropDB(intrf.get_database_path(args.directory, 'comppropDB'))
+    binarycoefDB = db.load_binarycoefDB(intrf.get_database_path(args.directory, 'binarycoefDB'))
+    golden = dict()
+    if os.path.exists(golden_path) and not args.update_golden:
+        with open(golden_path) as file:
+            golden = json.load(file)
+    imports = dict() if args.skip_import_check else check_import_times()
+    report, results = run_benchmark(args.directory, comppropDB, binarycoefDB, golden, args.repeats, args.method)
+    report['imports'] = imports
+    stream = sorted(intrf.get_streamcomp_names(args.directory))[0]
+    input_streamcomp = pd.read_excel(os.path.join(args.directory, stream), index_col='Name')
+    report['long table'] = check_long_table(comppropDB,
+                                            calc.ComponentSet(comppropDB, binarycoefDB, input_streamcomp.index),
+                                            input_streamcomp['Content [mol. fract.]'].to_numpy(dtype=float))
+    print('long table writer {}'.format('ok' if report['long table'] else 'FAILED'))
+    with open(args.report, 'w') as file:
+        json.dump(instr.get_json_safe(report), file, indent=1)
+    summary = report['summary']
+    print('\n{} cases: {} passed, {} failed, {} without golden values; {:.1f} ms total (median), '
+          '{} iterations, {} cubic solves; {} stability checks failed'.format(summary['cases'],
+                                                                              summary['passed'],
+                                                                              summary['failed'],
+                                                                              summary['without golden'],
+                                                                              summary['total time median [ms]'],
+                                                                              summary['iterations'],
+                                                                              summary['cubic solves'],
+                                                                              summary['stability checks failed']))
+    if args.update_golden:
+        with open(golden_path, 'w') as file:
+            json.dump(instr.get_json_safe(results), file, indent=1)
+        print('Golden values written to {}'.format(golden_path))
+    sys.exit(1 if summary['failed'] or summary['stability checks failed'] or not report['long table']
+             or not all(check['passed'] for check in imports.values()) else 0)
+
+
+if __name__ == '__main__':
+    main()
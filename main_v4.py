@@ -1,10 +1,17 @@
+from __future__ import annotations
 import os
 import Interfaces as intrf
 import Calculations_v4 as calc
-import pandas as pd
+import Database as db
+import Results as res
+import Properties as prop
+import Instrumentation as instr
+import Lazy as lazy
 import numpy as np
 import time
 import sys
+import argparse
+pd = lazy.lazy_import('pandas')
 
 '''
 REFERENCES
@@ -22,101 +29,121 @@ convcrit = 10**-4 # Convergence criteria for K-values
 steps_limit = 50
 
 
-### Import of Components Properties and Binary Interraction Coefficients Databases
-cwd = os.getcwd()
-comppropDB = pd.read_excel(intrf.get_comppropDB_names(cwd)[1], index_col= 'Name')
-binarycoefDB = pd.read_excel(intrf.get_binarycoefDB_names(cwd)[0], index_col= 'index_col')
-
-
-### Input of main parameters
-streamcomp_names_list = intrf.get_streamcomp_names(cwd)
-print('Select stream composition file:')
-streamcomp_name = intrf.select_file(streamcomp_names_list) #'Stream1 (GPSA exmpl) - StreamComposition.xlsx'
-input_streamcomp = pd.read_excel(streamcomp_name, index_col= 'Name')
-
-print('Input operating pressure P [bara]:')
-P = calc.UnitsConverter.Pressure.bar_to_kPa(float(input()))
-P_field = calc.UnitsConverter.Pressure.kPa_to_psi(P)
-print('Input operating temperature T [C]:')
-T = float(input())
-T_field = calc.UnitsConverter.Temperature.C_to_R(T)
-
-print('\nINPUT SUMMARY:')
-print('\t- Pressure - {:.1f} kPa\n\t- Temperature - {:.1f} C'.format(P, T))
-print('\t- Stream composition [mol. fract.]:')
-for component in input_streamcomp.index:
-	print('\t\t{:>10} - {:.4f}'.format(component, input_streamcomp.loc[component]['Content [mol. fract.]']))
-print('-'*30, end= '\n\n')
-
-print('Confirm input? ("y" - yes, "n" - no)')
-confirm = str(input())
-if confirm == 'n':
-	sys.exit()
-
-start_time = time.perf_counter()
-pd.options.display.float_format = '{:>8.4f}'.format
-
-### Performing Flash Calculations
-equicomp_df, phase_fractions, zfactors = calc.flash_calc_PR_EOS(comppropDB,
-																binarycoefDB,
-																input_streamcomp,
-																P_field,
-																T_field,
-																convcrit,
-																steps_limit)
-
-print('\n\nPhase Compositions:\n', equicomp_df)
-### Check phase compositions sums
-composition_check = pd.DataFrame({(equicomp_df['vapor'].sum(),
-								   equicomp_df['liquid'].sum(),
-								   equicomp_df['aqueous'].sum())},
-								 columns= (['vapor', 'liquid', 'aqueous']),
-								 index= ['TOTAL'])
-
-print(composition_check)
-print('\nVapor fraction (mol.): {:.5f}\nLiquid Fraction (mol.): {:.5f}\nAqueous Fraction (mol.): {:.5f}'.format(phase_fractions['V'],
-																											phase_fractions['L'],
-																											phase_fractions['Q']))
-
-
-### PHYSICAL PROPERTIES CALCULATIONS
-print('\n\nPhase properties:')
-liquid_density = calc.get_liquid_phase_density(comppropDB, equicomp_df, T_field, 'liquid')
-aqueous_density = calc.get_liquid_phase_density(comppropDB, equicomp_df, T_field, 'aqueous')
-vapor_density = calc.get_vapor_phase_density(comppropDB, equicomp_df, P_field, T_field, zfactors.loc['vapor']['zj'])
-print('Vapor phase Density [kg/m3]:\t {:.2f}'.format(vapor_density))
-print('Liquid phase Density [kg/m3]:\t {:.2f}'.format(liquid_density))
-print('Aqueous phase Density [kg/m3]:\t {:.2f}'.format(aqueous_density))
-
-densities = pd.Series([vapor_density, liquid_density, aqueous_density], index=['V', 'L', 'Q'])
-phaseMW = pd.Series([calc.get_phase_molar_weigh(comppropDB, equicomp_df, 'vapor'),
-					 calc.get_phase_molar_weigh(comppropDB, equicomp_df, 'liquid'),
-					 calc.get_phase_molar_weigh(comppropDB, equicomp_df, 'aqueous')], index=['V', 'L', 'Q'])
-print('mixro={}'.format(calc.get_mix_density(densities, phase_fractions, phaseMW)))
-
-### DOES NOT WORK STABLE WITH WATER AD DOES NOT WORK WITHOUT WATER !!!
-
-print('MW vapor:\t{}\nMW liquid:\t{}\nMW aqueous:\t'.format(calc.get_phase_molar_weigh(comppropDB, equicomp_df, 'vapor'),
-															calc.get_phase_molar_weigh(comppropDB, equicomp_df, 'liquid')))
-
-
-print('\nExecution time: {:.1f} ms\n'.format((time.perf_counter() - start_time) * 1000))
-
-
-try:
-	writer = pd.ExcelWriter('solver_output.xlsx')
-	equicomp_df.to_excel(writer)
-	writer.save()
-except:
-	print('Failed to write down results')
-
-print('Open output file? ("y" - yes, "n" - no)')
-confirm = str(input())
-if confirm == 'y':
+def main():
+	### Databases and the stream file are looked up in the working directory unless given explicitly;
+	### nothing is read before the run is started
+	parser = argparse.ArgumentParser(description='Flash of one stream composition at P and T given interactively')
+	parser.add_argument('--directory', help='directory with the databases and stream files, working directory by default')
+	parser.add_argument('--compprop', help='components properties database xlsx')
+	parser.add_argument('--binarycoef', help='binary interaction coefficients database xlsx')
+	parser.add_argument('--stream', help='stream composition xlsx, selected from the directory listing by default')
+	args = parser.parse_args()
+	instr.set_log_level('INFO') # 'DEBUG' - K-values error at every iteration
+
+	### Import of Components Properties and Binary Interraction Coefficients Databases
+	directory = args.directory or os.getcwd()
+	comppropDB = db.load_comppropDB(intrf.get_database_path(directory, 'comppropDB', args.compprop))
+	binarycoefDB = db.load_binarycoefDB(intrf.get_database_path(directory, 'binarycoefDB', args.binarycoef))
+
+
+	### Input of main parameters
+	if args.stream:
+		streamcomp_name = args.stream
+	else:
+		print('Select stream composition file:')
+		streamcomp_name = os.path.join(directory, intrf.select_file(intrf.get_streamcomp_names(directory))) #'Stream1 (GPSA exmpl) - StreamComposition.xlsx'
+	input_streamcomp = pd.read_excel(streamcomp_name, index_col= 'Name')
+
+	print('Input operating pressure P [bara]:')
+	P = calc.UnitsConverter.Pressure.bar_to_kPa(float(input()))
+	P_field = calc.UnitsConverter.Pressure.kPa_to_psi(P)
+	print('Input operating temperature T [C]:')
+	T = float(input())
+	T_field = calc.UnitsConverter.Temperature.C_to_R(T)
+
+	print('\nINPUT SUMMARY:')
+	print('\t- Pressure - {:.1f} kPa\n\t- Temperature - {:.1f} C'.format(P, T))
+	print('\t- Stream composition [mol. fract.]:')
+	for component in input_streamcomp.index:
+		print('\t\t{:>10} - {:.4f}'.format(component, input_streamcomp.loc[component]['Content [mol. fract.]']))
+	print('-'*30, end= '\n\n')
+
+	print('Confirm input? ("y" - yes, "n" - no)')
+	confirm = str(input())
+	if confirm == 'n':
+		return
+
+	start_time = time.perf_counter()
+	pd.options.display.float_format = '{:>8.4f}'.format
+
+	### Performing Flash Calculations
+	equicomp_df, phase_fractions, zfactors = calc.flash_calc_PR_EOS(comppropDB,
+																	binarycoefDB,
+																	input_streamcomp,
+																	P_field,
+																	T_field,
+																	convcrit,
+																	steps_limit)
+
+	print('\n\nPhase Compositions:\n', equicomp_df)
+	### Check phase compositions sums
+	composition_check = pd.DataFrame({(equicomp_df['vapor'].sum(),
+									   equicomp_df['liquid'].sum(),
+									   equicomp_df['aqueous'].sum())},
+									 columns= (['vapor', 'liquid', 'aqueous']),
+									 index= ['TOTAL'])
+
+	print(composition_check)
+	print('\nVapor fraction (mol.): {:.5f}\nLiquid Fraction (mol.): {:.5f}\nAqueous Fraction (mol.): {:.5f}'.format(phase_fractions['V'],
+																												phase_fractions['L'],
+																												phase_fractions['Q']))
+
+
+	### PHYSICAL PROPERTIES CALCULATIONS
+	print('\n\nPhase properties:')
+	phaseMW, densities, density_mix = prop.get_phase_properties(comppropDB,
+																 equicomp_df,
+																 phase_fractions,
+																 zfactors,
+																 P_field,
+																 T_field)
+	print('Vapor phase Density [kg/m3]:\t {:.2f}'.format(densities['V']))
+	print('Liquid phase Density [kg/m3]:\t {:.2f}'.format(densities['L']))
+	print('Aqueous phase Density [kg/m3]:\t {:.2f}'.format(densities['Q']))
+	print('mixro={}'.format(density_mix))
+
+	print('MW vapor:\t{}\nMW liquid:\t{}\nMW aqueous:\t{}'.format(phaseMW['V'], phaseMW['L'], phaseMW['Q']))
+
+
+	print('\nExecution time: {:.1f} ms\n'.format((time.perf_counter() - start_time) * 1000))
+
+
+	### Each run is appended to the results table (long format: phase and component rows with phase properties)
+	output_name = 'solver_output.csv'
 	try:
-		os.system('start excel.exe "%s//solver_output.xlsx"' % (sys.path[0], ))
-	except:
-		print('Failed to open file')
+		with res.ResultSink(output_name) as sink:
+			sink.append_frames(os.path.splitext(os.path.basename(streamcomp_name))[0],
+							   P / 100,
+							   T,
+							   equicomp_df,
+							   phase_fractions,
+							   zfactors,
+							   phaseMW,
+							   densities)
+	except OSError as error:
+		print('Failed to write down results: {}'.format(error))
+
+	print('Open output file? ("y" - yes, "n" - no)')
+	confirm = str(input())
+	if confirm == 'y':
+		try:
+			os.system('start excel.exe "%s//%s"' % (sys.path[0], output_name))
+		except:
+			print('Failed to open file')
+
+
+if __name__ == '__main__':
+	main()
 
 # check_df = ([0.919783235, 0.047922284, 0.014828746, 0.003731263, 0.002115643, 0.000428368, 0.000361431, 0.000182001, 4.52983E-05, 0, 0, 0, 0.010600829, 0])
 # print('TEST PASSED: {}'.format((abs(equicomp_df_sum['vapor'] - check_df) < 10e-10).all()))
\ No newline at end of file
@@ -0,0 +1,385 @@
+from __future__ import annotations
+import os
+import json
+import time
+import argparse
+import threading
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import Lazy as lazy
+import Interfaces as intrf
+import Calculations_v4 as calc
+import Database as db
+import Properties as prop
+import Instrumentation as instr
+import batch_v4 as batch
+pd = lazy.lazy_import('pandas')
+
+### Local flash service: databases are loaded once per worker process and stay resident between requests
+### POST /flash, /density, /mw - JSON body is one case or {"cases": [...]} for a batch; a case is
+###     {"stream": "<stream composition xlsx>" or "composition": {"Methane": 0.9, ...},
+###      "P [bara]": 50, "T [C]": 0, "case": optional name}
+###     stream files are read only from the service --directory and its subdirectories; an optional per-case
+###     "method" must be one of batch_v4.METHODS, otherwise the case comes back with an error
+###     a single case returns its record, a batch returns {"results": [records in the request order]}
+###     /flash - phase fractions, z-factors and compositions (same records as batch_v4)
+###     /density - flash record plus phase and mixture densities [kg/m3] and phase molar weights
+###     /mw - flash record plus phase molar weights [g/mole]
+### GET /stats - request counts and p50/p99 latency per endpoint, GET /health
+### Usage: python server_v4.py serve --port 8765 --workers 4
+###        python server_v4.py load --stream "Stream4 (Tarkhovskoe) - StreamComposition.xlsx" --concurrency 8
+ENDPOINTS = ('flash', 'density', 'mw')
+LATENCY_WINDOW = 10000
+
+
+def get_phase_properties(comppropDB: pd.DataFrame,
+                         compset,
+                         P_field: float,
+                         T_field: float,
+                         equicomp: np.ndarray,
+                         phase_fractions: np.ndarray,
+                         zfactors: np.ndarray,
+                         densities: bool = True):
+    ### Molar weights and densities of the present phases with the main_v4 correlations (PR z-factor for vapor,
+    ### COSTALD for liquids); absent phases are left out
+    ### Property constants are kept per component set in the worker
+    propsets = worker_state.setdefault('propsets', dict())
+    propset = propsets.get(compset.key)
+    if propset is None:
+        propset = propsets[compset.key] = prop.PropertySet(comppropDB, compset.names)
+    properties = prop.get_phase_properties_arr(propset, equicomp, phase_fractions, zfactors, P_field, T_field)
+    present = [i for i in range(len(batch.PHASES)) if phase_fractions[i] > 0]
+    MW = {batch.PHASES[i]: float(properties['MW'][i]) for i in present}
+    if not densities:
+        return MW, None
+    density = {batch.PHASES[i]: float(properties['densities'][i]) for i in present}
+    density['mix'] = float(properties['density mix'])
+    return MW, density
+
+
+### Worker side
+worker_state = dict()
+
+
+def init_worker(comppropDB_path: str,
+                binarycoefDB_path: str,
+                directory: str,
+                method: str,
+                stability_check: bool,
+                warm_start: bool = False):
+    batch.init_worker(comppropDB_path, binarycoefDB_path, directory, method, stability_check, warm_start)
+    worker_state['comppropDB'] = batch.worker_state['streams'].comppropDB
+
+
+def check_stream(stream,
+                 directory: str):
+    ### Streams come from clients: the path must stay inside the service directory (no absolute paths, '..' or
+    ### symbolic links out of it)
+    directory = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(directory, str(stream)))
+    if os.path.isabs(str(stream)) or os.path.commonpath((directory, path)) != directory:
+        raise ValueError('stream must be a file in the service directory, got {}'.format(stream))
+
+
+def run_request(case: dict):
+    ### One case of a request; the endpoint travels with the case and is not echoed back
+    case = dict(case)
+    endpoint = case.pop('endpoint')
+    streams = batch.worker_state['streams']
+    try:
+        if 'composition' not in case and 'stream' in case:
+            check_stream(case['stream'], streams.directory)
+        compset, P_field, T_field, equicomp, phase_fractions, zfactors, iterations, converged = batch.flash_case(
+            case,
+            streams,
+            case.get('method', batch.worker_state['method']),
+            case.get('stability_check', batch.worker_state['stability_check']),
+            case.get('warm_start', batch.worker_state['warm_start']))
+        record = batch.get_record(case, compset, equicomp, phase_fractions, zfactors, iterations, converged)
+        if endpoint != 'flash':
+            MW, density = get_phase_properties(worker_state['comppropDB'],
+                                               compset,
+                                               P_field,
+                                               T_field,
+                                               equicomp,
+                                               phase_fractions,
+                                               zfactors,
+                                               densities=endpoint == 'density')
+            record['MW [g/mole]'] = MW
+            if density is not None:
+                record['density [kg/m3]'] = density
+        record['error'] = ''
+    except Exception as error:
+        record = dict(case, error='{}: {}'.format(type(error).__name__, error))
+    return record
+
+
+def run_requests(cases: list):
+    return [run_request(case) for case in cases]
+
+
+### Server side
+class LatencyStats:
+    ### Request counts and the latency of the last LATENCY_WINDOW requests per endpoint
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {endpoint: deque(maxlen=LATENCY_WINDOW) for endpoint in ENDPOINTS}
+        self.requests = dict.fromkeys(ENDPOINTS, 0)
+        self.cases = dict.fromkeys(ENDPOINTS, 0)
+        self.errors = dict.fromkeys(ENDPOINTS, 0)
+        self.unconverged = dict.fromkeys(ENDPOINTS, 0)
+
+    def add(self,
+            endpoint: str,
+            latency: float,
+            cases_num: int,
+            errors_num: int,
+            unconverged_num: int):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.requests[endpoint] += 1
+            self.cases[endpoint] += cases_num
+            self.errors[endpoint] += errors_num
+            self.unconverged[endpoint] += unconverged_num
+
+    def report(self):
+        with self.lock:
+            report = dict()
+            for endpoint in ENDPOINTS:
+                latencies = np.array(self.latencies[endpoint]) * 1000
+                report[endpoint] = {'requests': self.requests[endpoint],
+                                    'cases': self.cases[endpoint],
+                                    'failed cases': self.errors[endpoint],
+                                    'not converged cases': self.unconverged[endpoint],
+                                    'p50 [ms]': float(np.percentile(latencies, 50)) if latencies.size else None,
+                                    'p99 [ms]': float(np.percentile(latencies, 99)) if latencies.size else None}
+            return report
+
+
+class FlashService:
+    ### Splits requests into chunks for the worker pool and gathers the records in request order
+    def __init__(self,
+                 pool: batch.WorkerPool,
+                 chunksize: int = 8):
+        self.pool = pool
+        self.chunksize = chunksize
+        self.stats = LatencyStats()
+        self.lock = threading.Lock()
+
+    def submit(self, chunk: list):
+        ### WorkerPool restarts are not thread safe, request threads take turns submitting
+        with self.lock:
+            return self.pool.submit(chunk)
+
+    def get_records(self,
+                    chunk: list,
+                    executor,
+                    future):
+        try:
+            return future.result()
+        except Exception:
+            with self.lock:
+                return self.pool.get_records(chunk, executor, future)
+
+    def run(self,
+            endpoint: str,
+            cases: list):
+        start_time = time.perf_counter()
+        cases = [dict(case, endpoint=endpoint) for case in cases]
+        submitted = [(chunk,) + self.submit(chunk) for chunk in batch.get_chunks(cases, self.chunksize)]
+        records = list()
+        for chunk, executor, future in submitted:
+            records.extend(self.get_records(chunk, executor, future))
+        for record in records:
+            record.pop('endpoint', None)
+        self.stats.add(endpoint,
+                       time.perf_counter() - start_time,
+                       len(records),
+                       sum(1 for record in records if record['error']),
+                       sum(1 for record in records if not record['error'] and not record['converged']))
+        return records
+
+
+def get_request_cases(data):
+    ### Request body - one case object or {'cases': [case objects]}
+    if not isinstance(data, dict):
+        raise ValueError('request body must be a JSON object, got {}'.format(type(data).__name__))
+    if 'cases' not in data:
+        return [data]
+    cases = data['cases']
+    if not isinstance(cases, list) or not all(isinstance(case, dict) for case in cases):
+        raise ValueError("'cases' must be a list of JSON objects")
+    return cases
+
+
+class FlashRequestHandler(BaseHTTPRequestHandler):
+    service = None  # FlashService, set by serve()
+
+    def send_json(self,
+                  status: int,
+                  data):
+        body = json.dumps(instr.get_json_safe(data), default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.service.stats.report())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'unknown endpoint {}'.format(self.path)})
+
+    def do_POST(self):
+        endpoint = self.path.strip('/')
+        if endpoint not in ENDPOINTS:
+            self.send_json(404, {'error': 'unknown endpoint {}'.format(self.path)})
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as error:
+            self.send_json(400, {'error': 'invalid JSON: {}'.format(error)})
+            return
+        try:
+            cases = get_request_cases(data)
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        ### Case errors come back in the records, anything raised here is a service fault
+        try:
+            records = self.service.run(endpoint, cases)
+        except Exception as error:
+            self.send_json(500, {'error': '{}: {}'.format(type(error).__name__, error)})
+            return
+        if 'cases' in data:
+            self.send_json(200, {'results': records})
+        else:
+            self.send_json(200, records[0])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(comppropDB_path: str,
+          binarycoefDB_path: str,
+          host: str = '127.0.0.1',
+          port: int = 8765,
+          workers: int = None,
+          chunksize: int = 8,
+          directory: str = None,
+          method: str = 'ss',
+          stability_check: bool = False,
+          warm_start: bool = False):
+    workers = workers or os.cpu_count()
+    ### Compiling the database cache before the workers start, so they only map it
+    db.load_comppropDB(comppropDB_path)
+    db.load_binarycoefDB(binarycoefDB_path)
+    initargs = (os.path.abspath(comppropDB_path),
+                os.path.abspath(binarycoefDB_path),
+                os.path.abspath(directory or os.getcwd()),
+                method,
+                stability_check,
+                warm_start)
+    pool = batch.WorkerPool(workers, initargs, initializer=init_worker, function=run_requests)
+    FlashRequestHandler.service = FlashService(pool, chunksize)
+    server = ThreadingHTTPServer((host, port), FlashRequestHandler)
+    print('Flash service on http://{}:{} with {} workers'.format(host, port, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown()
+
+
+### Load test client
+def post_json(url: str,
+              data):
+    request = urllib.request.Request(url,
+                                     data=json.dumps(data).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run_load_test(url: str,
+                  stream: str,
+                  endpoint: str = 'flash',
+                  requests_num: int = 1000,
+                  concurrency: int = 8,
+                  batch_size: int = 1):
+    ### Concurrent requests over a P/T sweep of one stream; prints client-side and server-side p50/p99 latency
+    def get_case(number):
+        return {'stream': stream, 'P [bara]': 5 + number % 80, 'T [C]': -30 + (number * 7) % 70}
+
+    def run_one(number):
+        start_time = time.perf_counter()
+        if batch_size == 1:
+            post_json('{}/{}'.format(url, endpoint), get_case(number))
+        else:
+            post_json('{}/{}'.format(url, endpoint), {'cases': [get_case(number * batch_size + i)
+                                                                for i in range(batch_size)]})
+        return time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = np.array(list(executor.map(run_one, range(requests_num)))) * 1000
+    duration = time.perf_counter() - start_time
+    print('{} requests x {} cases, concurrency {}: {:.0f} cases/s'.format(requests_num,
+                                                                       batch_size,
+                                                                       concurrency,
+                                                                       requests_num * batch_size / duration))
+    print('Client latency p50 {:.1f} ms, p99 {:.1f} ms'.format(np.percentile(latencies, 50),
+                                                              np.percentile(latencies, 99)))
+    with urllib.request.urlopen('{}/stats'.format(url)) as response:
+        print('Server stats:', json.dumps(json.loads(response.read())[endpoint]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local PR-EOS flash service')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the service')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--workers', type=int, default=0, help='worker processes, 0 - one per CPU')
+    serve_parser.add_argument('--chunksize', type=int, default=8, help='cases of a batch sent to a worker at once')
+    serve_parser.add_argument('--directory', help='base directory of stream files, working directory by default')
+    serve_parser.add_argument('--compprop', help='components properties database xlsx')
+    serve_parser.add_argument('--binarycoef', help='binary interaction coefficients database xlsx')
+    serve_parser.add_argument('--method', choices=batch.METHODS, default='ss')
+    serve_parser.add_argument('--stability-check', action='store_true', help='stability test before each flash')
+    serve_parser.add_argument('--warm-start', action='store_true',
+                              help='start each flash from the K-values of the nearest converged case of the same feed')
+    load_parser = commands.add_parser('load', help='concurrent load test against a running service')
+    load_parser.add_argument('--url', default='http://127.0.0.1:8765')
+    load_parser.add_argument('--stream', required=True, help='stream composition xlsx, as seen by the service')
+    load_parser.add_argument('--endpoint', choices=ENDPOINTS, default='flash')
+    load_parser.add_argument('--requests', type=int, default=1000)
+    load_parser.add_argument('--concurrency', type=int, default=8)
+    load_parser.add_argument('--batch-size', type=int, default=1, help='cases per request')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        directory = args.directory or os.getcwd()
+        serve(intrf.get_database_path(directory, 'comppropDB', args.compprop),
+              intrf.get_database_path(directory, 'binarycoefDB', args.binarycoef),
+              args.host,
+              args.port,
+              args.workers,
+              args.chunksize,
+              args.directory,
+              args.method,
+              args.stability_check,
+              args.warm_start)
+    else:
+        run_load_test(args.url, args.stream, args.endpoint, args.requests, args.concurrency, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()